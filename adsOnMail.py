@@ -1,26 +1,59 @@
-from setups import UserSetup, Database
+import time
+startTime = time.time() # before all other imports, see `Main.writeStartupTimings`
+
+from setups import UserSetup, Database, LogWriter, LogCompactor
 from domains import Common
+from scheduler import AccountScheduler, LeaseManager
+from supervisor import ProcessSupervisor, stopWorker
+from imapEngine import ImapEngine
 
 import multiprocessing
 import sys
+import math
+import datetime
+import os
+import socket
+import signal
+
+try:
+    import psutil
+except ImportError:
+    # without psutil time from system boot is not stored
+    psutil = None
+
+importedTime = time.time()
 
 
 noUserSetup = len(sys.argv) > 1 and sys.argv[1] == 'nosetup'
+showReport = len(sys.argv) > 1 and sys.argv[1] == 'report' # `report [days]` prints step timings percentiles and loop stats
+useProcesses = len(sys.argv) > 2 and sys.argv[2] == 'processes' # one process per account instead of scheduler
+useShards = len(sys.argv) > 2 and sys.argv[2] == 'shard' # `nosetup shard [host]` processes only accounts leased by this host
+addRule = len(sys.argv) > 1 and sys.argv[1] == 'rule' # `rule <domain> <field> <kind> <pattern> [user]` adds ad rule
+showStatus = len(sys.argv) > 1 and sys.argv[1] == 'status' # prints state of worker processes (`nosetup processes` mode)
     
     
 class Main:
-    def __init__(self, noUserSetup):
+    def __init__(self, noUserSetup, useProcesses = False, useShards = False, host = None):
         self.noUserSetup = noUserSetup
+        self.useProcesses = useProcesses
+        self.useShards = useShards
+        self.host = host if host is not None else f'{socket.gethostname()}:{os.getpid()}'
+        self.maxConcurrentAccounts = 4
+        self.accountsPerBrowser = 10 # host owns at most that many accounts per browser it may run at once (sharding)
+        self.maxConcurrentAccountsPerDomain = 2
+        self.logsRetentionDays = 30 # older logs are compacted on start and then daily, only their daily stats are kept
+        self.maxWorkerRssMb = 1500 # worker process with its browsers using more memory is restarted
+        self.maxBootDelay = 15*60 # [s] program started later after system boot was not started from startup folder
         self.database = Database()
+        self.databaseTime = time.time()
         
-        self.domainClassDict = {class_.__name__.lower() : class_ for class_ in Common.__subclasses__()}
+        self.domainClassDict = {class_.__name__.lower() : class_ for class_ in Common.__subclasses__() if class_.engine == Common.engine}
         # keys -> class name as string
         # values -> actual class object
-        self.processes = []
 
     def _initUsers(self):
         possibleDomains = list(self.domainClassDict.keys())
-        setupper = UserSetup(self.database, possibleDomains)
+        setupper = UserSetup(self.database, possibleDomains, [Common.engine, ImapEngine.engine])
         setupper.saveData()
         
     def _minutesToSeconds(self, minutes):
@@ -31,9 +64,16 @@ class Main:
         password = user[2]
         domain = user[3]
         timeInterval = self._minutesToSeconds(user[4])
+        engine = user[5]
         
-        domainClass = self.domainClassDict[domain]
-        worker = domainClass(login, password, timeInterval)
+        if engine == ImapEngine.engine:
+            worker = ImapEngine(login, password, timeInterval, domain)
+        else:
+            domainClass = self.domainClassDict[domain]
+            worker = domainClass(login, password, timeInterval)
+        if user[6] is not None and user[7] is not None:
+            worker.minTimeInterval = self._minutesToSeconds(user[6])
+            worker.maxTimeInterval = self._minutesToSeconds(user[7])
         return worker
         
     def _setup(self):
@@ -42,18 +82,104 @@ class Main:
             exit()
         users = self.database.getUsers()
         classObjects = [self._getClassObjects(user) for user in users]
+        for class_ in classObjects:
+            class_.startupTime = startTime
         return classObjects
         
+    def writeStartupTimings(self):
+        '''
+        Stores time of startup phases as timings of `startup` domain (shown by `report`): time since system boot
+        (if program was started right after it), imports and database setup. Time to the first cycle of every account
+        is stored by account itself (`firstCycle` step), time to start worker process by worker (`workerStart` step)
+        '''
+        if psutil is not None and startTime - psutil.boot_time() < self.maxBootDelay:
+            self.database.writeTiming('', 'startup', 'bootToStart', 1, startTime - psutil.boot_time(), 'ok')
+        self.database.writeTiming('', 'startup', 'imports', 1, importedTime - startTime, 'ok')
+        self.database.writeTiming('', 'startup', 'database', 1, self.databaseTime - importedTime, 'ok')
+        
+    def printReport(self, days = None):
+        '''
+        Prints p50/p95/p99 of wall time of every step per domain and loops, errors and deleted ads
+        of every account (for last `days` days if given)
+        '''
+        sinceDate = datetime.datetime.now() - datetime.timedelta(days = days) if days is not None else None
+        timings, errors = self.database.getTimings(sinceDate)
+        print(f'{"domain":<10} {"step":<30} {"runs":>6} {"errors":>6} {"p50 [s]":>8} {"p95 [s]":>8} {"p99 [s]":>8}')
+        for (domain, step), seconds in sorted(timings.items()):
+            percentiles = [self._percentile(seconds, percent) for percent in (50, 95, 99)]
+            print(f'{domain:<10} {step:<30} {len(seconds):>6} {errors[(domain, step)]:>6} ' + ' '.join(f'{value:>8.2f}' for value in percentiles))
+        print(f'\n{"domain":<10} {"user":<30} {"loops":>6} {"errors":>6} {"deleted":>8}')
+        for (domain, userName), (loops, nErrors, deleted) in self.database.getUserStats(sinceDate).items():
+            print(f'{domain:<10} {userName:<30} {loops:>6} {nErrors:>6} {deleted:>8}')
+            
+    def printStatus(self):
+        '''
+        Prints the last state of worker processes saved by `ProcessSupervisor`
+        '''
+        print(f'{"domain":<10} {"user":<30} {"pid":>7} {"state":<8} {"restarts":>8} {"RSS [MB]":>8} {"exit":>5} {"next start":<19} {"updated":<19}')
+        for userName, domain, pid, state, restarts, rssMb, lastExitCode, nextStart, updated in self.database.getWorkerStatus():
+            print(f'{domain:<10} {userName:<30} {pid or "":>7} {state:<8} {restarts:>8} {rssMb:>8} {"" if lastExitCode is None else lastExitCode:>5} '
+                  f'{nextStart or "":<19} {updated:<19}')
+            
+    def _percentile(self, sortedValues, percent):
+        # nearest-rank method
+        return sortedValues[max(math.ceil(percent/100*len(sortedValues)) - 1, 0)]
+        
     def run(self):
+        # stopped like worker is, so scheduler releases leases, supervisor terminates workers and logs are flushed
+        signal.signal(signal.SIGTERM, stopWorker)
         classObjects = self._setup()
-        self.processes = [multiprocessing.Process(target=class_.run) for class_ in classObjects]
-        [process.start() for process in self.processes]
+        self.writeStartupTimings()
+        if self.useProcesses:
+            self._runProcesses(classObjects)
+        else:
+            leaseManager = None
+            if self.useShards:
+                leaseManager = LeaseManager(self.database, self.host, self.maxConcurrentAccounts*self.accountsPerBrowser)
+            scheduler = AccountScheduler(classObjects, self.maxConcurrentAccounts, self.maxConcurrentAccountsPerDomain, leaseManager = leaseManager,
+                                         logCompactor = LogCompactor(self.database, self.logsRetentionDays))
+            scheduler.run()
+            
+    def _runProcesses(self, classObjects):
+        context = self._getProcessContext()
+        # workers only put logs to the queue, they are written by this process
+        logWriter = LogWriter(self.database.fullPath, context.Queue())
+        logWriter.start()
+        for class_ in classObjects:
+            class_.logQueue = logWriter.queue
+        self.database.logQueue = logWriter.queue
+        supervisor = ProcessSupervisor(classObjects, self.database, self.maxWorkerRssMb, context = context,
+                                       logCompactor = LogCompactor(self.database, self.logsRetentionDays))
+        try:
+            supervisor.run()
+        finally:
+            logWriter.close()
+            
+    def _getProcessContext(self):
+        '''
+        Returns forkserver context where available: modules of workers are imported once by fork server
+        and every worker is forked from it, instead of importing them again like spawned process does.
+        Otherwise (Windows, PyInstaller build) returns default context, spawned workers import only what they use
+        '''
+        if 'forkserver' not in multiprocessing.get_all_start_methods() or getattr(sys, 'frozen', False):
+            return multiprocessing.get_context()
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['setups', 'domains', 'imapEngine', 'selenium.webdriver',
+                                        'selenium.webdriver.support.ui', 'selenium.webdriver.support.expected_conditions'])
+        return context
         
        
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()
-    main = Main(noUserSetup)
-    main.run()
+    main = Main(noUserSetup, useProcesses, useShards, sys.argv[3] if useShards and len(sys.argv) > 3 else None)
+    if showReport:
+        main.printReport(float(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif addRule:
+        main.database.addAdRule(*sys.argv[2:7])
+    elif showStatus:
+        main.printStatus()
+    else:
+        main.run()
     
     
@@ -0,0 +1,559 @@
+'''
+Offline benchmark of domain classes. Serves local replicas of login and inbox pages of every domain
+(built from the same element locators as in database) and runs headless cycles against them.\n
+Run for example ```benchmark.py --sizes 10 100 1000 --ad-ratio 0.3 --runs 3```
+'''
+from setups import AdClassifier, DomainProfile, NoSuccessInNTrials, getDriverPool
+from domains import Common
+
+import argparse
+import html
+import http.server
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+
+INPUT_ELEMENTS = ['loginInput', 'passwordInput']
+
+# same structure as real webmail: list is rendered asynchronously, rows contain sender and select control.
+# Folder is shown page by page (`nextPage` element), part by part when list is scrolled (`messageList` element) or at once.
+# Search box (`searchInput` element) filters folder by sender, `selectAll` element selects all shown rows
+INBOX_SCRIPT = '''
+const folders = %(folders)s;
+const paging = %(paging)s;
+const pageSize = %(pageSize)d;
+const list = document.querySelector('[data-bench="messageList"]');
+const nextPage = document.querySelector('[data-bench="nextPage"]');
+let currentFolder = 'main';
+let page = 0;
+let loaded = 0;
+let loading = false;
+let query = '';
+
+function getShownSenders() {
+    return folders[currentFolder].filter(sender => sender.toLowerCase().includes(query.toLowerCase()));
+}
+
+function appendRows(senders) {
+    for (const sender of senders) {
+        list.insertAdjacentHTML('beforeend', %(rowTemplate)s.replace('{sender}', sender));
+    }
+}
+
+function render() {
+    const senders = getShownSenders();
+    list.innerHTML = '';
+    if (paging === 'pages') {
+        appendRows(senders.slice(page*pageSize, (page + 1)*pageSize));
+        nextPage.disabled = (page + 1)*pageSize >= senders.length;
+    } else if (paging === 'scroll') {
+        loaded = Math.min(pageSize, senders.length);
+        appendRows(senders.slice(0, loaded));
+    } else {
+        appendRows(senders);
+    }
+}
+
+function loadFolder(folder) {
+    currentFolder = folder;
+    page = 0;
+    query = '';
+    list.innerHTML = '';
+    setTimeout(render, %(loadDelayMs)d);
+}
+
+list.addEventListener('scroll', function() {
+    const senders = getShownSenders();
+    if (paging !== 'scroll' || loading || loaded >= senders.length || list.scrollTop + list.clientHeight < list.scrollHeight - 5) {
+        return;
+    }
+    loading = true;
+    setTimeout(function() {
+        appendRows(senders.slice(loaded, loaded + pageSize));
+        loaded = Math.min(loaded + pageSize, senders.length);
+        loading = false;
+    }, %(loadDelayMs)d);
+});
+
+document.addEventListener('click', function(event) {
+    const target = event.target;
+    if (target.closest('[data-bench="messageSelect"]')) {
+        const row = target.closest('[data-bench="message"]');
+        row.toggleAttribute('data-selected');
+    } else if (target.closest('[data-bench="selectAll"]')) {
+        for (const row of list.querySelectorAll('[data-bench="message"]')) {
+            row.setAttribute('data-selected', '');
+        }
+    } else if (target.closest('[data-bench="deleteButton"]')) {
+        const deleted = [];
+        for (const row of list.querySelectorAll('[data-bench="message"][data-selected]')) {
+            deleted.push(row.querySelector('[data-bench="messageDiscriminative"]').innerHTML);
+            if (paging !== 'pages') {
+                row.remove();
+            }
+        }
+        folders[currentFolder] = folders[currentFolder].filter(sender => !deleted.includes(sender));
+        loaded -= deleted.length;
+        if (paging === 'pages') {
+            setTimeout(render, %(loadDelayMs)d); // messages of next pages move in place of deleted ones
+        } else {
+            list.dispatchEvent(new Event('scroll')); // shorter list may not fill its box, so it can not be scrolled anymore
+        }
+    } else if (target.closest('[data-bench="nextPage"]') && !nextPage.disabled) {
+        page += 1;
+        list.innerHTML = '';
+        setTimeout(render, %(loadDelayMs)d);
+    } else if (target.closest('[data-bench="offertsTab"]')) {
+        loadFolder('offers');
+    } else if (target.closest('[data-bench="mainTab"]')) {
+        loadFolder('main');
+    }
+});
+
+document.addEventListener('keydown', function(event) {
+    if (event.key === 'Enter' && event.target.closest('[data-bench="searchInput"]')) {
+        query = event.target.value;
+        page = 0;
+        list.innerHTML = '';
+        setTimeout(render, %(loadDelayMs)d);
+    }
+});
+
+window.addEventListener('load', function() { loadFolder('main'); });
+'''
+
+# heavy resources that real pages load as well, served with these sizes [kB]
+STATIC_RESOURCES = {'banner.png' : 300, 'photo.jpg' : 300, 'icons.woff2' : 100, 'promo.mp4' : 2000}
+
+PAGE_RESOURCES = '''
+<style>@font-face {font-family: icons; src: url("static/icons.woff2");} body {font-family: icons, sans-serif;}</style>
+<img src="static/banner.png"><img src="static/photo.jpg">
+<video src="static/promo.mp4" autoplay muted loop></video>
+'''
+
+LOGIN_SCRIPT = '''
+document.addEventListener('click', function(event) {
+    if (event.target.closest('[data-bench="acceptCookies"]')) {
+        event.target.closest('[data-bench="acceptCookies"]').remove();
+    } else if (event.target.closest('[data-bench="loginButton"]')) {
+        document.cookie = 'benchmarkSession=1; path=/';
+        setTimeout(function() { window.location.href = 'inbox'; }, %(loginDelayMs)d);
+    }
+});
+'''
+
+
+class FixturePages:
+    '''
+    Builds HTML of login and inbox page of domain, so that every element locator of domain profile finds its element.\n
+    Supports locators by id, class name and simple xpaths like `//tag[@attribute="value"]` or `//tag[text()="value"]`
+    '''
+    def __init__(self, profile, adSuffix, inboxSize, adRatio, pageSize = 50, loadDelayMs = 100, seed = 0):
+        self.profile = profile
+        self.adSuffix = adSuffix
+        self.inboxSize = inboxSize
+        self.adRatio = adRatio
+        self.pageSize = pageSize
+        self.loadDelayMs = loadDelayMs
+        self.seed = seed
+
+    def getLoginPage(self):
+        body = ''.join([
+            self._element('acceptCookies', 'div'),
+            '<form onsubmit="return false;">',
+            self._element('loginInput', 'input'),
+            self._element('passwordInput', 'input'),
+            self._element('loginButton', 'button'),
+            '</form>'
+        ])
+        return self._page(body, LOGIN_SCRIPT % {'loginDelayMs' : self.loadDelayMs})
+
+    def getInboxPage(self):
+        listTag = 'ul' if self._getTag('message', 'div') == 'li' else 'div'
+        paging = self.getPaging()
+        listStyle = 'height: 400px; overflow-y: auto;' if paging == 'scroll' else ''
+        if 'messageList' in self.profile.elements:
+            messageList = self._element('messageList', listTag, '', {'style' : listStyle})
+        else:
+            messageList = f'<{listTag} data-bench="messageList"></{listTag}>'
+        body = ''.join([
+            self._element('mainTab', 'a'),
+            self._element('offertsTab', 'a'),
+            self._element('deleteButton', 'div'),
+            self._element('searchInput', 'input') if 'searchInput' in self.profile.elements else '',
+            self._element('selectAll', 'div') if 'selectAll' in self.profile.elements else '',
+            messageList,
+            self._element('nextPage', 'button') if paging == 'pages' else ''
+        ])
+        rowContent = self._element('messageDiscriminative', 'span', '{sender}') + self._element('messageSelect', 'span')
+        if 'messageSubject' in self.profile.elements:
+            rowContent += self._element('messageSubject', 'span', 'Subject')
+        script = INBOX_SCRIPT % {
+            'folders' : json.dumps({'main' : self.getSenders('main'), 'offers' : self.getSenders('offers')}),
+            'paging' : json.dumps(paging),
+            'pageSize' : self.pageSize,
+            'rowTemplate' : json.dumps(self._element('message', 'div', rowContent)),
+            'loadDelayMs' : self.loadDelayMs
+        }
+        return self._page(body, script)
+        
+    def getPaging(self):
+        '''
+        Returns how folder is shown, the same way as on the real page: `pages`, `scroll` or `None` (at once)
+        '''
+        if 'nextPage' in self.profile.elements:
+            return 'pages'
+        if 'messageList' in self.profile.elements:
+            return 'scroll'
+        return None
+
+    def getSenders(self, folder):
+        '''
+        Returns senders of messages in folder, `adRatio` of them are ads (end with ad rule of domain)
+        '''
+        randomGenerator = random.Random(f'{self.seed}{folder}')
+        nAds = round(self.inboxSize*self.adRatio)
+        senders = [f'Sender {index}{self.adSuffix if index < nAds else ""}' for index in range(self.inboxSize)]
+        randomGenerator.shuffle(senders)
+        return [html.escape(sender) for sender in senders]
+
+    def getNAds(self):
+        return round(self.inboxSize*self.adRatio)
+
+    def _page(self, body, script):
+        return f'<!DOCTYPE html><html><head><meta charset="utf-8"></head><body>{PAGE_RESOURCES}{body}<script>{script}</script></body></html>'
+
+    def _getTag(self, elementName, defaultTag):
+        by, value = self.profile.elements[elementName]
+        if by == 'xpath':
+            return self._parseXpath(value)[0]
+        return defaultTag
+
+    def _element(self, elementName, defaultTag, content = None, attributes = None):
+        by, value = self.profile.elements[elementName]
+        tag = defaultTag
+        attributes = {'data-bench' : elementName, **(attributes or {})}
+        if by == 'id':
+            attributes['id'] = value
+        elif by == 'class name':
+            attributes['class'] = value.replace('.', ' ')
+        elif by == 'xpath':
+            tag, attributeName, attributeValue, text = self._parseXpath(value)
+            if attributeName is not None:
+                attributes[attributeName] = attributeValue
+            else:
+                content = html.escape(text)
+        else:
+            raise ValueError(f'Unsupported locator strategy for fixture page: {by}')
+        if content is None:
+            content = elementName # empty elements have no size, so they could not be clicked
+        attributesHtml = ' '.join(f'{name}="{html.escape(attributeValue)}"' for name, attributeValue in attributes.items())
+        if tag == 'input':
+            return f'<input {attributesHtml}>'
+        return f'<{tag} {attributesHtml}>{content}</{tag}>'
+
+    def _parseXpath(self, xpath):
+        '''
+        Returns (tag, attribute name, attribute value, text) of xpath like `//tag[@name="value"]` or `//tag[text()="value"]`
+        '''
+        match = re.fullmatch(r'\.?//([\w-]+)\[(?:@([\w:-]+)="([^"]*)"|text\(\)="([^"]*)")\]', xpath)
+        if match is None:
+            raise ValueError(f'Unsupported xpath for fixture page: {xpath}')
+        return match.groups()
+
+
+class FixtureServer:
+    '''
+    Local HTTP server of fixture pages, `/<domain>/login` and `/<domain>/inbox` (needs cookie set by login page)
+    '''
+    def __init__(self):
+        self.pages = {} # keys -> domain, values -> FixturePages
+        fixtureServer = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                fixtureServer._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def getAddress(self, domain, page):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/{domain}/{page}'
+
+    def _handle(self, request):
+        parts = urllib.parse.urlsplit(request.path).path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] in self.pages and parts[1] == 'static' and parts[2] in STATIC_RESOURCES:
+            self._send(request, 'application/octet-stream', bytes(STATIC_RESOURCES[parts[2]]*1024))
+            return
+        if len(parts) != 2 or parts[0] not in self.pages or parts[1] not in ['login', 'inbox']:
+            request.send_error(404)
+            return
+        domain, page = parts
+        if page == 'inbox' and 'benchmarkSession=1' not in request.headers.get('Cookie', ''):
+            request.send_response(302)
+            request.send_header('Location', 'login')
+            request.end_headers()
+            return
+        pages = self.pages[domain]
+        self._send(request, 'text/html; charset=utf-8', (pages.getInboxPage() if page == 'inbox' else pages.getLoginPage()).encode())
+        
+    def _send(self, request, contentType, content):
+        request.send_response(200)
+        request.send_header('Content-Type', contentType)
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        try:
+            request.wfile.write(content)
+        except ConnectionError:
+            pass # browser stopped loading (video)
+
+
+class BenchmarkDatabase:
+    '''
+    Stand-in for `Database` keeping everything in memory, so that benchmark does not touch user database
+    '''
+    def __init__(self, profile, adClassifier):
+        self.profile = profile
+        self.adClassifier = adClassifier
+        self.sessions = {}
+        self.highWaterMarks = {}
+        self.logs = [] # (deleted messages, error info)
+        self.timings = [] # (step, attempts, seconds, outcome)
+
+    def getDomainProfile(self, domain):
+        return self.profile
+    
+    def getAdClassifier(self, domain, userName):
+        return self.adClassifier
+    
+    def getSelectorStats(self, userName, domain):
+        return {}
+    
+    def addSelectorStats(self, userName, domain, stats):
+        pass
+
+    def getSession(self, userName, domain):
+        return self.sessions.get((userName, domain))
+
+    def saveSession(self, userName, domain, address, cookies, localStorage):
+        self.sessions[(userName, domain)] = (address, cookies, localStorage)
+
+    def deleteSession(self, userName, domain):
+        self.sessions.pop((userName, domain), None)
+
+    def getHighWaterMark(self, userName, domain, folder):
+        return self.highWaterMarks.get((userName, domain, folder))
+    
+    def saveHighWaterMark(self, userName, domain, folder, rule, rowKeys):
+        self.highWaterMarks[(userName, domain, folder)] = (rule, rowKeys)
+        
+    def writeLog(self, userLogin, loopIndex, nDeletedMessages = None, info = None, domain = ''):
+        self.logs.append((nDeletedMessages, info))
+
+    def writeTiming(self, userLogin, domain, step, attempts, seconds, outcome):
+        self.timings.append((step, attempts, seconds, outcome))
+
+
+class Benchmark:
+    def __init__(self, databasePath, domains, sizes, adRatio, runs, keepSession = False, lean = True, deleteStrategy = 'rows',
+                 parallelFolders = False):
+        self.databasePath = databasePath
+        self.domains = domains
+        self.sizes = sizes
+        self.adRatio = adRatio
+        self.runs = runs
+        self.keepSession = keepSession
+        self.lean = lean # lean browser profile and blocked urls of domains, see `DriverSetup`
+        self.deleteStrategy = deleteStrategy # see `Common.deleteStrategy`
+        self.parallelFolders = parallelFolders # see `Common.processTabsInParallel`
+        self.domainClassDict = {class_.__name__.lower() : class_ for class_ in Common.__subclasses__() if class_.engine == Common.engine}
+        self.server = FixtureServer()
+
+    def run(self):
+        '''
+        Returns list of results (dicts), one per domain and inbox size
+        '''
+        self.server.start()
+        getDriverPool(lean = self.lean)
+        results = []
+        try:
+            for domain in self.domains:
+                profile = self._getProfile(domain)
+                adClassifier = self._getAdClassifier(domain)
+                for size in self.sizes:
+                    results.append(self._runDomain(domain, profile, adClassifier, size))
+        finally:
+            self.server.stop()
+            getDriverPool().shutdown()
+        return results
+
+    def _runDomain(self, domain, profile, adClassifier, size):
+        # ads are made with the first sender suffix rule of domain
+        adSuffix = next(pattern for field, kind, pattern in adClassifier.rules if (field, kind) == ('sender', 'suffix'))
+        pages = FixturePages(profile, adSuffix, size, self.adRatio)
+        self.server.pages[domain] = pages
+        database = BenchmarkDatabase(profile, adClassifier)
+        worker = self._getWorker(domain, database)
+
+        cycleTimes = []
+        commands = []
+        peakRssMb = 0
+        deleted = []
+        failures = 0
+        for _ in range(self.runs):
+            if not self.keepSession:
+                database.sessions = {}
+            database.highWaterMarks = {} # fixture inbox is the same on every page load, so every cycle has to check all of it
+            rssSampler = RssSampler(worker)
+            rssSampler.start()
+            startTime = time.perf_counter()
+            try:
+                worker.runCycle()
+            except NoSuccessInNTrials:
+                failures += 1 # error is in `database.logs`, cycle time still counts
+            cycleTimes.append(time.perf_counter() - startTime)
+            peakRssMb = max(peakRssMb, rssSampler.stop())
+            commands.append(worker.benchmarkCommands)
+            deleted.append(database.logs[-1][0])
+
+        meanCycleTime = sum(cycleTimes)/len(cycleTimes)
+        return {
+            'domain' : domain,
+            'size' : size,
+            'cycleTime' : meanCycleTime,
+            'timePerMessage' : meanCycleTime/(2*size) if size else 0, # both folders have `size` messages
+            'peakRssMb' : peakRssMb,
+            'commands' : sum(commands)/len(commands),
+            'deleted' : sum(deleted)/len(deleted),
+            'expectedDeleted' : 2*pages.getNAds(),
+            'failures' : failures
+        }
+
+    def _getWorker(self, domain, database):
+        domainClass = self.domainClassDict[domain]
+
+        class BenchmarkWorker(domainClass):
+            def openDatabase(self):
+                return database
+
+            def setup(self):
+                Common.setup(self)
+                self.benchmarkCommands = 0
+                countCommands(self)
+
+        worker = BenchmarkWorker('benchmark', 'benchmark', 60)
+        worker.deleteStrategy = self.deleteStrategy
+        worker.parallelFolders = self.parallelFolders
+        worker.benchmarkCommands = 0
+        return worker
+
+    def _getProfile(self, domain):
+        '''
+        Profile with the same elements, timeouts and blocked urls as in database, but with login page of fixture server
+        '''
+        db = sqlite3.connect(self.databasePath)
+        with db:
+            elements = db.execute('SELECT elementName, by, value FROM domainElements WHERE domain = ?', [domain]).fetchall()
+            timeouts = db.execute('SELECT timeoutName, seconds FROM domainTimeouts WHERE domain = ?', [domain]).fetchall()
+            blockedUrls = db.execute('SELECT pattern FROM domainBlockedUrls WHERE domain = ?', [domain]).fetchall()
+            folders = db.execute('SELECT tabName FROM domainFolders WHERE domain = ? ORDER BY position', [domain]).fetchall()
+            fallbacks = db.execute('SELECT elementName, by, value FROM domainElementCandidates WHERE domain = ? ORDER BY rank', [domain]).fetchall()
+        db.close()
+        elements = {name : (by, value) for name, by, value in elements}
+        candidates = {name : [locator] for name, locator in elements.items()}
+        for name, by, value in fallbacks:
+            candidates[name].append((by, value))
+        blockedUrls = [pattern for pattern, in blockedUrls] if self.lean else []
+        return DomainProfile(domain, 'benchmark', self.server.getAddress(domain, 'login'), elements, candidates, dict(timeouts), blockedUrls,
+                             [tabName for tabName, in folders])
+    
+    def _getAdClassifier(self, domain):
+        db = sqlite3.connect(self.databasePath)
+        with db:
+            rules = db.execute("SELECT field, kind, pattern FROM adRules WHERE domain = ? AND userName = '' ORDER BY rowid", [domain]).fetchall()
+        db.close()
+        return AdClassifier('benchmark', rules)
+
+
+def countCommands(worker):
+    '''
+    Counts webdriver commands (HTTP requests to driver) sent by `worker` in `worker.benchmarkCommands`
+    '''
+    driver = worker.driver
+    if getattr(driver, 'benchmarkWorker', None) is None:
+        execute = driver.execute
+        def countingExecute(*args, **kwargs):
+            driver.benchmarkWorker.benchmarkCommands += 1
+            return execute(*args, **kwargs)
+        driver.execute = countingExecute
+    driver.benchmarkWorker = worker
+
+
+class RssSampler:
+    '''
+    Samples memory used by driver and browser processes of worker until stopped, `stop()` returns peak [MB]
+    '''
+    def __init__(self, worker, interval = 0.1):
+        self.worker = worker
+        self.interval = interval
+        self.peakRssMb = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.peakRssMb
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            driver = self.worker.driver
+            if driver is not None:
+                self.peakRssMb = max(self.peakRssMb, getDriverPool().getRssMb(driver))
+
+
+def printResults(results):
+    print(f'{"domain":<10} {"messages":>8} {"cycle [s]":>10} {"per message [ms]":>17} {"peak RSS [MB]":>14} {"commands":>9} {"deleted":>12} {"failures":>9}')
+    for result in results:
+        print(f'{result["domain"]:<10} {result["size"]:>8} {result["cycleTime"]:>10.2f} {result["timePerMessage"]*1000:>17.2f} '
+              f'{result["peakRssMb"]:>14.0f} {result["commands"]:>9.0f} {result["deleted"]:>6.0f}/{result["expectedDeleted"]:<5} {result["failures"]:>9}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark domain classes against local replicas of webmail pages')
+    parser.add_argument('--database', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.sqlite'),
+                        help = 'preinited database (made by initDatabase.py) to take element locators from')
+    parser.add_argument('--domains', nargs = '+', default = ['wp', 'interia'])
+    parser.add_argument('--sizes', nargs = '+', type = int, default = [10, 100, 1000], help = 'messages in every folder')
+    parser.add_argument('--ad-ratio', type = float, default = 0.3)
+    parser.add_argument('--runs', type = int, default = 3, help = 'cycles per domain and size, averaged')
+    parser.add_argument('--keep-session', action = 'store_true', help = 'restore saved session instead of logging in every cycle')
+    parser.add_argument('--no-lean', action = 'store_true', help = 'full browser profile without blocked urls, to compare with lean one')
+    parser.add_argument('--delete-strategy', choices = ['rows', 'search'], default = 'rows', help = 'see `Common.deleteStrategy`')
+    parser.add_argument('--parallel-folders', action = 'store_true', help = 'open every folder in its own browser tab')
+    arguments = parser.parse_args()
+
+    benchmark = Benchmark(arguments.database, arguments.domains, arguments.sizes, arguments.ad_ratio, arguments.runs, arguments.keep_session,
+                          not arguments.no_lean, arguments.delete_strategy, arguments.parallel_folders)
+    printResults(benchmark.run())
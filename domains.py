@@ -1,51 +1,355 @@
-from setups import DriverSetup, Database, NoSuccessInNTrials
+from setups import Database, NoSuccessInNTrials, DomainUnavailable, getDriverPool, getCircuitBreaker, sleepUntil
 
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, ElementNotInteractableException
+# only exceptions are imported here, webdriver modules are heavy and imported where used (not needed by IMAP workers)
+from selenium.common.exceptions import TimeoutException, ElementNotInteractableException, NoSuchElementException, WebDriverException, StaleElementReferenceException
 import time
 import traceback
 import inspect
+import random
 import functools
 import datetime
+import hashlib
+import json
+import urllib.parse
 
 
+# finds elements inside the page the same way as `find_elements(by, value)` does on webdriver side
+LOCATE_ELEMENTS_SCRIPT = '''
+function locateElements(context, by, value) {
+    if (by === 'xpath') {
+        const result = document.evaluate(value, context, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+        const elements = [];
+        for (let index = 0; index < result.snapshotLength; index++) {
+            elements.push(result.snapshotItem(index));
+        }
+        return elements;
+    }
+    const cssSelectors = {
+        'css selector': value,
+        'class name': '.' + value,
+        'id': '[id="' + value + '"]',
+        'name': '[name="' + value + '"]',
+        'tag name': value
+    };
+    if (!(by in cssSelectors)) {
+        throw new Error('Unsupported locator strategy: ' + by);
+    }
+    return Array.from(context.querySelectorAll(cssSelectors[by]));
+}
+'''
+
+# returns [index, element] of the first locator (of [by, value] list) finding any element or null
+FIND_FIRST_SCRIPT = LOCATE_ELEMENTS_SCRIPT + '''
+const [locators] = arguments;
+for (let index = 0; index < locators.length; index++) {
+    const element = locateElements(document, locators[index][0], locators[index][1])[0];
+    if (element) {
+        return [index, element];
+    }
+}
+return null;
+'''
+
+# returns [discriminative text, select control, subject] for every message row (subject locator is optional)
+READ_MESSAGES_SCRIPT = LOCATE_ELEMENTS_SCRIPT + '''
+const [messageBy, messageValue, discriminativeBy, discriminativeValue, selectBy, selectValue, subjectBy, subjectValue] = arguments;
+return locateElements(document, messageBy, messageValue).map(function(message) {
+    const discriminative = locateElements(message, discriminativeBy, discriminativeValue)[0];
+    const select = locateElements(message, selectBy, selectValue)[0];
+    const subject = subjectBy === null ? null : locateElements(message, subjectBy, subjectValue)[0];
+    return [discriminative ? discriminative.innerText.trim() : null, select || null, subject ? subject.innerText.trim() : ''];
+});
+'''
+
+# counts changes of message list, kept in `window` so that changes made before waiting are counted as well.
+# Only changes inside `messageList` container (found by the first of `listLocators` that finds anything) are counted,
+# or changes of message rows (their number, the first and the last one) when there is no such container,
+# so elements ticking elsewhere on the page (clocks, ads) do not keep it from settling.
+# Without any locator every structural change of the page is counted
+MUTATION_RECORDER_SCRIPT = '''
+function locateFirst(locators) {
+    for (const [by, value] of locators) {
+        const elements = locateElements(document, by, value);
+        if (elements.length) {
+            return elements;
+        }
+    }
+    return [];
+}
+function getRowsState(messageLocators) {
+    const rows = locateFirst(messageLocators);
+    return [rows.length, rows[0], rows[rows.length - 1]];
+}
+function startMutationRecorder(listLocators, messageLocators) {
+    if (window.adsOnMailMutations) {
+        return;
+    }
+    const recorder = window.adsOnMailMutations = {count: 0, last: Date.now(), list: locateFirst(listLocators)[0] || null,
+                                                  rows: getRowsState(messageLocators)};
+    new MutationObserver(function(mutations) {
+        let changed = !listLocators.length && !messageLocators.length;
+        if (!changed && !(recorder.list && recorder.list.isConnected)) {
+            const list = locateFirst(listLocators)[0] || null;
+            changed = list !== recorder.list; // container was replaced, e.g. with list of other folder
+            recorder.list = list;
+        }
+        if (!changed && recorder.list) {
+            changed = mutations.some(mutation => recorder.list.contains(mutation.target));
+        } else if (!changed) {
+            const rows = getRowsState(messageLocators);
+            changed = rows.some((value, index) => value !== recorder.rows[index]);
+            recorder.rows = rows;
+        }
+        if (changed) {
+            recorder.count += mutations.length;
+            recorder.last = Date.now();
+        }
+    }).observe(document, {childList: true, subtree: true});
+}
+'''
+
+START_MUTATION_RECORDER_SCRIPT = LOCATE_ELEMENTS_SCRIPT + MUTATION_RECORDER_SCRIPT + '''
+startMutationRecorder(arguments[0], arguments[1]);
+return window.adsOnMailMutations.count;
+'''
+
+# calls back with true when page had no structural changes for `quietMs` (and changed at all after `sinceCount`
+# changes, if given) or with false after `timeoutMs`. Document without recorder (new page) counts as changed.
+# Without `sinceCount` quiet time is counted only once any of `contentLocators` (message row, empty folder notice)
+# finds an element, so list which has not started rendering yet is not taken for settled one
+WAIT_FOR_QUIET_PAGE_SCRIPT = LOCATE_ELEMENTS_SCRIPT + MUTATION_RECORDER_SCRIPT + '''
+const [quietMs, timeoutMs, sinceCount, listLocators, messageLocators, contentLocators, done] = arguments;
+const newDocument = !window.adsOnMailMutations;
+startMutationRecorder(listLocators, messageLocators);
+const started = Date.now();
+let contentShown = sinceCount !== null || !contentLocators.length ? started : null;
+const timer = setInterval(function() {
+    const recorder = window.adsOnMailMutations;
+    if (contentShown === null && locateFirst(contentLocators).length) {
+        contentShown = Date.now();
+    }
+    const changed = newDocument || sinceCount === null || recorder.count > sinceCount;
+    const settled = changed && contentShown !== null && Date.now() - Math.max(recorder.last, contentShown) >= quietMs;
+    if (settled || Date.now() - started >= timeoutMs) {
+        clearInterval(timer);
+        done(settled);
+    }
+}, 50);
+'''
+
+# returns [rows, loading, changes]: [discriminative text, select control, subject, row key text] of message rows not returned before
+# (they are marked), whether scrolling `messageList` started loading next part of it
+# and number of page changes before scrolling (to be passed to `waitForMessageList`).
+# Row key text is made of sender, subject and date (its `datetime` or `title` attribute, which are absolute, if there is any) only,
+# so it does not change with preview or relative date ("5 min ago") shown in row
+READ_NEW_MESSAGES_SCRIPT = LOCATE_ELEMENTS_SCRIPT + MUTATION_RECORDER_SCRIPT + '''
+const [messageBy, messageValue, discriminativeBy, discriminativeValue, selectBy, selectValue, subjectBy, subjectValue,
+       dateBy, dateValue, listBy, listValue] = arguments;
+startMutationRecorder(listBy === null ? [] : [[listBy, listValue]], [[messageBy, messageValue]]);
+const rows = [];
+for (const message of locateElements(document, messageBy, messageValue)) {
+    if (message.hasAttribute('data-ads-on-mail-read')) {
+        continue;
+    }
+    message.setAttribute('data-ads-on-mail-read', '');
+    const discriminative = locateElements(message, discriminativeBy, discriminativeValue)[0];
+    const select = locateElements(message, selectBy, selectValue)[0];
+    const subject = subjectBy === null ? null : locateElements(message, subjectBy, subjectValue)[0];
+    const date = dateBy === null ? null : locateElements(message, dateBy, dateValue)[0];
+    const discriminativeText = discriminative ? discriminative.innerText.trim() : null;
+    const subjectText = subject ? subject.innerText.trim() : '';
+    const dateText = date ? (date.getAttribute('datetime') || date.getAttribute('title') || date.innerText.trim()) : '';
+    rows.push([discriminativeText, select || null, subjectText, [discriminativeText, subjectText, dateText].join('\\n')]);
+}
+const changes = window.adsOnMailMutations.count;
+const list = listBy === null ? null : locateElements(document, listBy, listValue)[0];
+let loading = false;
+if (list) {
+    const scrollTop = list.scrollTop;
+    list.scrollTop = list.scrollHeight;
+    loading = list.scrollTop !== scrollTop;
+}
+return [rows, loading, changes];
+'''
+
+
+class RetryPolicy:
+    '''
+    Retry settings of one step, read from its signature once when it is decorated with `Common._errorHandler`.\n
+    Value passed in call wins over default value in signature, which wins over `default...` attribute of the instance.\n
+    Trials are separated by exponentially growing intervals (`tryAgainInterval` times `defaultBackoffFactor`
+    to the power of trial index, up to `defaultMaxTimeIntervalBetweenTrials`) with random jitter,
+    so that accounts failing at the same moment do not try again at the same moment
+    '''
+    def __init__(self, function):
+        parameters = inspect.signature(function).parameters
+        self.nTries = self._getDefault(parameters, 'nTries')
+        self.tryAgainInterval = self._getDefault(parameters, 'tryAgainInterval')
+        self.refreshOnError = self._getDefault(parameters, 'refreshOnError')
+        
+    def resolve(self, classSelf, functionKwargs):
+        '''
+        Returns (nTries, tryAgainInterval, refreshOnError) of single call
+        '''
+        return (self._resolve(functionKwargs, 'nTries', self.nTries, classSelf.defaultNTrialsBeforeError),
+                self._resolve(functionKwargs, 'tryAgainInterval', self.tryAgainInterval, classSelf.defaultTimeIntervalBetweenTrials),
+                self._resolve(functionKwargs, 'refreshOnError', self.refreshOnError, classSelf.defaultRefreshOnError))
+        
+    def getDelay(self, classSelf, tryAgainInterval, index):
+        '''
+        Returns number of seconds to wait after trial `index` failed
+        '''
+        maxInterval = max(tryAgainInterval, classSelf.defaultMaxTimeIntervalBetweenTrials)
+        delay = min(tryAgainInterval*classSelf.defaultBackoffFactor**index, maxInterval)
+        return delay*random.uniform(1 - classSelf.defaultJitter, 1)
+        
+    def _getDefault(self, parameters, paramName):
+        parameter = parameters.get(paramName)
+        if parameter is None or parameter.default is inspect.Parameter.empty:
+            return None
+        return parameter.default
+        
+    def _resolve(self, functionKwargs, paramName, signatureDefault, instanceDefault):
+        param = functionKwargs.get(paramName)
+        if param is None:
+            param = signatureDefault if signatureDefault is not None else instanceDefault
+        return param
+
 
 class Common:
     '''
     Base class for all domain specific classes\n
     Provide basic configuration, functions, error handling, database access, logs handling and data gathering
     '''
+    engine = 'browser' # value of `engine` column in `users` table
+    
     def __init__(self, userLogin, userPassword, timeInterval, domain):
         self.database = None
         self.driver = None
-        self.info = None
+        self.profile = None
+        self.info = None # keys -> element name, values -> locator tuple (by, value), the best candidate of element
+        self.candidates = None # keys -> element name, values -> locator tuples ordered by `rankCandidates`
+        self.selectorStats = None # keys -> (element name, by, value), values -> [hits, misses, seconds], see `findElement`
+        self._newSelectorStats = {} # part of `selectorStats` not saved yet
+        self.timeouts = None
+        self.logQueue = None # set when logs are written by other process
         self.domain = domain
         self.userLogin = userLogin
         self.userPassword = userPassword
         self.timeInterval = timeInterval
+        self.minTimeInterval = None # [s] set with `maxTimeInterval` for adaptive time interval, see `getTimeInterval`
+        self.maxTimeInterval = None
+        self.adRateModel = None
+        self.startupTime = None # [s since epoch] program start, time to the first cycle is stored as `firstCycle` timing
         self.loopIndex = 0
         self.nSelectedMessages = 0
-        self._config = DriverSetup()
+        self.adClassifier = None # rules of domain and user, see `AdClassifier`
+        self.batchedSelection = True # read and select all messages in two webdriver calls instead of 3-4 calls per message
+        self.streamedMessages = True # go through whole folder part by part (needs `batchedSelection`), see `streamMessages`
+        self.incremental = True # stop streaming folder at messages checked in previous loops, see `processMessages`
+        self.nHighWaterMarkKeys = 5 # newest messages remembered per folder, one of them has to be still there to stop early
+        self.deleteStrategy = 'rows' # 'rows' (read folder, select ads one by one) or 'search' (see `processSearchResults`)
+        self.tabNames = None # tab elements of folders, from `domainFolders` table
+        self.currentTab = None
+        self.parallelFolders = False # open every folder in its own browser tab, see `processTabsInParallel`
+        self.sleepTick = 5 # [s] the longest single sleep, so run is late at most that much after system sleep
         self.defaultNTrialsBeforeError = 5
         self.defaultTimeIntervalBetweenTrials = 0.2
         self.defaultRefreshOnError = False
+        self.defaultBackoffFactor = 2
+        self.defaultMaxTimeIntervalBetweenTrials = 5
+        self.defaultJitter = 0.5 # part of interval that can be cut off at random
         
     def setup(self):
-        self.database = Database()
-        self.info = self.getElements(self.domain)
+        startTime = time.perf_counter()
+        self.database = self.openDatabase()
+        self.profile = self.database.getDomainProfile(self.domain)
+        if self.selectorStats is None:
+            self.selectorStats = self.database.getSelectorStats(self.userLogin, self.domain)
+        self.rankCandidates()
+        self.timeouts = self.profile.timeouts
+        self.adClassifier = self.database.getAdClassifier(self.domain, self.userLogin)
+        self.tabNames = self.profile.folders
+        self.currentTab = self.tabNames[-1] # loop ends in the folder it starts in
         self.closeDriver()
-        self.driver = self._config.getDriver()
+        self.driver = getDriverPool().borrow()
+        self.driver.set_script_timeout(self.timeouts['messagesSettle'] + self.timeouts['page'])
+        self.blockUrls()
+        self.writeTiming('setup', 1, time.perf_counter()-startTime, 'ok') # mostly browser start, when pool has no idle driver
+        
+    def blockUrls(self):
+        '''
+        Makes browser block requests matching `blockedUrls` of domain (ads, trackers, fonts, videos).
+        Always set, because driver could block urls of other domain before
+        '''
+        if self._supportsCdp():
+            self.driver.execute_cdp_cmd('Network.enable', {})
+            self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls' : self.profile.blockedUrls})
+        
+    def openDatabase(self):
+        return Database(logQueue = self.logQueue)
         
     def closeDriver(self):
+        '''
+        Gives driver back to the pool of this process
+        '''
         if self.driver is not None:
-            self.driver.close()
+            getDriverPool().giveBack(self.driver)
             self.driver = None
     
-    def getElements(self, domain):
-        return self.database.getElements(domain)
+    def rankCandidates(self):
+        '''
+        Orders locators of every element by hit rate and then mean time to find of this account, so locator that works
+        is tried first and used by scripts (`info`). Locators not tried yet keep their rank
+        '''
+        def getScore(name, locator):
+            hits, misses, seconds = self.selectorStats.get((name, *locator), (0, 0, 0))
+            return (-(hits + 1)/(hits + misses + 2), seconds/hits if hits else float('inf'))
+        self.candidates = {name : sorted(locators, key = lambda locator: getScore(name, locator))
+                           for name, locators in self.profile.candidates.items()}
+        self.info = {name : locators[0] for name, locators in self.candidates.items()}
+        
+    def findElement(self, elementName, timeout = None, optional = False):
+        '''
+        Returns element found by any locator of `elementName` (in order of `rankCandidates`) or None.
+        All locators are checked in one script call, so fallbacks cost no extra timeouts.\n
+        Optional element (like cookies banner that may be dismissed already) is looked for once, after page is loaded,
+        required one is waited for up to `timeout` (`element` timeout by default).
+        Lookup is counted in `selectorStats`
+        '''
+        if timeout is None:
+            timeout = self.timeouts['element']
+        locators = self.candidates[elementName]
+        from selenium.webdriver.support.ui import WebDriverWait
+        findFirst = lambda driver: driver.execute_script(FIND_FIRST_SCRIPT, locators)
+        startTime = time.perf_counter()
+        if optional:
+            self.waitForPage()
+            found = findFirst(self.driver)
+        else:
+            try:
+                found = WebDriverWait(self.driver, timeout).until(findFirst)
+            except TimeoutException:
+                found = None
+        index, element = found if found is not None else (len(locators), None)
+        for missedLocator in locators[:index]:
+            self._countLookup(elementName, missedLocator, 0, 1, 0)
+        if element is not None:
+            self._countLookup(elementName, locators[index], 1, 0, time.perf_counter() - startTime)
+        return element
     
-    def waitForElement(self, by, value, timeout = 10):
+    def _countLookup(self, elementName, locator, hits, misses, seconds):
+        for stats in (self.selectorStats, self._newSelectorStats):
+            counts = stats.setdefault((elementName, *locator), [0, 0, 0])
+            counts[0] += hits
+            counts[1] += misses
+            counts[2] += seconds
+        
+    def waitForElement(self, by, value, timeout = None):
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        if timeout is None:
+            timeout = self.timeouts['element']
         try:
             element = WebDriverWait(self.driver, timeout).until(
             EC.presence_of_element_located((by, value))
@@ -54,11 +358,65 @@ class Common:
             return None
         return element
 
-    def waitForPage(self, timeout = 10):
+    def waitForPage(self, timeout = None):
+        from selenium.webdriver.support.ui import WebDriverWait
+        if timeout is None:
+            timeout = self.timeouts['page']
         WebDriverWait(self.driver, timeout).until(
             lambda x: x.execute_script("return document.readyState === 'complete'")
         )
         
+    def startWatchingPage(self):
+        '''
+        Starts counting structural changes of the page.\n
+        Returns number of changes so far, to be passed to `waitForMessageList` after action that changes the page
+        '''
+        return self.driver.execute_script(START_MUTATION_RECORDER_SCRIPT, *self._getWatchedLocators())
+    
+    def _getWatchedLocators(self):
+        '''
+        Returns locators of `messageList` container and of message rows, changes of which are watched by `waitForMessageList`
+        '''
+        return self.candidates.get('messageList', []), self.candidates.get('message', [])
+    
+    def waitForMessageList(self, sinceChanges = None, timeout = None):
+        '''
+        Waits until message list (see `MUTATION_RECORDER_SCRIPT`) has not changed for `messagesQuiet` seconds,
+        but no longer than `timeout` (`messagesSettle` by default) seconds. Returns True if page settled.\n
+        If `sinceChanges` is given, at least one change has to happen after `startWatchingPage` returned it.
+        Otherwise at least one message row or `emptyFolder` element (if domain has it) has to be shown first
+        '''
+        if timeout is None:
+            timeout = self.timeouts['messagesSettle']
+        self.waitForPage()
+        quietTime = self.timeouts['messagesQuiet']
+        deadline = time.monotonic() + timeout
+        while True:
+            remainingTime = deadline - time.monotonic()
+            if remainingTime <= 0:
+                return False
+            try:
+                contentLocators = [] if sinceChanges is not None else self.candidates.get('message', []) + self.candidates.get('emptyFolder', [])
+                return self.driver.execute_async_script(WAIT_FOR_QUIET_PAGE_SCRIPT, quietTime*1000, remainingTime*1000, sinceChanges,
+                                                        *self._getWatchedLocators(), contentLocators)
+            except WebDriverException:
+                # page was replaced while waiting, new one is watched from the start
+                sinceChanges = None
+                self.waitForPage()
+        
+    def waitForLoginPageLeft(self):
+        '''
+        Waits until login input, found by any of its locators, is gone or hidden
+        '''
+        from selenium.webdriver.support.ui import WebDriverWait
+        def isLoginPageLeft(driver):
+            found = driver.execute_script(FIND_FIRST_SCRIPT, self.candidates['loginInput'])
+            try:
+                return found is None or not found[1].is_displayed()
+            except StaleElementReferenceException:
+                return True
+        WebDriverWait(self.driver, self.timeouts['login']).until(isLoginPageLeft)
+        
     def refreshPage(self, additionalSleepTime = 0):
         self.driver.refresh()
         self.waitForPage()
@@ -85,61 +443,56 @@ class Common:
         '''
         self.driver.execute_script("arguments[0].click();", element)
         
-    
-    def _getParameter(self, function, functionKwargs, paramName, defaultVal):
+    def clickOnElements(self, elements):
         '''
-        Returns `paramName` value passed to `function` if `paramName` was passed to `function` or \n
-        returns `paramName` default value if `function` has default value or \n
-        returns `defaultVal`
+        Same as `clickOnElement` for every element in `elements`, but in single webdriver call
         '''
-        param = functionKwargs.get(paramName)
-        if param is None:
-            pom = inspect.signature(function).parameters.get(paramName)
-            param = pom.default if pom is not None else defaultVal
-        return param
-
+        self.driver.execute_script("arguments[0].forEach(element => element.click());", elements)
+        
+    
     def _errorHandler(function):
+        policy = RetryPolicy(function) # signature is read once, not on every call
+        
         @functools.wraps(function)
         def modFun(*args, **kwargs):
             classSelf = args[0] # first arg passed to `function` is `self`
-            nTries = classSelf._getParameter(function, kwargs, 'nTries', classSelf.defaultNTrialsBeforeError)
-            tryAgainInterval = classSelf._getParameter(function, kwargs, 'tryAgainInterval', classSelf.defaultTimeIntervalBetweenTrials)
-            refreshOnError = classSelf._getParameter(function, kwargs, 'refreshOnError', classSelf.defaultRefreshOnError)
+            nTries, tryAgainInterval, refreshOnError = policy.resolve(classSelf, kwargs)
             
+            startTime = time.perf_counter()
             for index in range(nTries):
+                # domain is failing for other accounts as well, do not load it with more trials
+                classSelf.checkCircuitBreaker(function.__name__)
                 try:
-                    return function(*args, **kwargs)
-                except:
+                    result = function(*args, **kwargs)
+                except Exception: # not `SystemExit` of worker asked to stop (see `supervisor.stopWorker`)
                     if index < nTries-1:
-                        time.sleep(tryAgainInterval)
+                        time.sleep(policy.getDelay(classSelf, tryAgainInterval, index))
                         if refreshOnError:
                             classSelf.refreshPage()
                     else:
+                        classSelf.writeTiming(function.__name__, index+1, time.perf_counter()-startTime, 'error')
                         classSelf.writeLog(errorInfo = traceback.format_exc())
                         raise NoSuccessInNTrials
+                else:
+                    classSelf.writeTiming(function.__name__, index+1, time.perf_counter()-startTime, 'ok')
+                    return result
         return modFun
                 
     @_errorHandler
     def runPage(self, tryAgainInterval = 30, **kwargs):
-        pageAddress = self.database.getPageAddress(self.domain)
-        self.driver.get(pageAddress)
+        self.driver.get(self.profile.pageAddress)
         
     @_errorHandler
     def acceptCookies(self, **kwargs):
-        buttonInfo = self.info['acceptCookies']
-        acceptCookiesButton = self.waitForElement(buttonInfo['by'], buttonInfo['value'])
+        acceptCookiesButton = self.findElement('acceptCookies', optional = True)
         if acceptCookiesButton is not None:
             self.clickOnElement(acceptCookiesButton)
     
     @_errorHandler
     def login(self, refreshOnError = True, **kwargs):
-        loginInfo = self.info['loginInput']
-        passwordInfo = self.info['passwordInput']
-        buttonInfo = self.info['loginButton']
-        
-        loginInput = self.waitForElement(loginInfo['by'], loginInfo['value'])
-        passwordInput = self.waitForElement(passwordInfo['by'], passwordInfo['value'])
-        loginButton = self.waitForElement(buttonInfo['by'], buttonInfo['value'])
+        loginInput = self.findElement('loginInput')
+        passwordInput = self.findElement('passwordInput')
+        loginButton = self.findElement('loginButton')
         
         # it has to be in `fillInput` function
         # otherwise it could fill `loginInput` multiple times in case of error in `passwordInput`
@@ -147,58 +500,524 @@ class Common:
         self.fillInput(passwordInput, self.userPassword)
         self.clickOnElement(loginButton)
                 
+    def logIn(self):
+        '''
+        Restores saved session of the account or logs in from scratch when there is no valid one.\n
+        Returns True if logged in from scratch (`afterLoginRoutine` is needed then)
+        '''
+        if self.restoreSession():
+            return False
+        self.runPage()
+        self.acceptCookies()
+        self.login()
+        return True
+        
+    def restoreSession(self):
+        '''
+        Loads cookies and local storage saved by `saveSession` into browser and opens page they were saved on.\n
+        Returns True if account is logged in then. Otherwise clears cookies and forgets saved session
+        '''
+        session = self.database.getSession(self.userLogin, self.domain)
+        if session is None:
+            return False
+        address, cookies, localStorage = session
+        try:
+            self._setCookies(address, cookies)
+            self._openWithLocalStorage(address, localStorage)
+            loggedIn = self._isLoggedIn()
+        except WebDriverException:
+            loggedIn = False
+        if not loggedIn:
+            self.database.deleteSession(self.userLogin, self.domain)
+            self._clearCookies()
+        return loggedIn
+    
+    def saveSession(self):
+        '''
+        Saves cookies and local storage of logged in account, so that next loop does not need to log in
+        '''
+        if self._supportsCdp():
+            cookies = self.driver.execute_cdp_cmd('Network.getAllCookies', {})['cookies']
+        else:
+            cookies = self.driver.get_cookies() # only cookies of current page domain
+        localStorage = self.driver.execute_script('return Object.assign({}, window.localStorage);')
+        self.database.saveSession(self.userLogin, self.domain, self.driver.current_url, cookies, localStorage)
+        
+    def _supportsCdp(self):
+        return hasattr(self.driver, 'execute_cdp_cmd')
+    
+    def _setCookies(self, address, cookies):
+        if self._supportsCdp():
+            cookieKeys = ['name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'sameSite']
+            cookieParams = []
+            for cookie in cookies:
+                cookieParam = {key : cookie[key] for key in cookieKeys if key in cookie}
+                if not cookie.get('session', False) and 'expires' in cookie:
+                    cookieParam['expires'] = cookie['expires']
+                cookieParams.append(cookieParam)
+            self.driver.execute_cdp_cmd('Network.setCookies', {'cookies': cookieParams})
+        else:
+            # webdriver accepts cookies only for domain of current page
+            self.driver.get(address)
+            for cookie in cookies:
+                self.driver.add_cookie(cookie)
+                
+    def _openWithLocalStorage(self, address, localStorage):
+        origin = '{0.scheme}://{0.netloc}'.format(urllib.parse.urlsplit(address))
+        fillLocalStorage = f'''
+            if (window.location.origin === {json.dumps(origin)}) {{
+                const items = {json.dumps(localStorage)};
+                for (const key in items) {{
+                    window.localStorage.setItem(key, items[key]);
+                }}
+            }}
+        '''
+        if self._supportsCdp():
+            # local storage is filled before page scripts run, so page does not need to be loaded twice
+            script = self.driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': fillLocalStorage})
+            try:
+                self.driver.get(address)
+            finally:
+                self.driver.execute_cdp_cmd('Page.removeScriptToEvaluateOnNewDocument', {'identifier': script['identifier']})
+        else:
+            self.driver.get(address)
+            self.driver.execute_script(fillLocalStorage)
+            self.refreshPage()
+        self.waitForPage()
+        
+    def _isLoggedIn(self):
+        '''
+        Waits until either login input (session expired) or main tab (logged in), found by any of its locators, shows up
+        '''
+        from selenium.webdriver.support.ui import WebDriverWait
+        def getPageKind(driver):
+            if driver.execute_script(FIND_FIRST_SCRIPT, self.candidates['loginInput']) is not None:
+                return 'login'
+            if driver.execute_script(FIND_FIRST_SCRIPT, self.candidates['mainTab']) is not None:
+                return 'inbox'
+            return None
+        try:
+            pageKind = WebDriverWait(self.driver, self.timeouts['element']).until(getPageKind)
+        except TimeoutException:
+            return False
+        return pageKind == 'inbox'
+    
+    def _clearCookies(self):
+        if self._supportsCdp():
+            self.driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        else:
+            self.driver.delete_all_cookies()
+        
     @_errorHandler
     def afterLoginRoutine(self, **kwargs):
-        time.sleep(5)
-        self.refreshPage(additionalSleepTime = 5)
+        self.waitForLoginPageLeft()
+        self.refreshPage()
+        self.waitForMessageList()
         
     @_errorHandler
     def getMessages(self, **kwargs):
-        messageInfo = self.info['message']
-        anyMessage = self.waitForElement(messageInfo['by'], messageInfo['value'])
-        if anyMessage is not None:
-            time.sleep(3)
-            messages = self.driver.find_elements(messageInfo['by'], messageInfo['value'])
-            return messages
-        return []
+        self.waitForMessageList()
+        return self.driver.find_elements(*self.info['message'])
         
     @_errorHandler
-    def selectAdMessagesByEndString(self, messages, endsWithString, refreshOnError = True, **kwargs):
+    def selectAdMessages(self, messages, refreshOnError = True, **kwargs):
+        '''
+        Selects messages that match any rule of `adClassifier`.\n
+        When `batchedSelection` is set, all messages matched by `message` element info are read
+        in one script call (`messages` are not used then) and ads are selected in second one
+        '''
+        if self.batchedSelection:
+            self.nSelectedMessages += self._selectAdMessagesInBatch()
+            return
+        
         nSelectedMessages = 0
-        discriminativeInfo = self.info['messageDiscriminative']
-        selectInfo = self.info['messageSelect']
         for message in messages:
-            messageTopic = message.find_element(discriminativeInfo['by'], discriminativeInfo['value']).text
-            selectButton = message.find_element(selectInfo['by'], selectInfo['value'])
-            if messageTopic.endswith(endsWithString):
+            messageTopic = message.find_element(*self.info['messageDiscriminative']).text
+            selectButton = message.find_element(*self.info['messageSelect'])
+            subjects = message.find_elements(*self.info['messageSubject']) if 'messageSubject' in self.info else []
+            if self.adClassifier.isAd(messageTopic, subjects[0].text if subjects else ''):
                 self.clickOnElement(selectButton)
                 nSelectedMessages += 1
         self.nSelectedMessages += nSelectedMessages
+        
+    def _selectAdMessagesInBatch(self):
+        rows = self.driver.execute_script(READ_MESSAGES_SCRIPT, *self.info['message'], *self.info['messageDiscriminative'],
+                                          *self.info['messageSelect'], *self.info.get('messageSubject', (None, None)))
+        return self._selectRows(rows)
+        
+    def _selectRows(self, rows):
+        '''
+        Clicks select controls of `rows` (discriminative text, select control, subject, ...) classified as ads.\n
+        Returns number of selected rows
+        '''
+        # rows without discriminative text or select control would raise on `find_element` in unbatched mode
+        if any(row[0] is None or row[1] is None for row in rows):
+            raise ValueError('Message without discriminative text or select control')
+        areAds = self.adClassifier.classify([(row[0], row[2]) for row in rows])
+        selectButtons = [row[1] for row, isAd in zip(rows, areAds) if isAd]
+        if selectButtons:
+            self.clickOnElements(selectButtons)
+        return len(selectButtons)
+        
+    def streamMessages(self, seenKeys = ()):
+        '''
+        Yields lists of (discriminative text, select control, subject, row key) of message rows of current folder, part by part,
+        so only one part is kept at once. Every row is yielded once, also rows moved in place of deleted ones.\n
+        Reading part scrolls `messageList` element (if domain has it), so next part is loaded while current one
+        is processed. When nothing is left to read, `nextPage` element (if domain has it) is clicked.\n
+        Stops before the first row which key is in `seenKeys` (rows below it were checked before)
+        '''
+        self.waitForMessageList()
+        listLocator = self.info.get('messageList', (None, None))
+        while True:
+            rows, loading, changes = self.readNewMessages(listLocator)
+            seenIndex = next((index for index, row in enumerate(rows) if row[3] in seenKeys), None)
+            if seenIndex is not None:
+                if seenIndex:
+                    yield rows[:seenIndex]
+                return
+            if rows:
+                yield rows
+            if loading:
+                # `messagesLoad` instead of `messagesSettle`, because the end of list is found by waiting in vain
+                self.waitForMessageList(sinceChanges = changes, timeout = self.timeouts['messagesLoad'])
+            elif not rows and not self.openNextPage():
+                return
+                
+    @_errorHandler
+    def readNewMessages(self, listLocator, **kwargs):
+        rows, loading, changes = self.driver.execute_script(READ_NEW_MESSAGES_SCRIPT, *self.info['message'], *self.info['messageDiscriminative'],
+                                                            *self.info['messageSelect'], *self.info.get('messageSubject', (None, None)),
+                                                            *self.info.get('messageDate', (None, None)), *listLocator)
+        # sender, subject and date identify message, page does not need to give it any id
+        rows = [(messageTopic, selectButton, subject, hashlib.sha1(keyText.encode()).hexdigest()) for messageTopic, selectButton, subject, keyText in rows]
+        return rows, loading, changes
+        
+    @_errorHandler
+    def selectAdRows(self, rows, **kwargs):
+        '''
+        Same as `selectAdMessages` for rows yielded by `streamMessages`
+        '''
+        nSelectedMessages = self._selectRows(rows)
+        self.nSelectedMessages += nSelectedMessages
+        return nSelectedMessages
+        
+    @_errorHandler
+    def openNextPage(self, **kwargs):
+        '''
+        Returns False if domain has no `nextPage` element or current page is the last one
+        '''
+        if 'nextPage' not in self.info:
+            return False
+        nextPageButtons = self.driver.find_elements(*self.info['nextPage'])
+        if not nextPageButtons or not nextPageButtons[0].is_enabled() or nextPageButtons[0].get_attribute('aria-disabled') == 'true':
+            return False
+        changesBeforeClick = self.startWatchingPage()
+        self.clickOnElement(nextPageButtons[0])
+        self.waitForMessageList(sinceChanges = changesBeforeClick)
+        return True
                 
     @_errorHandler
     def deleteSelectedMessages(self, **kwargs):
-        deleteButtonInfo = self.info['deleteButton']
-        deleteButton = self.waitForElement(deleteButtonInfo['by'], deleteButtonInfo['value'])
+        deleteButton = self.findElement('deleteButton')
         if deleteButton is not None:
             self.clickOnElement(deleteButton)
         
     @_errorHandler
-    def switchTab(self, tabName, **kwargs):
-        tabInfo = self.info[tabName]
-        time.sleep(1)
-        tab = self.driver.find_element(tabInfo['by'], tabInfo['value'])
+    def switchTab(self, tabName, timeout = None, **kwargs):
+        tab = self.findElement(tabName, timeout = timeout)
+        if tab is None:
+            raise NoSuchElementException(tabName)
+        changesBeforeClick = self.startWatchingPage()
         self.clickOnElement(tab)
-        self.waitForPage()
-        time.sleep(3)
+        self.currentTab = tabName
+        self.waitForMessageList(sinceChanges = changesBeforeClick)
+        
+    @_errorHandler
+    def searchMessages(self, text, **kwargs):
+        '''
+        Types `text` into search box of webmail and waits for filtered message list (whole folder when `text` is empty)
+        '''
+        searchInput = self.findElement('searchInput')
+        if searchInput is None:
+            raise NoSuchElementException('searchInput')
+        from selenium.webdriver.common.keys import Keys
+        searchInput.clear()
+        changesBeforeSearch = self.startWatchingPage()
+        self.fillInput(searchInput, text + Keys.ENTER)
+        self.waitForMessageList(sinceChanges = changesBeforeSearch)
+        
+    @_errorHandler
+    def selectSearchResults(self, **kwargs):
+        '''
+        Selects ads shown in filtered message list, all of them with `selectAll` element when every shown message is an ad.
+        Returns (number of selected messages, (discriminative text, subject) of shown messages)
+        '''
+        rows = self.driver.execute_script(READ_MESSAGES_SCRIPT, *self.info['message'], *self.info['messageDiscriminative'],
+                                          *self.info['messageSelect'], *self.info.get('messageSubject', (None, None)))
+        shownMessages = [(row[0], row[2]) for row in rows]
+        if rows and all(self.adClassifier.classify(shownMessages)):
+            selectAll = self.findElement('selectAll')
+            if selectAll is None:
+                raise NoSuchElementException('selectAll')
+            self.clickOnElement(selectAll)
+            nSelectedMessages = len(rows)
+        else:
+            nSelectedMessages = self._selectRows(rows)
+        self.nSelectedMessages += nSelectedMessages
+        return nSelectedMessages, shownMessages
+        
+    def canSearch(self):
+        '''
+        Returns True if domain has elements needed by `processSearchResults` and every ad rule can be typed into search box
+        '''
+        return ('searchInput' in self.info and 'selectAll' in self.info and self.batchedSelection
+                and self.adClassifier.getSearchTerms() is not None)
+        
+    def processSearchResults(self):
+        '''
+        Deletes ads in current folder using search of webmail: for every ad rule its text is searched
+        and filtered list is deleted page by page (one select and delete per page) until it shows no ads.
+        Search finds text in any field, so shown messages are classified and, when any of them is not an ad, ads are selected one by one.
+        Page without ads is left with `nextPage` element (if domain has it)
+        '''
+        terms = self.adClassifier.getSearchTerms()
+        if not terms:
+            return
+        for _, text in terms:
+            self.searchMessages(text)
+            previousMessages = None
+            while True:
+                nSelectedMessages, shownMessages = self.selectSearchResults()
+                if shownMessages == previousMessages:
+                    break # deleting changed nothing, it would never end
+                previousMessages = shownMessages
+                if nSelectedMessages:
+                    changesBeforeDelete = self.startWatchingPage()
+                    self.deleteSelectedMessages()
+                    self.waitForMessageList(sinceChanges = changesBeforeDelete)
+                elif not self.openNextPage():
+                    break
+        self.searchMessages('')
+        
+    def processTabs(self):
+        if self.parallelFolders and len(self.tabNames) > 1:
+            self.processTabsInParallel()
+            return
+        for tabName in self.tabNames:
+            self.processMessages()
+            self.switchTab(tabName)
+            
+    def processTabsInParallel(self):
+        '''
+        Opens page of webmail in its own tab of the same browser (same session) for every other folder and clicks
+        folder element of every tab as soon as it is shown (see `startFolderLoads`), so lists of all folders load at once.
+        Then processes current folder and every other one in turn, in its tab. Only loading overlaps with processing,
+        folders themselves are processed one after another. Extra tabs are closed afterwards
+        '''
+        mainWindow = self.driver.current_window_handle
+        mainTab = self.currentTab
+        address = self.driver.current_url
+        folderWindows = {} # keys -> tab name, values -> window handle
+        try:
+            for tabName in self.tabNames:
+                if tabName != mainTab:
+                    folderWindows[tabName] = self.openFolderWindow(address)
+            changesBeforeClicks = self.startFolderLoads(folderWindows, self.timeouts['page'] + self.timeouts['element'])
+            self.driver.switch_to.window(mainWindow)
+            self.processMessages()
+            for tabName, window in folderWindows.items():
+                self.driver.switch_to.window(window)
+                if tabName in changesBeforeClicks:
+                    self.currentTab = tabName
+                    self.waitForMessageList(sinceChanges = changesBeforeClicks[tabName])
+                else:
+                    self.switchTab(tabName, timeout = self.timeouts['element'])
+                self.processMessages()
+        finally:
+            self.closeFolderWindows(mainWindow)
+            self.currentTab = mainTab
+            
+    def startFolderLoads(self, folderWindows, timeout):
+        '''
+        Polls tabs of `folderWindows` (tab name -> window handle) in turn, without waiting in any of them, and clicks
+        folder element of tab as soon as its page shows it, for `timeout` seconds at most.\n
+        Returns {tab name : number of page changes before click} of clicked tabs, other ones are left to `switchTab`
+        '''
+        pending = dict(folderWindows)
+        changesBeforeClicks = {}
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            for tabName, window in list(pending.items()):
+                try:
+                    self.driver.switch_to.window(window)
+                    found = self.driver.execute_script(FIND_FIRST_SCRIPT, self.candidates[tabName])
+                    if found is not None:
+                        changesBeforeClick = self.startWatchingPage()
+                        self.clickOnElement(found[1])
+                        changesBeforeClicks[tabName] = changesBeforeClick
+                        del pending[tabName]
+                except WebDriverException:
+                    pass # page is being replaced, tried again in next round
+            if pending:
+                time.sleep(0.1)
+        return changesBeforeClicks
+    
+    def openFolderWindow(self, address):
+        '''
+        Opens new browser tab and starts loading `address` there, without waiting for it. Returns window handle
+        '''
+        self.driver.switch_to.new_window('tab')
+        self.driver.execute_script('window.location.href = arguments[0];', address) # unlike `get`, does not wait for page load
+        return self.driver.current_window_handle
+    
+    def closeFolderWindows(self, mainWindow):
+        '''
+        Closes all browser tabs except `mainWindow` (also ones left by failed `openFolderWindow`), driver goes back to pool with one tab
+        '''
+        try:
+            for window in self.driver.window_handles:
+                if window != mainWindow:
+                    self.driver.switch_to.window(window)
+                    self.driver.close()
+            self.driver.switch_to.window(mainWindow)
+        except WebDriverException:
+            pass # driver is broken, pool replaces it
+            
+    def processMessages(self):
+        '''
+        Deletes ads in current folder. Streamed, part is deleted before next part is read.\n
+        When `incremental` is set, keys of the newest messages left in folder are saved (high-water mark)
+        and next loop stops at them, so only messages that came in the meantime are checked.
+        Mark saved with different ad rules is not used.\n
+        With `deleteStrategy` set to 'search' ads are found by search of webmail instead, if domain supports it (see `canSearch`)
+        '''
+        if self.deleteStrategy == 'search' and self.canSearch():
+            self.processSearchResults()
+            return
+        
+        if not (self.streamedMessages and self.batchedSelection):
+            messages = self.getMessages()
+            if messages:
+                self.selectAdMessages(messages)
+                self.deleteSelectedMessages()
+            return
+        
+        mark = self.database.getHighWaterMark(self.userLogin, self.domain, self.currentTab) if self.incremental else None
+        seenKeys = mark[1] if mark is not None and mark[0] == self.adClassifier.version else []
+        rowKeys = []
+        for rows in self.streamMessages(set(seenKeys)):
+            if self.selectAdRows(rows):
+                changesBeforeDelete = self.startWatchingPage()
+                self.deleteSelectedMessages()
+                self.waitForMessageList(sinceChanges = changesBeforeDelete)
+            for messageTopic, _, subject, rowKey in rows:
+                if len(rowKeys) < self.nHighWaterMarkKeys and not self.adClassifier.isAd(messageTopic, subject) and rowKey not in rowKeys:
+                    rowKeys.append(rowKey)
+        
+        if self.incremental:
+            # messages of old mark are below new ones, so they fill it up when only few messages came
+            rowKeys = (rowKeys + [rowKey for rowKey in seenKeys if rowKey not in rowKeys])[:self.nHighWaterMarkKeys]
+            self.database.saveHighWaterMark(self.userLogin, self.domain, self.currentTab, self.adClassifier.version, rowKeys)
+            
+    def runCycle(self):
+        '''
+        Single loop used by `AccountScheduler` instead of endless `run`:
+        logs in, processes all tabs, writes log and gives driver back to the pool.\n
+        Raises `NoSuccessInNTrials` the same way steps do (`DomainUnavailable` at once, when circuit breaker is open)
+        '''
+        try:
+            self.checkCircuitBreaker('cycle')
+            self.setup()
+            if self.logIn():
+                self.afterLoginRoutine()
+            self.processTabs()
+            self.saveSession()
+            self.writeLog()
+        except DomainUnavailable:
+            raise
+        except NoSuccessInNTrials:
+            getCircuitBreaker(self.domain, self.engine).recordFailure()
+            raise
+        finally:
+            getCircuitBreaker(self.domain, self.engine).releaseProbe()
+            self.closeDriver()
+            self.nextLoop()
+            
+    def checkCircuitBreaker(self, stepName):
+        '''
+        Raises `DomainUnavailable` when circuit breaker of domain and engine is open, so `stepName` does not go to provider.
+        Checked before every step and before whole cycle, as setup and restoring session are not steps
+        '''
+        circuitBreaker = getCircuitBreaker(self.domain, self.engine)
+        if circuitBreaker.allowRequest():
+            return
+        if self.database is None:
+            self.database = self.openDatabase()
+        self.writeLog(errorInfo = f'{self.domain} unavailable, {stepName} skipped (next try in {circuitBreaker.getRetryTime():.0f} s)')
+        raise DomainUnavailable
+        
+    def getSleepTime(self):
+        '''
+        Returns number of seconds to the next full time interval (counted from epoch) shifted by offset of the account,
+        so accounts with the same interval are spread over it instead of running at the same moment
+        '''
+        timeInterval = self.getTimeInterval()
+        return timeInterval - (time.time() - self.getOffset(timeInterval))%timeInterval
+    
+    def getOffset(self, timeInterval):
+        '''
+        Returns number of seconds (less than `timeInterval`) runs of the account are shifted by, the same in every process
+        '''
+        digest = hashlib.sha256(f'{self.domain}/{self.userLogin}'.encode()).digest() # `hash()` differs between processes
+        return int.from_bytes(digest[:8], 'big')%timeInterval
+    
+    def isAdaptive(self):
+        return self.minTimeInterval is not None and self.maxTimeInterval is not None
+    
+    def getTimeInterval(self):
+        '''
+        Returns `timeInterval` or, for adaptive account, interval in which about one ad comes according to rate
+        learned by `adRateModel` for this hour of day (within `minTimeInterval` and `maxTimeInterval`)
+        '''
+        if not self.isAdaptive() or self.database is None:
+            return self.timeInterval
+        return self._getAdRateModel().getTimeInterval(datetime.datetime.now(), self.timeInterval, self.minTimeInterval, self.maxTimeInterval)
+    
+    def _getAdRateModel(self):
+        if self.adRateModel is None:
+            self.adRateModel = self.database.getAdRateModel(self.userLogin, self.domain)
+        return self.adRateModel
         
     def goToSleep(self):
-        sleepTime = self.timeInterval - int((datetime.datetime.now()-datetime.datetime(1970,1,1)).total_seconds())%self.timeInterval
-        time.sleep(sleepTime)
+        sleepUntil(time.time() + self.getSleepTime(), self.sleepTick)
+        self.nextLoop()
+        
+    def nextLoop(self):
         self.nSelectedMessages = 0
         self.loopIndex += 1
         
     def writeLog(self, errorInfo = None):
-        self.database.writeLog(self.userLogin, self.loopIndex, self.nSelectedMessages, errorInfo)
+        '''
+        Log without `errorInfo` is written at the end of completed cycle, so it is counted as success by circuit breaker
+        (failed cycles are counted by `runCycle` and `loop`)
+        '''
+        self.database.writeLog(self.userLogin, self.loopIndex, self.nSelectedMessages, errorInfo, self.domain)
+        if errorInfo is None:
+            getCircuitBreaker(self.domain, self.engine).recordSuccess()
+        if self._newSelectorStats:
+            self.database.addSelectorStats(self.userLogin, self.domain, self._newSelectorStats)
+            self._newSelectorStats = {}
+        if self.startupTime is not None:
+            self.writeTiming('firstCycle', 1, time.time() - self.startupTime, 'ok' if errorInfo is None else 'error')
+            self.startupTime = None
+        if errorInfo is None and self.isAdaptive():
+            adRateModel = self._getAdRateModel()
+            adRateModel.update(self.nSelectedMessages, datetime.datetime.now())
+            self.database.saveAdRateModel(self.userLogin, self.domain, adRateModel)
+        
+    def writeTiming(self, step, attempts, seconds, outcome):
+        self.database.writeTiming(self.userLogin, self.domain, step, attempts, seconds, outcome)
             
     @staticmethod
     def loop(function):
@@ -208,7 +1027,10 @@ class Common:
             while True:
                 try:
                     function(*args, **kwargs)
+                except DomainUnavailable:
+                    classSelf.goToSleep()
                 except NoSuccessInNTrials:
+                    getCircuitBreaker(classSelf.domain, classSelf.engine).recordFailure()
                     classSelf.goToSleep()
                     
         return modFun
@@ -217,25 +1039,17 @@ class Common:
 class Wp(Common):
     def __init__(self, userLogin, userPassword, timeInterval):
         Common.__init__(self, userLogin, userPassword, timeInterval, 'wp')
-        self.adMessageEndsWith = '/WP'
 
     @Common.loop
     def run(self):
+        self.checkCircuitBreaker('run')
         self.setup()
-        self.runPage()
-        self.acceptCookies()
-        self.login()
+        self.logIn()
         
         for _ in range(5):
             self.afterLoginRoutine()
-            
-            for tabName in ['offertsTab', 'mainTab']:
-                messages = self.getMessages()
-                if messages:
-                    self.selectAdMessagesByEndString(messages, self.adMessageEndsWith)
-                    self.deleteSelectedMessages()
-                self.switchTab(tabName)
-            
+            self.processTabs()
+            self.saveSession()
             self.writeLog()
             self.goToSleep()
             
@@ -244,25 +1058,17 @@ class Wp(Common):
 class Interia(Common):
     def __init__(self, userLogin, userPassword, timeInterval):
         Common.__init__(self, userLogin, userPassword, timeInterval, 'interia')
-        self.adMessageEndsWith = 'dostarczone przez Interię'
         
     @Common.loop
     def run(self):
+        self.checkCircuitBreaker('run')
         self.setup()
-        self.runPage()
-        self.acceptCookies()
-        self.login()
+        self.logIn()
         
         for _ in range(5):
             self.afterLoginRoutine()
-            
-            for tabName in ['offertsTab', 'mainTab']:
-                messages = self.getMessages()
-                if messages:
-                    self.selectAdMessagesByEndString(messages, self.adMessageEndsWith)
-                    self.deleteSelectedMessages()
-                self.switchTab(tabName)
-                    
+            self.processTabs()
+            self.saveSession()
             self.writeLog()
             self.goToSleep()
             
\ No newline at end of file
@@ -0,0 +1,339 @@
+from domains import Common
+from setups import sleepUntil
+
+import email
+import email.header
+import email.utils
+import imaplib
+import multiprocessing.util
+import re
+import select
+import ssl
+import threading
+import time
+
+
+
+class ImapConnectionPool:
+    '''
+    Keeps logged in IMAP connections between loops (one per account), so that account logs in only once.\n
+    Connection is checked with NOOP before it is borrowed again
+    '''
+    def __init__(self):
+        self._idle = {} # keys -> (host, port, login), values -> connection
+        self._lock = threading.Lock()
+
+    def borrow(self, host, port, login, password):
+        with self._lock:
+            connection = self._idle.pop((host, port, login), None)
+        if connection is not None:
+            if self._isHealthy(connection):
+                return connection
+            self.discard(connection)
+        connection = imaplib.IMAP4_SSL(host, port)
+        try:
+            connection.login(login, password)
+        except:
+            self.discard(connection)
+            raise
+        return connection
+
+    def giveBack(self, connection, login):
+        with self._lock:
+            previous = self._idle.pop((connection.host, connection.port, login), None)
+            self._idle[(connection.host, connection.port, login)] = connection
+        if previous is not None:
+            self.discard(previous)
+
+    def discard(self, connection):
+        try:
+            connection.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def shutdown(self):
+        with self._lock:
+            connections = list(self._idle.values())
+            self._idle = {}
+        for connection in connections:
+            self.discard(connection)
+
+    def _isHealthy(self, connection):
+        try:
+            typ, _ = connection.noop()
+        except (imaplib.IMAP4.error, OSError):
+            return False
+        return typ == 'OK'
+
+
+_imapPool = None
+
+def getImapPool():
+    global _imapPool
+    if _imapPool is None:
+        _imapPool = ImapConnectionPool()
+        multiprocessing.util.Finalize(_imapPool, _imapPool.shutdown, exitpriority = 10)
+    return _imapPool
+
+
+class ImapEngine(Common):
+    '''
+    Processes account through IMAP instead of browser. Used for users with `imap` in `engine` column of `users` table.\n
+    Messages are searched by ad rules on server side and ads are deleted with single STORE and EXPUNGE per folder,
+    folders from `domainImapFolders` table take place of tabs
+    '''
+    engine = 'imap'
+    _searchKeys = {'sender' : 'FROM', 'subject' : 'SUBJECT'} # keys -> ad rule field, values -> IMAP search key
+
+    def __init__(self, userLogin, userPassword, timeInterval, domain):
+        Common.__init__(self, userLogin, userPassword, timeInterval, domain)
+        self.imapInfo = None
+        self.connection = None
+        self.currentFolder = None
+        self.selectedUids = []
+        self.folderUids = None # (UIDVALIDITY, UIDNEXT) of current folder, if server gave them
+        self.maxIdleTime = 25*60 # servers may drop connection idling for 30 minutes or longer
+        self.idleTick = 60 # [s] IDLE is renewed that often, so run is late at most that much after system sleep
+
+    def setup(self):
+        self.database = self.openDatabase()
+        self.profile = self.database.getDomainProfile(self.domain)
+        self.adClassifier = self.database.getAdClassifier(self.domain, self.userLogin)
+        self.imapInfo = self.database.getImapInfo(self.domain)
+        self.tabNames = self.imapInfo['folders']
+        self.closeDriver()
+
+    def closeDriver(self):
+        '''
+        Gives connection back to the pool of this process
+        '''
+        if self.connection is not None:
+            getImapPool().giveBack(self.connection, self._getImapLogin())
+            self.connection = None
+            self.currentFolder = None
+
+    def refreshPage(self, additionalSleepTime = 0):
+        '''
+        Reconnects and selects current folder again (called by `_errorHandler` when `refreshOnError` is set)
+        '''
+        if self.connection is not None:
+            getImapPool().discard(self.connection)
+            self.connection = None
+        self.login()
+        if self.currentFolder is not None:
+            self.switchTab(self.currentFolder)
+
+    def logIn(self):
+        self.login()
+        return False # there is no page to wait for after logging in
+
+    def saveSession(self):
+        pass # connection is kept by connection pool instead
+
+    @Common._errorHandler
+    def login(self, tryAgainInterval = 5, **kwargs):
+        if self.connection is None:
+            self.connection = getImapPool().borrow(self.imapInfo['host'], self.imapInfo['port'],
+                                                   self._getImapLogin(), self.userPassword)
+
+    def _getImapLogin(self):
+        if '@' in self.userLogin:
+            return self.userLogin
+        return self.userLogin + self.imapInfo['loginSuffix']
+
+    @Common._errorHandler
+    def switchTab(self, tabName, refreshOnError = True, **kwargs):
+        self._check(self.connection.select(self._quote(tabName)))
+        self.currentFolder = tabName
+        _, [uidValidity] = self.connection.response('UIDVALIDITY')
+        _, [uidNext] = self.connection.response('UIDNEXT')
+        self.folderUids = (int(uidValidity), int(uidNext)) if uidValidity is not None and uidNext is not None else None
+
+    @Common._errorHandler
+    def getMessages(self, lastUid = None, refreshOnError = True, **kwargs):
+        '''
+        Returns (uid, sender, subject) of messages in current folder that may be ads (see `_searchCandidates`).\n
+        Only candidates are fetched (and only their From and Subject headers).
+        Only messages with UID greater than `lastUid` are searched, if it is given
+        '''
+        uids = self._searchCandidates(lastUid)
+        if not uids:
+            return []
+        data = self._check(self.connection.uid('FETCH', b','.join(uids), '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])'))
+        messages = []
+        for prefix, literal, suffix in self._splitFetchResponse(data):
+            uid = re.search(rb'UID (\d+)', prefix + suffix).group(1) # server may send UID before or after header
+            header = email.message_from_bytes(literal)
+            messages.append((uid, self._getSender(header), self._decode(header.get('Subject', ''))))
+        return messages
+    
+    def _splitFetchResponse(self, data):
+        '''
+        Returns [text before literal, literal, text after it] for every message of FETCH response.
+        imaplib gives (text before literal, literal) tuple and then text after it (at least closing parenthesis)
+        '''
+        parts = []
+        for item in data:
+            if isinstance(item, tuple):
+                parts.append([item[0], item[1], b''])
+            elif item and parts:
+                parts[-1][2] += item
+        return parts
+
+    @Common._errorHandler
+    def selectAdMessages(self, messages, **kwargs):
+        areAds = self.adClassifier.classify([(sender, subject) for _, sender, subject in messages])
+        self.selectedUids = [uid for (uid, _, _), isAd in zip(messages, areAds) if isAd]
+        self.nSelectedMessages += len(self.selectedUids)
+
+    @Common._errorHandler
+    def deleteSelectedMessages(self, refreshOnError = True, **kwargs):
+        if not self.selectedUids:
+            return
+        uidSet = b','.join(self.selectedUids)
+        self._check(self.connection.uid('STORE', uidSet, '+FLAGS.SILENT', r'(\Deleted)'))
+        if 'UIDPLUS' in self.connection.capabilities:
+            self._check(self.connection.uid('EXPUNGE', uidSet)) # does not expunge messages deleted by someone else
+        else:
+            self._check(self.connection.expunge())
+        self.selectedUids = []
+
+    def processTabs(self):
+        '''
+        When `incremental` is set, the last UID of folder (high-water mark) is saved and next loop
+        searches only messages that came later. Mark is not used after UIDVALIDITY or ad rules changed
+        '''
+        for tabName in self.tabNames:
+            self.switchTab(tabName)
+            messages = self.getMessages(self._getLastCheckedUid(tabName))
+            if messages:
+                self.selectAdMessages(messages)
+                self.deleteSelectedMessages()
+            if self.incremental and self.folderUids is not None:
+                uidValidity, uidNext = self.folderUids
+                # messages that came after SELECT have greater UIDs, so they are searched next time
+                self.database.saveHighWaterMark(self.userLogin, self.domain, tabName, self.adClassifier.version, [f'{uidValidity}:{uidNext-1}'])
+                
+    def _getLastCheckedUid(self, tabName):
+        if not self.incremental or self.folderUids is None:
+            return None
+        mark = self.database.getHighWaterMark(self.userLogin, self.domain, tabName)
+        if mark is None or mark[0] != self.adClassifier.version:
+            return None
+        uidValidity, lastUid = mark[1][0].split(':')
+        return int(lastUid) if int(uidValidity) == self.folderUids[0] else None
+
+    def goToSleep(self):
+        '''
+        Same as `Common.goToSleep`, but wakes up as soon as new message comes to the first folder (IMAP IDLE)
+        '''
+        deadline = time.time() + self.getSleepTime()
+        try:
+            self._check(self.connection.select(self._quote(self.tabNames[0])))
+            self.currentFolder = self.tabNames[0]
+            while deadline > time.time():
+                if self._idle(min(deadline - time.time(), self.maxIdleTime, self.idleTick)):
+                    break
+        except (imaplib.IMAP4.error, OSError, AttributeError):
+            # no connection or it was broken, it is replaced in next loop
+            sleepUntil(deadline, self.sleepTick)
+        self.nextLoop()
+
+    @Common.loop
+    def run(self):
+        self.checkCircuitBreaker('run')
+        self.setup()
+        self.logIn()
+
+        while True:
+            self.processTabs()
+            self.writeLog()
+            self.goToSleep()
+
+    def _idle(self, timeout):
+        '''
+        Returns True if new message came within `timeout` seconds
+        '''
+        tag = self.connection._new_tag()
+        self.connection.send(tag + b' IDLE\r\n')
+        if not self.connection.readline().startswith(b'+'):
+            raise imaplib.IMAP4.error('IDLE not supported')
+        newMessage = False
+        deadline = time.monotonic() + timeout
+        while not newMessage and deadline > time.monotonic():
+            if not self._hasDataToRead():
+                readable, _, _ = select.select([self.connection.sock], [], [], deadline - time.monotonic())
+                if not readable:
+                    break
+            newMessage = self.connection.readline().rstrip().endswith(b'EXISTS')
+        self.connection.send(b'DONE\r\n')
+        while not self.connection.readline().startswith(tag):
+            pass
+        return newMessage
+
+    def _hasDataToRead(self):
+        '''
+        Tells without blocking whether line can be read: server may send more lines at once (like IDLE continuation
+        and EXISTS), imaplib reads them into buffer of its file and socket (or SSL layer) has nothing left for `select`
+        '''
+        timeout = self.connection.sock.gettimeout()
+        self.connection.sock.settimeout(0)
+        try:
+            return bool(self.connection.file.peek(1)) # buffered bytes or what socket has ready, never waits
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            self.connection.sock.settimeout(timeout)
+
+    def _searchCandidates(self, lastUid = None):
+        '''
+        Returns UIDs of messages containing text of any ad rule in its field. Server search is case-insensitive
+        substring search, so it finds all ads and maybe more (they are classified after fetching).\n
+        Regex rules can not be searched and only one non-ASCII text can be sent (as literal),
+        all messages are candidates otherwise
+        '''
+        criteria = ['UID', f'{lastUid+1}:*'] if lastUid is not None else []
+        terms = self.adClassifier.getSearchTerms()
+        if terms == []:
+            return [] # no rules
+        literal = None
+        nonAsciiTerms = [term for term in terms if not term[1].isascii()] if terms is not None else []
+        if terms is not None and len(nonAsciiTerms) <= 1:
+            terms = [term for term in terms if term[1].isascii()] + nonAsciiTerms # literal is sent after the last argument
+            criteria += ['OR']*(len(terms) - 1)
+            for field, text in terms:
+                criteria += [self._searchKeys[field], self._quote(text)]
+            if nonAsciiTerms:
+                criteria.pop()
+                literal = nonAsciiTerms[0][1].encode()
+        if not criteria:
+            criteria = ['ALL']
+        
+        if literal is None:
+            data = self._check(self.connection.uid('SEARCH', *criteria))
+        else:
+            self.connection.literal = literal
+            data = self._check(self.connection.uid('SEARCH', 'CHARSET', 'UTF-8', *criteria))
+        uids = data[0].split()
+        if lastUid is not None:
+            uids = [uid for uid in uids if int(uid) > lastUid] # `n:*` matches the last message even if its UID is lower than n
+        return uids
+
+    def _getSender(self, header):
+        '''
+        Returns sender name (as shown in webmail) or address if there is no name
+        '''
+        name, address = email.utils.parseaddr(self._decode(header.get('From', '')))
+        return name or address
+    
+    def _decode(self, headerValue):
+        return str(email.header.make_header(email.header.decode_header(headerValue)))
+
+    def _quote(self, text):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def _check(self, response):
+        typ, data = response
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(data)
+        return data
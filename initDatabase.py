@@ -17,6 +17,12 @@ elements = [
     ['wp', 'deleteButton', 'class name', 'Button.Button--secondary'],
     ['wp', 'offertsTab', 'class name', 'Tab-text.commerce'],
     ['wp', 'mainTab', 'class name', 'Tab-text.tooltip-theme-arrows.tooltip-target'],
+    ['wp', 'messageList', 'class name', 'stream-list'], # scrolled to load next part of folder
+    ['wp', 'messageSubject', 'class name', 'stream-item__subject'], # optional, used by `subject` ad rules
+    ['wp', 'messageDate', 'class name', 'stream-item__date'], # optional, part of row key of high water mark
+    ['wp', 'searchInput', 'class name', 'SearchInput-input'], # optional with `selectAll`, used by `search` delete strategy
+    ['wp', 'selectAll', 'class name', 'stream-select-all'],
+    ['wp', 'emptyFolder', 'class name', 'stream-empty'], # optional, shown instead of rows in empty folder
     
     ['interia', 'acceptCookies', 'class name', 'rodo-popup-agree'],
     ['interia', 'loginInput', 'id', 'email'],
@@ -27,7 +33,75 @@ elements = [
     ['interia', 'messageSelect', 'class name', 'checkbox-label'],
     ['interia', 'deleteButton', 'xpath', '//div[@ng-click="moveCheckedToTrash();"]'],
     ['interia', 'offertsTab', 'class name', 'icon.icon-offer'],
-    ['interia', 'mainTab', 'xpath', '//a[@href="#/folder/1"]']
+    ['interia', 'mainTab', 'xpath', '//a[@href="#/folder/1"]'],
+    ['interia', 'nextPage', 'xpath', '//button[@ng-click="nextPage()"]'], # clicked to open next page of folder
+    ['interia', 'messageSubject', 'xpath', './/span[@ng-bind="::message.subject"]'],
+    ['interia', 'messageDate', 'xpath', './/*[contains(@class, "date")]'],
+    ['interia', 'searchInput', 'xpath', '//input[@ng-model="searchQuery"]'],
+    ['interia', 'selectAll', 'xpath', '//div[@ng-click="checkAll()"]'],
+    ['interia', 'emptyFolder', 'xpath', '//*[@ng-if="!messages.length"]'] # optional, shown instead of rows in empty folder
+]
+
+# fallback locators of elements (rank 0 is locator in `elements`), tried when page was redesigned;
+# every account orders them by its own hit rate (see `Common.findElement`)
+elementCandidates = [
+    ['wp', 'acceptCookies', 1, 'xpath', '//button[contains(text(), "AKCEPTUJĘ")]'],
+    ['wp', 'loginButton', 1, 'xpath', '//button[@type="submit"]'],
+    ['wp', 'loginInput', 1, 'name', 'login'],
+    ['wp', 'passwordInput', 1, 'name', 'password'],
+    ['interia', 'loginButton', 1, 'xpath', '//button[@type="submit"]'],
+    ['interia', 'loginInput', 1, 'name', 'email'],
+    ['interia', 'passwordInput', 1, 'name', 'password']
+]
+
+# tab elements of folders processed in this order, the last one is open after login
+folders = [
+    ['wp', 'offertsTab', 1],
+    ['wp', 'mainTab', 2],
+    ['interia', 'offertsTab', 1],
+    ['interia', 'mainTab', 2]
+]
+
+# message is ad when any rule matches its field (sender is discriminative text of message),
+# kind is `suffix`, `prefix`, `substring` or `regex`. Rules of single users are added with empty domain rules
+adRules = [
+    ['wp', '', 'sender', 'suffix', '/WP'],
+    ['interia', '', 'sender', 'suffix', 'dostarczone przez Interię']
+]
+
+# used by users with `imap` engine, login suffix is added to logins without domain
+imapServers = [
+    ['wp', 'imap.wp.pl', 993, '@wp.pl'],
+    ['interia', 'poczta.interia.pl', 993, '@interia.pl']
+]
+
+imapFolders = [
+    ['wp', 'INBOX'],
+    ['interia', 'INBOX']
+]
+
+# requests to urls matching these patterns (`*` is wildcard) are blocked by browser
+blockedUrls = [[domain, pattern] for domain in ['wp', 'interia'] for pattern in [
+    '*.mp4*', '*.webm*', '*.woff*', '*.ttf*', '*.otf*',
+    '*doubleclick.net*', '*googlesyndication.com*', '*googletagservices.com*', '*google-analytics.com*',
+    '*googletagmanager.com*', '*adform.net*', '*gemius.pl*', '*facebook.net*', '*criteo.*', '*rubiconproject.com*'
+]]
+
+# [seconds]
+timeouts = [
+    ['wp', 'element', 10],
+    ['wp', 'page', 10],
+    ['wp', 'login', 15], # leaving login page after clicking login button
+    ['wp', 'messagesSettle', 10], # message list stops changing
+    ['wp', 'messagesQuiet', 0.75], # no changes in page structure for that long means message list has settled
+    ['wp', 'messagesLoad', 3], # next part of message list appears after scrolling
+    
+    ['interia', 'element', 10],
+    ['interia', 'page', 10],
+    ['interia', 'login', 15],
+    ['interia', 'messagesSettle', 10],
+    ['interia', 'messagesQuiet', 1],
+    ['interia', 'messagesLoad', 3]
 ]
 
 
@@ -35,6 +109,12 @@ elements = [
 db = sqlite3.connect('./database.sqlite')
 
 with db:
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS meta (
+                   key text NOT NULL PRIMARY KEY,
+                   value text NOT NULL);
+               ''')
+    
     db.execute('''
                CREATE TABLE IF NOT EXISTS domainAddress (
                    domain text NOT NULL,
@@ -51,13 +131,88 @@ with db:
                    PRIMARY KEY (domain, elementName));
                ''')
     
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS domainElementCandidates (
+                   domain text NOT NULL,
+                   elementName text NOT NULL,
+                   rank INTEGER NOT NULL,
+                   by text NOT NULL,
+                   value text NOT NULL,
+                   PRIMARY KEY (domain, elementName, rank));
+               ''')
+    
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS domainFolders (
+                   domain text NOT NULL,
+                   tabName text NOT NULL,
+                   position INTEGER NOT NULL,
+                   PRIMARY KEY (domain, tabName));
+               ''')
+    
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS domainBlockedUrls (
+                   domain text NOT NULL,
+                   pattern text NOT NULL,
+                   PRIMARY KEY (domain, pattern));
+               ''')
+    
+    # `userName` is empty for rules of all users of domain, `bundled` is 1 for rules of this file
+    # (only they are synced with new versions, rules added by user are kept)
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS adRules (
+                   domain text NOT NULL,
+                   userName text NOT NULL DEFAULT '',
+                   field text NOT NULL,
+                   kind text NOT NULL,
+                   pattern text NOT NULL,
+                   bundled INTEGER NOT NULL DEFAULT 0,
+                   PRIMARY KEY (domain, userName, field, kind, pattern));
+               ''')
+    
+    # compiled rules are cached until this version changes
+    # (conflict clause of statement changing rules overrides the one in trigger, so REPLACE could not be used)
+    for event in ['INSERT', 'UPDATE', 'DELETE']:
+        db.execute(f'''
+                   CREATE TRIGGER IF NOT EXISTS adRulesVersion{event.capitalize()} AFTER {event} ON adRules
+                   BEGIN
+                       INSERT OR IGNORE INTO meta(key, value) VALUES ('adRulesVersion', 0);
+                       UPDATE meta SET value = value + 1 WHERE key = 'adRulesVersion';
+                   END;
+                   ''')
+    
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS domainTimeouts (
+                   domain text NOT NULL,
+                   timeoutName text NOT NULL,
+                   seconds REAL NOT NULL,
+                   PRIMARY KEY (domain, timeoutName));
+               ''')
+    
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS domainImap (
+                   domain text NOT NULL PRIMARY KEY,
+                   host text NOT NULL,
+                   port INTEGER NOT NULL,
+                   loginSuffix text NOT NULL);
+               ''')
+    
+    db.execute('''
+               CREATE TABLE IF NOT EXISTS domainImapFolders (
+                   domain text NOT NULL,
+                   folder text NOT NULL,
+                   PRIMARY KEY (domain, folder));
+               ''')
+    
     db.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY AUTOINCREMENT,
                     userName text NOT NULL,
                     password text NOT NULL,
                     domain text NOT NULL,
-                    timeInterval INTEGER NOT NULL);
+                    timeInterval INTEGER NOT NULL,
+                    engine text NOT NULL DEFAULT 'browser',
+                    minTimeInterval INTEGER,
+                    maxTimeInterval INTEGER);
                 ''')
 
     db.execute('''
@@ -68,9 +223,132 @@ with db:
                     error INTEGER NOT NULL,
                     info text NOT NULL,
                     deleted INTEGER,
+                    date text NOT NULL,
+                    domain text NOT NULL DEFAULT '');
+                ''')
+    
+    db.execute('CREATE INDEX IF NOT EXISTS logsUserDate ON logs (userName, date);')
+    db.execute('CREATE INDEX IF NOT EXISTS logsDate ON logs (date);')
+    
+    # loops, errors and deleted ads per hour and per day (`start` is the first second of period),
+    # kept after raw logs are compacted (see `Database.compactLogs`)
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS logRollups (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    period text NOT NULL,
+                    start text NOT NULL,
+                    loops INTEGER NOT NULL,
+                    errors INTEGER NOT NULL,
+                    deleted INTEGER NOT NULL,
+                    PRIMARY KEY (userName, domain, period, start));
+                ''')
+    
+    for period, start in [('hour', "substr(NEW.date, 1, 13) || ':00:00'"), ('day', 'substr(NEW.date, 1, 10)')]:
+        db.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS logRollups{period.capitalize()} AFTER INSERT ON logs
+                    BEGIN
+                        INSERT OR IGNORE INTO logRollups VALUES (NEW.userName, NEW.domain, '{period}', {start}, 0, 0, 0);
+                        UPDATE logRollups SET loops = loops + 1, errors = errors + NEW.error, deleted = deleted + coalesce(NEW.deleted, 0)
+                        WHERE userName = NEW.userName AND domain = NEW.domain AND period = '{period}' AND start = {start};
+                    END;
+                    ''')
+    
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS timings (
+                    timing_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    step text NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    seconds REAL NOT NULL,
+                    outcome text NOT NULL,
                     date text NOT NULL);
                 ''')
     
+    db.execute('CREATE INDEX IF NOT EXISTS timingsDate ON timings (date);')
+    
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    address text NOT NULL,
+                    cookies text NOT NULL,
+                    localStorage text NOT NULL,
+                    date text NOT NULL,
+                    PRIMARY KEY (userName, domain));
+                ''')
+    
+    # keys of the newest messages kept in folder after last loop, messages below them were checked already
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS highWaterMarks (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    folder text NOT NULL,
+                    rule text NOT NULL,
+                    rowKeys text NOT NULL,
+                    date text NOT NULL,
+                    PRIMARY KEY (userName, domain, folder));
+                ''')
+    
+    # the last state of worker processes of accounts, saved by `ProcessSupervisor`
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS workerStatus (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    pid INTEGER,
+                    state text NOT NULL,
+                    restarts INTEGER NOT NULL,
+                    rssMb INTEGER NOT NULL,
+                    lastExitCode INTEGER,
+                    nextStart text,
+                    updated text NOT NULL,
+                    PRIMARY KEY (userName, domain));
+                ''')
+    
+    # hosts processing accounts of shared database (`adsOnMail.py nosetup shard`) and accounts each of them owns until `expires`
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS hosts (
+                    host text NOT NULL PRIMARY KEY,
+                    capacity INTEGER NOT NULL,
+                    heartbeat text NOT NULL);
+                ''')
+    
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    host text NOT NULL,
+                    expires text NOT NULL,
+                    PRIMARY KEY (userName, domain));
+                ''')
+    
+    db.execute('CREATE INDEX IF NOT EXISTS leasesHost ON leases (host);')
+    
+    # lookups of every locator of element by account: found, not found (while other locator or none was found) and time to find
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS selectorStats (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    elementName text NOT NULL,
+                    by text NOT NULL,
+                    value text NOT NULL,
+                    hits INTEGER NOT NULL,
+                    misses INTEGER NOT NULL,
+                    seconds REAL NOT NULL,
+                    PRIMARY KEY (userName, domain, elementName, by, value));
+                ''')
+    
+    # ads per hour for every hour of day, learned by accounts with adaptive time interval (see `AdRateModel`)
+    db.execute('''
+                CREATE TABLE IF NOT EXISTS adRateModels (
+                    userName text NOT NULL,
+                    domain text NOT NULL,
+                    rates text NOT NULL,
+                    updated text NOT NULL,
+                    PRIMARY KEY (userName, domain));
+                ''')
+    
     
 
 with db:
@@ -79,6 +357,25 @@ with db:
 with db:
     db.executemany('INSERT OR IGNORE INTO domainElements VALUES (?,?,?,?);',  elements)
     
+with db:
+    db.executemany('INSERT OR IGNORE INTO domainElementCandidates VALUES (?,?,?,?,?);',  elementCandidates)
+    
+with db:
+    db.executemany('INSERT OR IGNORE INTO domainFolders VALUES (?,?,?);',  folders)
+    
+with db:
+    db.executemany('INSERT OR IGNORE INTO adRules VALUES (?,?,?,?,?,1);',  adRules)
+    
+with db:
+    db.executemany('INSERT OR IGNORE INTO domainBlockedUrls VALUES (?,?);',  blockedUrls)
+    
+with db:
+    db.executemany('INSERT OR IGNORE INTO domainTimeouts VALUES (?,?,?);',  timeouts)
+    
+with db:
+    db.executemany('INSERT OR IGNORE INTO domainImap VALUES (?,?,?,?);',  imapServers)
+    db.executemany('INSERT OR IGNORE INTO domainImapFolders VALUES (?,?);',  imapFolders)
+    
     
     
     
@@ -0,0 +1,163 @@
+from setups import NoSuccessInNTrials, getDriverPool
+
+import asyncio
+import concurrent.futures
+import collections
+import heapq
+import itertools
+import sqlite3
+import time
+import traceback
+
+
+
+class AccountScheduler:
+    '''
+    Runs all accounts in single process instead of one process per account.\n
+    One asyncio coordinator keeps accounts in priority queue ordered by time of their next run
+    and hands due accounts to small pool of worker threads running `Common.runCycle`.\n
+    Number of cycles run at once is limited globally (`maxConcurrent`) and per domain (`maxConcurrentPerDomain`),
+    so memory and CPU usage depend on these limits, not on number of accounts.
+    No more than `maxStarts` cycles start within `startWindow` seconds, so browsers are not started all at once.\n
+    Due times are wall clock times checked at least every `tick` seconds, so account that got due
+    during system sleep runs right after resume.\n
+    With `leaseManager` (several hosts sharing database) only accounts leased by this host are run,
+    others wait for the next renewal of leases. With `logCompactor` old logs are compacted when it is due
+    '''
+    def __init__(self, accounts, maxConcurrent = 4, maxConcurrentPerDomain = 2, maxStarts = 2, startWindow = 10, tick = 5, leaseManager = None,
+                 logCompactor = None):
+        self.accounts = accounts
+        self.leaseManager = leaseManager
+        self.logCompactor = logCompactor
+        self.maxConcurrent = maxConcurrent
+        self.maxConcurrentPerDomain = maxConcurrentPerDomain
+        self.maxStarts = maxStarts
+        self.startWindow = startWindow
+        self.tick = tick
+        self._starts = collections.deque() # monotonic times of the last `maxStarts` starts
+        self._queue = [] # heap of (dueTime, order, account)
+        self._order = itertools.count() # accounts are not comparable, so equal due times are ordered by insertion
+        self._queueChanged = None
+        self._globalLimit = None
+        self._domainLimits = None
+        self._executor = None
+        self._running = set() # (userName, domain) of accounts which cycle runs
+
+    def run(self):
+        asyncio.run(self._coordinate())
+
+    async def _coordinate(self):
+        self._queueChanged = asyncio.Event()
+        self._globalLimit = asyncio.Semaphore(self.maxConcurrent)
+        self._domainLimits = collections.defaultdict(lambda: asyncio.Semaphore(self.maxConcurrentPerDomain))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.maxConcurrent)
+        getDriverPool(size = self.maxConcurrent)
+
+        now = time.time()
+        for account in self.accounts:
+            self._push(account, now)
+
+        runningTasks = set()
+        try:
+            while True:
+                if self.leaseManager is not None and self.leaseManager.isRenewalDue():
+                    await asyncio.get_running_loop().run_in_executor(None, self.leaseManager.renew, set(self._running))
+                if self.logCompactor is not None and self.logCompactor.isDue():
+                    self.logCompactor.compact() # only puts statements to log writer queue
+                dueTime, _, account = self._queue[0] if self._queue else (None, None, None)
+                delay = dueTime - time.time() if dueTime is not None else self.tick
+                if delay > 0:
+                    # woken up earlier when account is put back to queue
+                    self._queueChanged.clear()
+                    try:
+                        await asyncio.wait_for(self._queueChanged.wait(), min(delay, self.tick))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.leaseManager is not None and not self.leaseManager.owns(account):
+                    heapq.heappop(self._queue)
+                    self._push(account, time.time() + self.leaseManager.heartbeatInterval)
+                    continue
+                if len(self._starts) >= self.maxStarts:
+                    startDelay = self._starts[0] + self.startWindow - time.monotonic()
+                    if startDelay > 0:
+                        await asyncio.sleep(startDelay)
+                        continue
+                    self._starts.popleft()
+                self._starts.append(time.monotonic())
+                heapq.heappop(self._queue)
+                self._running.add((account.userLogin, account.domain))
+                task = asyncio.create_task(self._runAccount(account))
+                runningTasks.add(task)
+                task.add_done_callback(runningTasks.discard)
+        finally:
+            self._executor.shutdown(wait = False, cancel_futures = True)
+            if self.leaseManager is not None:
+                self.leaseManager.release()
+
+    async def _runAccount(self, account):
+        try:
+            async with self._domainLimits[account.domain], self._globalLimit:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(self._executor, account.runCycle)
+                except NoSuccessInNTrials:
+                    pass # already logged by `Common._errorHandler`
+                except Exception:
+                    # any other error must not stop processing of other accounts
+                    traceback.print_exc()
+        finally:
+            self._running.discard((account.userLogin, account.domain))
+            # account is never dropped from queue, also when its sleep time can not be computed
+            try:
+                sleepTime = account.getSleepTime()
+            except Exception:
+                traceback.print_exc()
+                sleepTime = account.timeInterval
+            self._push(account, time.time() + sleepTime)
+
+    def _push(self, account, dueTime):
+        heapq.heappush(self._queue, (dueTime, next(self._order), account))
+        if self._queueChanged is not None:
+            self._queueChanged.set()
+
+
+class LeaseManager:
+    '''
+    Shards accounts between hosts sharing one database. Host owns accounts leased to it in `leases` table
+    (see `Database.claimLeases`) for `leaseTime` seconds and renews leases every `heartbeatInterval` seconds.
+    Leases of host that stopped renewing expire and are taken over by other hosts, host that joined gets its share
+    when others renew.\n
+    `capacity` is the most accounts host may own, given by its browser budget
+    '''
+    def __init__(self, database, host, capacity, leaseTime = 120, heartbeatInterval = 30):
+        self.database = database
+        self.host = host
+        self.capacity = capacity
+        self.leaseTime = leaseTime
+        self.heartbeatInterval = heartbeatInterval
+        self._owned = set() # (userName, domain)
+        self._ownedUntil = 0 # monotonic time when leases expire if they are not renewed
+        self._nextRenewal = time.monotonic()
+
+    def isRenewalDue(self):
+        return time.monotonic() >= self._nextRenewal
+
+    def renew(self, running = ()):
+        '''
+        Renews leases, `running` (userName, domain) accounts keep theirs also when host owns more than its share
+        '''
+        try:
+            renewalTime = time.monotonic()
+            self._owned = self.database.claimLeases(self.host, self.capacity, self.leaseTime, running)
+            self._ownedUntil = renewalTime + self.leaseTime
+        except sqlite3.Error:
+            # database busy, leases are kept till they expire and renewed in next try
+            traceback.print_exc()
+        self._nextRenewal = time.monotonic() + self.heartbeatInterval
+
+    def owns(self, account):
+        return time.monotonic() < self._ownedUntil and (account.userLogin, account.domain) in self._owned
+
+    def release(self):
+        self._owned = set()
+        self.database.releaseLeases(self.host)
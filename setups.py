@@ -1,21 +1,35 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.safari.options import Options as SafariOptions
-from pwinput import pwinput
+# selenium, pwinput and appdirs are imported where they are used, so that processes not using them start faster
 import sqlite3
 import sys
 import os
-import appdirs
 import shutil
 import datetime
+import hashlib
+import json
+import math
+import queue
+import re
+import threading
+import time
+import traceback
+import urllib.parse
+import multiprocessing.util
+
+try:
+    import psutil
+except ImportError:
+    # without psutil drivers are recycled only by number of uses
+    psutil = None
 
 
 
 class UserSetup:
-    def __init__(self, database, possibleDomains):
+    def __init__(self, database, possibleDomains, possibleEngines):
         self.possibleDomains = possibleDomains
+        self.possibleEngines = possibleEngines
         self.database = database
         self.defaultTimeInterval = 30
+        self.defaultEngine = 'browser'
 
     def saveData(self):
         print('Creating new account')
@@ -23,8 +37,10 @@ class UserSetup:
         password = self._getPassword()
         domain = self._getDomain()
         timeInterval = self._getTimeInterval()
+        minTimeInterval, maxTimeInterval = self._getTimeIntervalBounds(timeInterval)
+        engine = self._getEngine()
         
-        self.database.newUser(login, password, domain, timeInterval)
+        self.database.newUser(login, password, domain, timeInterval, engine, minTimeInterval, maxTimeInterval)
         print('Account saved.\n')
         
         userAnswear = ''
@@ -44,6 +60,7 @@ class UserSetup:
         return userName
     
     def _getPassword(self):
+        from pwinput import pwinput
         password = pwinput('Enter password: ')
         return password
     
@@ -53,6 +70,13 @@ class UserSetup:
         domain = domain.lower()
         return domain if domain in self.possibleDomains else self._getDomain()
     
+    def _getEngine(self):
+        engine = input(f'Select engine: {", ".join(self.possibleEngines)} (leave empty to use {self.defaultEngine}): ')
+        engine = engine.lower()
+        if not engine:
+            return self.defaultEngine
+        return engine if engine in self.possibleEngines else self._getEngine()
+    
     def _getTimeInterval(self):
         while True:
             try:
@@ -66,36 +90,151 @@ class UserSetup:
             except ValueError:
                 print('Enter only number\n')
                 
+    def _getTimeIntervalBounds(self, timeInterval):
+        '''
+        Returns (None, None) for fixed time interval or (shortest, longest) interval chosen by adaptive mode
+        '''
+        while True:
+            bounds = input('Enter shortest and longest time interval, for example "10 120", to adapt interval to how often ads come '
+                           '(leave empty to use fixed interval) [minutes]: ')
+            if not bounds:
+                return None, None
+            try:
+                minTimeInterval, maxTimeInterval = [int(bound) for bound in bounds.split()]
+            except ValueError:
+                print('Enter two numbers\n')
+                continue
+            if 0 < minTimeInterval <= timeInterval <= maxTimeInterval:
+                return minTimeInterval, maxTimeInterval
+            print(f'Enter positive numbers, the first not greater and the second not less than {timeInterval}\n')
+                
                 
 class DatabaseSetup:
     def __init__(self, databaseName):
         self._name = databaseName
+        self._domainTables = ['domainAddress', 'domainElements', 'domainElementCandidates', 'domainFolders', 'domainTimeouts', 'domainBlockedUrls', 'domainImap', 'domainImapFolders']
+        self._sharedTables = {'adRules' : 'bundled = 1'} # keys -> table with bundled and user rows, values -> condition of bundled rows
         
         
     def update(self):
         '''
-        Replaces data in `domainAddress` and `domainElements` tables in database in user data directory
+        Replaces data in domain tables (`domainAddress`, `domainElements`, `domainTimeouts`, ...) in database in user data directory
         by data from database in pyinstaller temporary location (PTL).\n
-        Does any diffrence only when data in PTL was updated
+        Writes anything only when version (hash of schema and domain data) of database in PTL differs from the one synced last time
         '''
         if self._runningAsExe():
             fromPath = self._getDatabasePathFromPyinstallerTempLocation()
         else:
             fromPath = self._getDatabasePathFromSourceCodeLoaction()
         fromDb = sqlite3.connect(fromPath)
-        with fromDb:
-            domainAddress = fromDb.execute('SELECT * FROM domainAddress;')
-            domainElements = fromDb.execute('SELECT * FROM domainElements;')    
-        
         uddPath = self._getDatabasePathFromUserDataDir()
-        uddDb = sqlite3.connect(uddPath)
-        with uddDb:
-            uddDb.execute('DELETE FROM domainAddress;')
-            uddDb.execute('DELETE FROM domainElements;')
-            uddDb.executemany('INSERT INTO domainAddress(domain, pageAddress) VALUES (?,?);',  domainAddress)
-            uddDb.executemany('INSERT INTO domainElements VALUES (?,?,?,?);',  domainElements)
+        uddDb = sqlite3.connect(uddPath, timeout = 30)
+        version = self._getVersion(fromDb)
+        if self.getSyncedVersion(uddDb) != version:
+            with uddDb:
+                createdTables = self._createMissingTables(fromDb, uddDb)
+                addedColumns = self._addMissingColumns(fromDb, uddDb)
+                self._migrateLogs(uddDb, 'logRollups' in createdTables)
+                if ('adRules', 'bundled') in addedColumns:
+                    self._markBundledRules(fromDb, uddDb)
+                for table, condition in self._getDomainRows():
+                    rows = fromDb.execute(f'SELECT * FROM {table} WHERE {condition};').fetchall()
+                    uddDb.execute(f'DELETE FROM {table} WHERE {condition};')
+                    if rows:
+                        placeholders = ','.join('?'*len(rows[0]))
+                        # user row equal to bundled one is kept as user row, so it stays when bundle drops it
+                        uddDb.executemany(f'INSERT OR IGNORE INTO {table} VALUES ({placeholders});', rows)
+                uddDb.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('domainDataVersion', ?);", [version])
         fromDb.close()
         uddDb.close()
+        
+    def getSyncedVersion(self, uddDb):
+        '''
+        Returns version of domain data synced to database in user data directory or None if it was never synced
+        '''
+        try:
+            query = uddDb.execute("SELECT value FROM meta WHERE key = 'domainDataVersion';")
+        except sqlite3.OperationalError:
+            # table does not exist
+            return None
+        version = query.fetchone()
+        return version[0] if version is not None else None
+        
+    def _getVersion(self, fromDb):
+        digest = hashlib.sha256()
+        for row in fromDb.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name;"):
+            digest.update(repr(row).encode())
+        for table, condition in self._getDomainRows():
+            for row in sorted(fromDb.execute(f'SELECT * FROM {table} WHERE {condition};').fetchall(), key = repr):
+                digest.update(repr((table, row)).encode())
+        return digest.hexdigest()
+        
+    def _getDomainRows(self):
+        '''
+        Returns (table, condition) of every table with domain data, condition selects domain rows (all in domain tables)
+        '''
+        return [(table, '1') for table in self._domainTables] + list(self._sharedTables.items())
+        
+    def _createMissingTables(self, fromDb, uddDb):
+        '''
+        Creates tables, indexes and triggers that exist in preinited database but not in database in user data directory.\n
+        Database in user data directory is copied only once, so it misses everything added in newer versions.
+        Returns names of created objects
+        '''
+        existing = {row[0] for row in uddDb.execute('SELECT name FROM sqlite_master;')}
+        query = fromDb.execute('''SELECT name, sql FROM sqlite_master
+                                  WHERE type IN ('table', 'index', 'trigger') AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+                                  ORDER BY type != 'table';''')
+        created = []
+        for name, sql in query.fetchall():
+            if name not in existing:
+                uddDb.execute(sql)
+                created.append(name)
+        return created
+                
+    def _addMissingColumns(self, fromDb, uddDb):
+        '''
+        Adds columns that exist in tables of preinited database but not in the same tables of database in user data directory.
+        Returns (table, column) of added columns
+        '''
+        added = []
+        tables = [row[0] for row in fromDb.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';")]
+        for table in tables:
+            existing = {row[1] for row in uddDb.execute(f'PRAGMA table_info({table});')}
+            for _, name, type_, notNull, default, _ in fromDb.execute(f'PRAGMA table_info({table});').fetchall():
+                if name in existing:
+                    continue
+                column = f'{name} {type_}'
+                if default is not None:
+                    column += f' DEFAULT {default}'
+                if notNull and default is not None: # NOT NULL column without default can not be added to table with rows
+                    column += ' NOT NULL'
+                uddDb.execute(f'ALTER TABLE {table} ADD COLUMN {column};')
+                added.append((table, name))
+        return added
+        
+    def _markBundledRules(self, fromDb, uddDb):
+        '''
+        Marks domain rules of older database that are bundled ones, so they are synced from now on.
+        Other domain rules were added by user and are kept
+        '''
+        rules = fromDb.execute('SELECT domain, userName, field, kind, pattern FROM adRules WHERE bundled = 1;').fetchall()
+        uddDb.executemany('UPDATE adRules SET bundled = 1 WHERE domain = ? AND userName = ? AND field = ? AND kind = ? AND pattern = ?;', rules)
+                
+    def _migrateLogs(self, uddDb, fillRollups):
+        '''
+        Converts dates written by older versions ("%m/%d/%Y, %H:%M:%S") to sortable ISO format, fills domain of old logs
+        and, if `logRollups` table was just created, fills it from logs written before
+        '''
+        for table in ['logs', 'sessions', 'highWaterMarks']:
+            uddDb.execute(f'''UPDATE {table} SET date = substr(date, 7, 4) || '-' || substr(date, 1, 2) || '-' || substr(date, 4, 2) || 'T' || substr(date, 13, 8)
+                              WHERE date LIKE '__/__/____, %';''')
+        uddDb.execute('''UPDATE logs SET domain = coalesce((SELECT domain FROM users WHERE users.userName = logs.userName LIMIT 1), '')
+                         WHERE domain = '';''')
+        if fillRollups:
+            for period, start in [('hour', "substr(date, 1, 13) || ':00:00'"), ('day', 'substr(date, 1, 10)')]:
+                uddDb.execute(f'''INSERT INTO logRollups SELECT userName, domain, '{period}', {start}, count(*), sum(error), sum(coalesce(deleted, 0))
+                                  FROM logs GROUP BY userName, domain, {start};''')
 
 
     def _anyUsers(self):
@@ -104,15 +243,16 @@ class DatabaseSetup:
         returns False if users table does not exists or users table is empty
         '''
         dbPath = self._getDatabasePathFromUserDataDir()
-        tempDbConnection = sqlite3.connect(dbPath)
-        with tempDbConnection:
-            try:
-                query = tempDbConnection.execute('SELECT * FROM users')
-            except sqlite3.OperationalError:
-                # table does not exist
-                return False
+        tempDbConnection = sqlite3.connect(dbPath, timeout = 30)
+        try:
+            anyUser = tempDbConnection.execute('SELECT 1 FROM users LIMIT 1;').fetchone()
+        except sqlite3.OperationalError:
+            # table does not exist
+            return False
+        finally:
+            tempDbConnection.close()
             
-        return True if query.fetchall() else False # query is list so `return query` would not return bool value
+        return anyUser is not None
         
     def getDatabasePath(self):
         '''
@@ -144,6 +284,7 @@ class DatabaseSetup:
         return os.getcwd() + f'\{self._name}'
     
     def _getDatabasePathFromUserDataDir(self):
+        import appdirs
         thisFileName = os.path.basename(sys.modules['__main__'].__file__).split('.')[0]
         retPath = appdirs.user_data_dir() + f'\{thisFileName}\{self._name}'
         self._createPathIfNotExists(retPath)
@@ -167,7 +308,12 @@ class DatabaseSetup:
 
 
 class DriverSetup:
-    def __init__(self):
+    '''
+    In lean mode browser loads no images and extensions and runs fewer renderer processes
+    (requests are blocked per domain by `Common` through CDP)
+    '''
+    def __init__(self, lean = True):
+        self.lean = lean
         self._osName = sys.platform
     
     def getDriver(self):
@@ -180,71 +326,1028 @@ class DriverSetup:
         return self._getDriverForSafari()
     
     def _getDriverOptions(self):
+        from selenium.webdriver.chrome.options import Options as ChromeOptions
+        from selenium.webdriver.safari.options import Options as SafariOptions
         if self._osName == 'win32' or self._osName.startswith('linux'):
             options = ChromeOptions()
         else:
             options = SafariOptions()
         options.headless = True
         options.add_experimental_option('excludeSwitches', ['enable-logging'])
+        if isinstance(options, ChromeOptions):
+            # folders open in other tabs keep loading at full speed (see `Common.parallelFolders`)
+            options.add_argument('--disable-background-timer-throttling')
+            options.add_argument('--disable-renderer-backgrounding')
+            options.add_argument('--disable-backgrounding-occluded-windows')
+        if self.lean and isinstance(options, ChromeOptions):
+            self._setLeanOptions(options)
         return options
+    
+    def _setLeanOptions(self, options):
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images' : 2})
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--renderer-process-limit=2') # pages of all tabs share them
+        options.add_argument('--autoplay-policy=user-gesture-required')
+        options.add_argument('--mute-audio')
+        options.add_argument('--disable-background-networking') # no component, safe browsing or translate updates
+        options.add_argument('--disable-component-update')
+        options.add_argument('--disable-default-apps')
+        options.add_argument('--disable-sync')
         
     def _getDriverForChrome(self):
+        from selenium import webdriver
         options = self._getDriverOptions()
         return webdriver.Chrome('chromedriver', options=options)
         
     def _getDriverForSafari(self):
         self._enableSafariDriver()
+        from selenium import webdriver
         options = self._getDriverOptions()
         return webdriver.Safari(options=options)
         
     def _enableSafaridriver(self):
         os.system('safaridriver --enable')
+        
+        
+class DriverPool:
+    '''
+    Keeps warm webdrivers so that `Common` does not start new browser on every `run()` restart.\n
+    Driver is health-checked before it is borrowed again and recycled (quit and replaced by new one)
+    after `maxUses` borrows or when its browser processes use more than `maxRssMb` megabytes of memory
+    '''
+    def __init__(self, size = 1, maxUses = 50, maxRssMb = 1024, lean = True):
+        self.size = size
+        self.maxUses = maxUses
+        self.maxRssMb = maxRssMb
+        self._config = DriverSetup(lean)
+        self._idle = []
+        self._uses = {} # keys -> driver, values -> how many times driver was borrowed
+        self._nDrivers = 0 # idle and borrowed drivers
+        self._closed = False
+        self._condition = threading.Condition()
+        
+    def borrow(self, timeout = None):
+        '''
+        Returns healthy idle driver or new one if pool is not full yet.\n
+        Waits up to `timeout` seconds (forever if None) for driver to be given back when pool is full.
+        Lock is held only for bookkeeping, health checks and starting or quitting browsers do not block other threads
+        '''
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError('Driver pool is shut down')
+                    if self._idle:
+                        driver = self._idle.pop()
+                        break
+                    if self._nDrivers < self.size:
+                        self._nDrivers += 1
+                        driver = None
+                        break
+                    if not self._condition.wait(timeout):
+                        raise TimeoutError('No driver given back to pool in time')
+            if driver is None:
+                break
+            if self._isHealthy(driver):
+                with self._condition:
+                    if driver not in self._uses:
+                        raise RuntimeError('Driver pool is shut down') # and driver was quit by `shutdown`
+                    self._uses[driver] += 1
+                return driver
+            self._quitDriver(driver)
+                
+        try:
+            driver = self._config.getDriver()
+        except:
+            with self._condition:
+                self._nDrivers -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            closed = self._closed
+            if not closed:
+                self._uses[driver] = 1
+            else:
+                self._nDrivers -= 1
+        if closed:
+            driver.quit()
+            raise RuntimeError('Driver pool is shut down')
+        return driver
+    
+    def giveBack(self, driver):
+        if self._closed or self._needsRecycling(driver) or not self._reset(driver):
+            self._quitDriver(driver)
+            return
+        with self._condition:
+            if not self._closed: # pool could be shut down while driver was reset
+                self._idle.append(driver)
+                self._condition.notify()
+                return
+        self._quitDriver(driver)
+            
+    def shutdown(self):
+        '''
+        Quits all drivers, also ones borrowed at the moment, as borrower may never give them back when process exits
+        '''
+        with self._condition:
+            self._closed = True
+            self._idle = []
+            drivers = list(self._uses)
+            self._condition.notify_all()
+        for driver in drivers:
+            self._quitDriver(driver)
+            
+    def _isHealthy(self, driver):
+        try:
+            driver.execute_script('return document.readyState;')
+        except Exception:
+            return False
+        return True
+    
+    def _reset(self, driver):
+        '''
+        Leaves driver in state of a fresh browser, so that next borrower (possibly other account)
+        does not see previous session. Returns False if driver is not usable anymore.\n
+        With CDP all storage (local storage, IndexedDB, cache, service workers...) of every origin visited
+        in any tab is cleared, otherwise only local and session storage of the current one
+        '''
+        try:
+            supportsCdp = hasattr(driver, 'execute_cdp_cmd')
+            origins = set()
+            for handle in reversed(driver.window_handles):
+                driver.switch_to.window(handle)
+                if supportsCdp:
+                    origins.update(self._getVisitedOrigins(driver))
+                if handle != driver.window_handles[0]:
+                    driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+            if supportsCdp:
+                driver.execute_cdp_cmd('Network.clearBrowserCookies', {}) # cookies of all domains, not only current one
+                for origin in origins:
+                    driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin' : origin, 'storageTypes' : 'all'})
+            else:
+                driver.delete_all_cookies()
+                driver.execute_script('window.localStorage.clear(); window.sessionStorage.clear();')
+            driver.get('about:blank')
+        except Exception:
+            return False
+        return True
+    
+    @staticmethod
+    def _getVisitedOrigins(driver):
+        '''
+        Returns origins of all pages in navigation history of current tab (login redirects included)
+        '''
+        history = driver.execute_cdp_cmd('Page.getNavigationHistory', {})
+        origins = set()
+        for entry in history['entries']:
+            parts = urllib.parse.urlsplit(entry['url'])
+            if parts.scheme in ('http', 'https'):
+                origins.add(f'{parts.scheme}://{parts.netloc}')
+        return origins
+    
+    def _needsRecycling(self, driver):
+        if self._uses.get(driver, 0) >= self.maxUses:
+            return True
+        return self.getRssMb(driver) > self.maxRssMb
+    
+    def getRssMb(self, driver):
+        '''
+        Returns memory used by driver service process and all browser processes it started
+        '''
+        if psutil is None:
+            return 0
+        try:
+            process = psutil.Process(driver.service.process.pid)
+            processes = [process] + process.children(recursive = True)
+        except (AttributeError, psutil.Error):
+            return 0
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss / 2**20
     
+    def _quitDriver(self, driver):
+        with self._condition:
+            if driver in self._uses: # driver given back after `shutdown` is not counted anymore
+                del self._uses[driver]
+                self._nDrivers -= 1
+                self._condition.notify()
+        try:
+            driver.quit() # `close()` would leave driver service process running
+        except Exception:
+            pass
+        
+        
+_driverPool = None
+
+def getDriverPool(**poolSettings):
+    '''
+    Returns driver pool of this process. `poolSettings` are passed to `DriverPool`
+    only when pool is created (first call in process)
+    '''
+    global _driverPool
+    if _driverPool is None:
+        _driverPool = DriverPool(**poolSettings)
+        # unlike `atexit`, called also when `multiprocessing` child process exits
+        multiprocessing.util.Finalize(_driverPool, _driverPool.shutdown, exitpriority = 10)
+    return _driverPool
+    
+    
+class LogWriter:
+    '''
+    The only writer of logs. Workers just put records to `recordQueue` (thread or process queue), so they never wait for database.\n
+    Records are written in one transaction (`executemany` per statement) when `maxBatchSize` of them are waiting
+    or `maxDelay` seconds passed since the oldest of them was put. Batch is written again later only if database is busy,
+    `close()` tries `closeTrials` times to write everything put before
+    '''
+    def __init__(self, databasePath, recordQueue = None, maxBatchSize = 200, maxDelay = 2, closeTrials = 5):
+        self.databasePath = databasePath
+        self.queue = recordQueue if recordQueue is not None else queue.Queue()
+        self.maxBatchSize = maxBatchSize
+        self.maxDelay = maxDelay
+        self.closeTrials = closeTrials
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._closing = threading.Event()
+        
+    def start(self):
+        self._thread.start()
+        
+    def put(self, statement, record):
+        self.queue.put((statement, record))
+        
+    def close(self):
+        if self._thread.is_alive():
+            self._closing.set()
+            self.queue.put(None)
+            self._thread.join()
+            
+    def _connect(self):
+        '''
+        Opens connection of writer thread. Switching to WAL needs lock of database, so it is tried again while database is busy
+        (records wait in queue meanwhile), but only `closeTrials` times after `close()` was called.
+        Returns None if database stayed busy
+        '''
+        trials = self.closeTrials
+        while True:
+            db = sqlite3.connect(self.databasePath, timeout = 30)
+            try:
+                db.execute('PRAGMA journal_mode=WAL;') # readers do not block writer and the other way around
+                db.execute('PRAGMA synchronous=NORMAL;') # in WAL mode still safe against corruption, fsync only at checkpoints
+                return db
+            except sqlite3.Error as error:
+                db.close()
+                if not self._isBusy(error):
+                    raise
+                traceback.print_exc()
+            if self._closing.is_set():
+                trials -= 1
+                if not trials:
+                    return None
+            time.sleep(self.maxDelay)
+            
+    def _run(self):
+        db = self._connect()
+        if db is None:
+            nRecords = 0
+            while self.queue.get() is not None:
+                nRecords += 1
+            print(f'{nRecords} log records not written, database is busy', file = sys.stderr)
+            return
+        batch = []
+        flushTime = None
+        closing = False
+        while not closing:
+            try:
+                item = self.queue.get(timeout = None if flushTime is None else max(flushTime - time.monotonic(), 0))
+            except queue.Empty:
+                item = ()
+            if item is None:
+                closing = True
+            elif item:
+                batch.append(item)
+                if flushTime is None:
+                    flushTime = time.monotonic() + self.maxDelay
+            
+            if batch and (closing or len(batch) >= self.maxBatchSize or time.monotonic() >= flushTime):
+                trials = self.closeTrials if closing else 1
+                while True:
+                    batch = self._flush(db, batch)
+                    trials -= 1
+                    if not batch or not trials:
+                        break
+                    time.sleep(self.maxDelay)
+                flushTime = None if not batch else time.monotonic() + self.maxDelay # database is busy, try again later
+        if batch:
+            print(f'{len(batch)} log records not written, database is busy', file = sys.stderr)
+        db.close()
+        
+    def _flush(self, db, batch):
+        '''
+        Writes `batch`, returns records that have to be written later as database is busy (locked).
+        Batch with invalid record is written record by record, invalid ones are reported and dropped
+        '''
+        statements = {} # keys -> statement, values -> records in order they were put
+        for statement, record in batch:
+            statements.setdefault(statement, []).append(record)
+        try:
+            with db:
+                for statement, records in statements.items():
+                    db.executemany(statement, records)
+            return []
+        except sqlite3.Error as error:
+            if self._isBusy(error):
+                traceback.print_exc()
+                return batch
+        for index, (statement, record) in enumerate(batch):
+            try:
+                with db:
+                    db.execute(statement, record)
+            except sqlite3.Error as error:
+                if self._isBusy(error):
+                    traceback.print_exc()
+                    return batch[index:]
+                print(f'Log record {record!r} dropped: {error}', file = sys.stderr)
+        return []
+    
+    @staticmethod
+    def _isBusy(error):
+        '''
+        Tells whether writing failed only because other connection holds the lock, so it may succeed later
+        '''
+        return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+_logWriter = None
+
+def getLogWriter(databasePath):
+    '''
+    Returns started log writer of this process, it is closed (so flushed) when process exits
+    '''
+    global _logWriter
+    if _logWriter is None:
+        _logWriter = LogWriter(databasePath)
+        _logWriter.start()
+        # lower priority than driver pool shutdown, so logs written while quitting drivers are flushed too
+        multiprocessing.util.Finalize(_logWriter, _logWriter.close, exitpriority = 5)
+    return _logWriter
+        
+        
+class LogCompactor:
+    '''
+    Compacts logs of database (see `Database.compactLogs`) on start and then every `interval` seconds,
+    so database does not keep growing while accounts run for weeks. Called from loop of scheduler or supervisor
+    '''
+    def __init__(self, database, retentionDays, interval = 24*3600):
+        self.database = database
+        self.retentionDays = retentionDays
+        self.interval = interval
+        self._nextCompaction = time.time() # wall clock time, interval counts also time of system sleep
+        
+    def isDue(self):
+        return time.time() >= self._nextCompaction
     
+    def compact(self):
+        self.database.compactLogs(self.retentionDays)
+        self._nextCompaction = time.time() + self.interval
+        
+        
+class CircuitBreaker:
+    '''
+    Shared by all accounts of one domain using the same engine (browser or IMAP, they reach different servers)
+    in this process. Counts whole cycles, not steps, as optional steps and pages served during outage succeed anyway:
+    after `failureThreshold` cycles in a row failed (ended by a step that failed all its trials, in any account)
+    it opens and every cycle and step of the domain fails at once with `DomainUnavailable` for `openTime` seconds.
+    Then single cycle is let through as a probe: its success closes the breaker,
+    its failure opens it again for twice as long (up to `maxOpenTime`)
+    '''
+    def __init__(self, domain, engine, failureThreshold = 3, openTime = 60, maxOpenTime = 30*60):
+        self.domain = domain
+        self.engine = engine
+        self.failureThreshold = failureThreshold
+        self.openTime = openTime
+        self.maxOpenTime = maxOpenTime
+        self.nFailures = 0
+        self.openUntil = None # None when closed
+        self.probeThread = None # thread running the probe, its nested steps are let through as well
+        self._nextOpenTime = openTime
+        self._lock = threading.Lock()
+        
+    def allowRequest(self):
+        with self._lock:
+            if self.openUntil is None:
+                return True
+            if self.probeThread is not None:
+                return self.probeThread == threading.get_ident()
+            if time.monotonic() >= self.openUntil:
+                self.probeThread = threading.get_ident()
+                return True
+            return False
+        
+    def recordSuccess(self):
+        with self._lock:
+            self.nFailures = 0
+            self.openUntil = None
+            self.probeThread = None
+            self._nextOpenTime = self.openTime
+            
+    def releaseProbe(self):
+        '''
+        Lets other thread probe, when probe of this thread ended without any step recorded
+        '''
+        with self._lock:
+            if self.probeThread == threading.get_ident():
+                self.probeThread = None
+                
+    def recordFailure(self):
+        with self._lock:
+            self.nFailures += 1
+            if self.probeThread is not None or (self.openUntil is None and self.nFailures >= self.failureThreshold):
+                self.openUntil = time.monotonic() + self._nextOpenTime
+                self._nextOpenTime = min(2*self._nextOpenTime, self.maxOpenTime)
+                self.probeThread = None
+                
+    def getRetryTime(self):
+        '''
+        Returns number of seconds to the next probe (0 when closed)
+        '''
+        with self._lock:
+            return max(self.openUntil - time.monotonic(), 0) if self.openUntil is not None else 0
+
+
+_circuitBreakers = {} # keys -> (domain, engine), values -> CircuitBreaker
+_circuitBreakersLock = threading.Lock()
+
+def getCircuitBreaker(domain, engine):
+    '''
+    Returns circuit breaker of `domain` shared by all accounts using `engine` in this process
+    '''
+    with _circuitBreakersLock:
+        if (domain, engine) not in _circuitBreakers:
+            _circuitBreakers[domain, engine] = CircuitBreaker(domain, engine)
+        return _circuitBreakers[domain, engine]
+        
+        
+def sleepUntil(deadline, tick = 5):
+    '''
+    Sleeps until wall clock time `deadline` (as `time.time()`) in `tick` seconds long sleeps.
+    `time.sleep` does not count time of system sleep, so single long sleep would end too late after resume
+    '''
+    while True:
+        remainingTime = deadline - time.time()
+        if remainingTime <= 0:
+            return
+        time.sleep(min(remainingTime, tick))
+        
+        
+class DomainProfile:
+    '''
+    Everything about domain pages read from database, built once per process and domain data version.\n
+    `elements` values are locator tuples (by, value), ready to be passed to `find_element` or `WebDriverWait` conditions,
+    `candidates` values are lists of locator tuples of element, the one from `elements` first and then fallbacks by rank
+    '''
+    def __init__(self, domain, version, pageAddress, elements, candidates, timeouts, blockedUrls, folders):
+        self.domain = domain
+        self.version = version
+        self.pageAddress = pageAddress
+        self.elements = elements
+        self.candidates = candidates
+        self.timeouts = timeouts
+        self.blockedUrls = blockedUrls
+        self.folders = folders # tab element names in order they are processed
+        
+        
+class AdRateModel:
+    '''
+    Ads arrival rate of account [ads per hour] for every hour of day, exponentially weighted (by `weight`),
+    so recent days count more than old ones. Learned from number of ads deleted in every loop.\n
+    Time interval is chosen so that about `targetAds` ads come in it, within bounds given by user
+    '''
+    def __init__(self, rates = None, updated = None, weight = 0.3, targetAds = 1):
+        self.rates = rates if rates is not None else [None]*24 # None for hours without any loop yet
+        self.updated = updated # time of the last update (`datetime`)
+        self.weight = weight
+        self.targetAds = targetAds
+        
+    def update(self, nDeleted, currentTime):
+        '''
+        Counts `nDeleted` ads deleted at `currentTime` (`datetime`) as came since the last update
+        '''
+        if self.updated is not None and currentTime > self.updated:
+            hours = (currentTime - self.updated).total_seconds()/3600
+            rate = nDeleted/hours
+            previousRate = self.rates[currentTime.hour]
+            self.rates[currentTime.hour] = rate if previousRate is None else previousRate + self.weight*(rate - previousRate)
+        self.updated = currentTime
+        
+    def getTimeInterval(self, currentTime, defaultTimeInterval, minTimeInterval, maxTimeInterval):
+        '''
+        Returns number of seconds to wait for `targetAds` at rate of current or next hour (the higher one, so that burst
+        starting soon is not missed), `defaultTimeInterval` if nothing was learned for them yet
+        '''
+        rates = [rate for rate in (self.rates[currentTime.hour], self.rates[(currentTime.hour + 1)%24]) if rate is not None]
+        if not rates:
+            return defaultTimeInterval
+        rate = max(rates)
+        timeInterval = self.targetAds/rate*3600 if rate > 0 else maxTimeInterval
+        timeInterval = round(timeInterval/60)*60 # whole minutes, so runs stay aligned (see `Common.getSleepTime`)
+        return min(max(timeInterval, minTimeInterval), maxTimeInterval)
+        
+        
+class AdClassifier:
+    '''
+    All ad rules of one account (rules of its domain and its own ones) compiled into one regular expression per field,
+    so message is checked against all rules in one pass, whatever their number is.\n
+    Rules are (field, kind, pattern), `field` is one of `fields`, `kind` is one of `kinds`.
+    Built once per process and rules version (changed by triggers on `adRules` table)
+    '''
+    fields = ['sender', 'subject']
+    kinds = ['suffix', 'prefix', 'substring', 'regex']
+    _groupReference = re.compile(r'\(\?P[<=>]|\(\?\(|(?<!\\)(?:\\\\)*\\(?:[1-9]|g<)') # (?P<name>, (?P=name), (?(1)...), \1, \g<...> not escaped by \\
+    
+    def __init__(self, version, rules):
+        self.version = version
+        self.rules = rules
+        self._matchers = {field : self._compile(field) for field in self.fields}
+        
+    def isAd(self, sender, subject = ''):
+        return self.getMatchingRule(sender, subject) is not None
+    
+    def classify(self, messages):
+        '''
+        Returns list of bools (True for ad) for `messages` (sender, subject)
+        '''
+        return [self.isAd(sender, subject) for sender, subject in messages]
+    
+    def getMatchingRule(self, sender, subject = ''):
+        '''
+        Returns index (in `rules`) of rule that matched message or None if it is not an ad
+        '''
+        for field, text in (('sender', sender), ('subject', subject)):
+            matcher = self._matchers[field]
+            if matcher is None or not text:
+                continue
+            match = matcher.search(text)
+            if match is not None:
+                return int(match.lastgroup[1:])
+        return None
+    
+    def getSearchTerms(self):
+        '''
+        Returns (field, text) of all rules if message containing any text in its field may be an ad
+        or None if there is regex rule (it can not be checked by IMAP server)
+        '''
+        if any(kind == 'regex' for _, kind, _ in self.rules):
+            return None
+        return [(field, pattern) for field, _, pattern in self.rules]
+        
+    def _compile(self, field):
+        alternatives = []
+        for index, (ruleField, kind, pattern) in enumerate(self.rules):
+            if ruleField != field:
+                continue
+            try:
+                expression = self.getExpression(kind, pattern)
+            except (re.error, ValueError) as error:
+                # rule added by hand, it must not stop other rules from working
+                print(f'Ad rule {kind} {pattern!r} skipped: {error}', file = sys.stderr)
+                continue
+            alternatives.append(f'(?P<r{index}>{expression})') # group name tells which rule matched
+        try:
+            return re.compile('|'.join(alternatives)) if alternatives else None
+        except re.error:
+            pass
+        # some rule is valid alone, but not as part of bigger expression, only rules that compile together are kept
+        kept = []
+        for alternative in alternatives:
+            try:
+                re.compile('|'.join(kept + [alternative]))
+            except re.error as error:
+                print(f'Ad rule {alternative!r} skipped: {error}', file = sys.stderr)
+                continue
+            kept.append(alternative)
+        return re.compile('|'.join(kept)) if kept else None
+    
+    @classmethod
+    def getExpression(cls, kind, pattern):
+        '''
+        Returns regular expression matching the same texts as rule. Raises `ValueError` or `re.error` for invalid rule
+        '''
+        if kind == 'suffix':
+            return re.escape(pattern) + r'\Z'
+        if kind == 'prefix':
+            return r'\A' + re.escape(pattern)
+        if kind == 'substring':
+            return re.escape(pattern)
+        if kind == 'regex':
+            if cls._groupReference.search(pattern):
+                # group names and numbers change when rule becomes part of bigger expression
+                raise ValueError(f'Named groups and backreferences are not allowed in ad rule: {pattern}')
+            expression = f'(?:{pattern})'
+            re.compile(expression) # flags like `(?i)` have to be scoped, `(?i:...)`, as rule is part of bigger expression
+            return expression
+        raise ValueError(f'Unknown ad rule kind: {kind}')
+
+
+_domainProfiles = {} # keys -> domain, values -> DomainProfile
+_adClassifiers = {} # keys -> (domain, user name), values -> AdClassifier
+_databasePaths = {} # keys -> (process id, database name), values -> database path in user data directory
+_connections = {} # keys -> (process id, database path), values -> (connection, lock guarding it)
+_databaseLock = threading.Lock()
+
+def _getDatabasePath(databaseSetup):
+    '''
+    Finds (copying preinited database if needed) and updates database only once per process
+    '''
+    key = (os.getpid(), databaseSetup._name)
+    with _databaseLock:
+        if key not in _databasePaths:
+            databasePath = databaseSetup.getDatabasePath()
+            databaseSetup.update()
+            _databasePaths[key] = databasePath
+        return _databasePaths[key]
+
+def _getConnection(databasePath):
+    '''
+    Returns connection shared by all `Database` objects and threads of this process.
+    Process id is part of the key, so forked process does not use connection of its parent
+    '''
+    key = (os.getpid(), databasePath)
+    with _databaseLock:
+        if key not in _connections:
+            _connections[key] = (sqlite3.connect(databasePath, timeout = 30, check_same_thread = False), threading.RLock())
+        return _connections[key]
+        
+        
 class Database:
-    def __init__(self, databaseName = 'database.sqlite'):
+    def __init__(self, databaseName = 'database.sqlite', logQueue = None):
+        '''
+        `logQueue` is queue of `LogWriter` running in other process. If not given, log writer of this process is used
+        '''
         self.name = databaseName
+        self.logQueue = logQueue
         self._config = DatabaseSetup(self.name)
-        self._config.update()
-        self.fullPath = self._config.getDatabasePath()
-        self.db = sqlite3.connect(self.fullPath)
+        self.fullPath = _getDatabasePath(self._config)
+        self.db, self._lock = _getConnection(self.fullPath)
     
     def getUsers(self):
-        with self.db:
-            query = self.db.execute('SELECT * FROM users;')
-        return query.fetchall()
+        with self._lock, self.db:
+            return self.db.execute('SELECT * FROM users;').fetchall()
             
-    def newUser(self, userName, password, domain, timeInterval):
-        dbRecord = (userName, password, domain, timeInterval)
-        with self.db:
-            self.db.execute('INSERT INTO users(userName, password, domain, timeInterval) VALUES(?,?,?,?);', dbRecord)
+    def newUser(self, userName, password, domain, timeInterval, engine = 'browser', minTimeInterval = None, maxTimeInterval = None):
+        dbRecord = (userName, password, domain, timeInterval, engine, minTimeInterval, maxTimeInterval)
+        with self._lock, self.db:
+            self.db.execute('INSERT INTO users(userName, password, domain, timeInterval, engine, minTimeInterval, maxTimeInterval) VALUES(?,?,?,?,?,?,?);', dbRecord)
             
-    def writeLog(self, userLogin, loopIndex, nDeletedMessages = None, info = None):
+    def writeLog(self, userLogin, loopIndex, nDeletedMessages = None, info = None, domain = ''):
         if info is None:
             info = 'Done'
         error = info != 'Done'
-        currentTime = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-        with self.db:
-            if error:
-                dbRecord = (userLogin, loopIndex, error, info, currentTime)
-                self.db.execute('INSERT INTO logs(userName, loop_id, error, info, date) VALUES(?,?,?,?,?);', dbRecord)
-            else:
-                dbRecord = (userLogin, loopIndex, error, info, nDeletedMessages, currentTime)
-                self.db.execute('INSERT INTO logs(userName, loop_id, error, info, deleted, date) VALUES(?,?,?,?,?,?);', dbRecord)
+        currentTime = datetime.datetime.now().isoformat(timespec = 'seconds')
+        dbRecord = (userLogin, loopIndex, error, info, None if error else nDeletedMessages, currentTime, domain)
+        self._putLog('INSERT INTO logs(userName, loop_id, error, info, deleted, date, domain) VALUES(?,?,?,?,?,?,?);', dbRecord)
+        
+    def compactLogs(self, days):
+        '''
+        Deletes logs, hourly rollups and step timings older than `days` days, daily rollups are kept.
+        Deleted by log writer, so it does not wait for database
+        '''
+        since = (datetime.datetime.now() - datetime.timedelta(days = days)).isoformat(timespec = 'seconds')
+        self._putLog('DELETE FROM logs WHERE date < ?;', (since,))
+        self._putLog("DELETE FROM logRollups WHERE period = 'hour' AND start < ?;", (since,))
+        self._putLog('DELETE FROM timings WHERE date < ?;', (since,))
+        
+    def getUserStats(self, sinceDate = None):
+        '''
+        Returns {(domain, user name) : (loops, errors, deleted ads)} since `sinceDate` (datetime, all if None), see `_getStats`
+        '''
+        return self._getStats('domain, userName', sinceDate)
+    
+    def getDomainStats(self, sinceDate = None):
+        '''
+        Returns {domain : (loops, errors, deleted ads)} since `sinceDate` (datetime, all if None), see `_getStats`
+        '''
+        return {domain : stats for (domain,), stats in self._getStats('domain', sinceDate).items()}
+        
+    def _getStats(self, columns, sinceDate):
+        '''
+        Sums rollups instead of logs: daily ones for whole days and hourly ones for the first day (from hour of `sinceDate`).
+        First day is not counted if its hourly rollups were compacted already
+        '''
+        if sinceDate is None:
+            sinceHour, nextDay = '', ''
+        else:
+            sinceHour = sinceDate.replace(minute = 0, second = 0, microsecond = 0).isoformat(timespec = 'seconds')
+            nextDay = (sinceDate.date() + datetime.timedelta(days = 1)).isoformat()
+        with self._lock, self.db:
+            query = self.db.execute(f'''SELECT {columns}, sum(loops), sum(errors), sum(deleted) FROM logRollups
+                                        WHERE (period = 'day' AND start >= ?) OR (period = 'hour' AND start >= ? AND start < ?)
+                                        GROUP BY {columns} ORDER BY {columns};''', [nextDay, sinceHour, nextDay]).fetchall()
+        return {tuple(row[:-3]) : tuple(row[-3:]) for row in query}
+        
+    def writeTiming(self, userLogin, domain, step, attempts, seconds, outcome):
+        currentTime = datetime.datetime.now().isoformat(timespec = 'seconds')
+        dbRecord = (userLogin, domain, step, attempts, seconds, outcome, currentTime)
+        self._putLog('INSERT INTO timings(userName, domain, step, attempts, seconds, outcome, date) VALUES(?,?,?,?,?,?,?);', dbRecord)
+        
+    def getTimings(self, sinceDate = None):
+        '''
+        Returns {(domain, step) : [seconds, ...]} sorted ascending and {(domain, step) : number of errors}
+        for steps finished after `sinceDate` (datetime, all if None)
+        '''
+        since = sinceDate.isoformat(timespec = 'seconds') if sinceDate is not None else ''
+        with self._lock, self.db:
+            query = self.db.execute('SELECT domain, step, seconds, outcome FROM timings WHERE date >= ? ORDER BY seconds;', [since]).fetchall()
+        timings = {}
+        errors = {}
+        for domain, step, seconds, outcome in query:
+            timings.setdefault((domain, step), []).append(seconds)
+            errors[(domain, step)] = errors.get((domain, step), 0) + (outcome != 'ok')
+        return timings, errors
+        
+    def _putLog(self, statement, record):
+        if self.logQueue is not None:
+            self.logQueue.put((statement, record))
+        else:
+            getLogWriter(self.fullPath).put(statement, record)
+                        
+    def getSession(self, userName, domain):
+        '''
+        Returns (address, cookies, localStorage) saved by `saveSession` or None
+        '''
+        with self._lock, self.db:
+            session = self.db.execute('SELECT address, cookies, localStorage FROM sessions WHERE userName = ? AND domain = ?', [userName, domain]).fetchone()
+        if session is None:
+            return None
+        address, cookies, localStorage = session
+        return address, json.loads(cookies), json.loads(localStorage)
+    
+    def saveSession(self, userName, domain, address, cookies, localStorage):
+        currentTime = datetime.datetime.now().isoformat(timespec = 'seconds')
+        dbRecord = (userName, domain, address, json.dumps(cookies), json.dumps(localStorage), currentTime)
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO sessions(userName, domain, address, cookies, localStorage, date) VALUES(?,?,?,?,?,?);', dbRecord)
+            
+    def deleteSession(self, userName, domain):
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM sessions WHERE userName = ? AND domain = ?', [userName, domain])
+                        
+    def getAdRateModel(self, userName, domain):
+        '''
+        Returns model saved by `saveAdRateModel` or, if there is none, model learned from `logs` of user
+        '''
+        with self._lock, self.db:
+            model = self.db.execute('SELECT rates, updated FROM adRateModels WHERE userName = ? AND domain = ?', [userName, domain]).fetchone()
+        if model is not None:
+            rates, updated = model
+            return AdRateModel(json.loads(rates), datetime.datetime.fromisoformat(updated))
+        
+        with self._lock, self.db:
+            # the newest logs, without errors (they have no number of deleted messages)
+            logs = self.db.execute('''SELECT deleted, date FROM (SELECT log_id, deleted, date FROM logs WHERE userName = ? AND error = 0
+                                                               ORDER BY log_id DESC LIMIT 5000)
+                                      ORDER BY log_id;''', [userName]).fetchall()
+        model = AdRateModel()
+        for deleted, date in logs:
+            model.update(deleted or 0, datetime.datetime.fromisoformat(date))
+        return model
+    
+    def saveAdRateModel(self, userName, domain, model):
+        dbRecord = (userName, domain, json.dumps(model.rates), model.updated.isoformat(timespec = 'seconds'))
+        self._putLog('INSERT OR REPLACE INTO adRateModels(userName, domain, rates, updated) VALUES(?,?,?,?);', dbRecord)
+        
+    def saveWorkerStatus(self, statuses):
+        '''
+        Saves statuses returned by `ProcessSupervisor.getStatus`
+        '''
+        currentTime = datetime.datetime.now().isoformat(timespec = 'seconds')
+        for status in statuses:
+            dbRecord = (status['userName'], status['domain'], status['pid'], status['state'], status['restarts'],
+                        status['rssMb'], status['lastExitCode'], status['nextStart'], currentTime)
+            self._putLog('INSERT OR REPLACE INTO workerStatus VALUES(?,?,?,?,?,?,?,?,?);', dbRecord)
+            
+    def getWorkerStatus(self):
+        '''
+        Returns (userName, domain, pid, state, restarts, rssMb, lastExitCode, nextStart, updated) of every worker
+        '''
+        with self._lock, self.db:
+            return self.db.execute('SELECT * FROM workerStatus ORDER BY domain, userName;').fetchall()
+        
+    def claimLeases(self, host, capacity, leaseTime, running = ()):
+        '''
+        Renews leases of `host` for `leaseTime` seconds and balances accounts between live hosts (ones with heartbeat
+        within `leaseTime`): accounts are split evenly, but never more than `capacity` of host, so what small hosts
+        can not take goes to hosts with spare room (see `getLeaseShares`).
+        Host owning more than its share stops renewing the rest, so they are taken over by other hosts only when they expire,
+        and leases of `running` (userName, domain) accounts are renewed above share till their cycles end.
+        Host owning less claims accounts without lease or with expired one.
+        Times are UTC, as hosts may be in different time zones.\n
+        Returns set of (userName, domain) owned by `host`
+        '''
+        now = datetime.datetime.now(datetime.timezone.utc)
+        currentTime = now.isoformat(timespec = 'seconds')
+        expires = (now + datetime.timedelta(seconds = leaseTime)).isoformat(timespec = 'seconds')
+        deadTime = (now - datetime.timedelta(seconds = leaseTime)).isoformat(timespec = 'seconds')
+        running = set(running)
+        with self._lock, self.db:
+            # writing first locks database till commit, so hosts balance one after another
+            self.db.execute('INSERT OR REPLACE INTO hosts(host, capacity, heartbeat) VALUES(?,?,?);', [host, capacity, currentTime])
+            self.db.execute('DELETE FROM hosts WHERE heartbeat < ?;', [deadTime])
+            capacities = dict(self.db.execute('SELECT host, capacity FROM hosts;').fetchall())
+            accounts = self.db.execute('SELECT DISTINCT userName, domain FROM users ORDER BY userName, domain;').fetchall()
+            share = self.getLeaseShares(len(accounts), capacities)[host]
+            
+            leases = self.db.execute('SELECT userName, domain, expires FROM leases WHERE host = ? ORDER BY userName, domain;', [host]).fetchall()
+            owned = [(userName, domain) for userName, domain, leaseExpires in leases
+                     if leaseExpires >= currentTime or (userName, domain) in running]
+            # running accounts are kept first, extra ones are not renewed and expire
+            owned.sort(key = lambda account: account not in running)
+            owned = owned[:max(share, len(running.intersection(owned)))]
+            self.db.executemany('UPDATE leases SET expires = ? WHERE userName = ? AND domain = ?;',
+                                [(expires, userName, domain) for userName, domain in owned])
+            if len(owned) < share:
+                free = self.db.execute('''SELECT DISTINCT userName, domain FROM users WHERE NOT EXISTS
+                                          (SELECT 1 FROM leases WHERE leases.userName = users.userName AND leases.domain = users.domain AND expires >= ?)
+                                          ORDER BY userName, domain LIMIT ?;''', [currentTime, share - len(owned)]).fetchall()
+                self.db.executemany('INSERT OR REPLACE INTO leases(userName, domain, host, expires) VALUES(?,?,?,?);',
+                                    [(userName, domain, host, expires) for userName, domain in free])
+                owned += free
+        return set(owned)
+    
+    @staticmethod
+    def getLeaseShares(nAccounts, capacities):
+        '''
+        Returns {host : most accounts it may own} for `capacities` {host : capacity}.
+        Hosts are filled from the smallest: each gets even part of accounts left, limited by its capacity
+        '''
+        shares = {}
+        left = nAccounts
+        hosts = sorted(capacities, key = lambda host: (capacities[host], host))
+        for index, host in enumerate(hosts):
+            shares[host] = min(capacities[host], math.ceil(left/(len(hosts) - index)))
+            left = max(left - shares[host], 0)
+        return shares
+    
+    def releaseLeases(self, host):
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM leases WHERE host = ?;', [host])
+            self.db.execute('DELETE FROM hosts WHERE host = ?;', [host])
+        
+    def getHighWaterMark(self, userName, domain, folder):
+        '''
+        Returns (rule, rowKeys) saved by `saveHighWaterMark` or None
+        '''
+        with self._lock, self.db:
+            mark = self.db.execute('SELECT rule, rowKeys FROM highWaterMarks WHERE userName = ? AND domain = ? AND folder = ?',
+                                   [userName, domain, folder]).fetchone()
+        if mark is None:
+            return None
+        rule, rowKeys = mark
+        return rule, json.loads(rowKeys)
+    
+    def saveHighWaterMark(self, userName, domain, folder, rule, rowKeys):
+        currentTime = datetime.datetime.now().isoformat(timespec = 'seconds')
+        dbRecord = (userName, domain, folder, rule, json.dumps(rowKeys), currentTime)
+        with self._lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO highWaterMarks(userName, domain, folder, rule, rowKeys, date) VALUES(?,?,?,?,?,?);', dbRecord)
+                        
+    def getDomainProfile(self, domain):
+        '''
+        Returns cached profile of domain, it is built again only after domain data was synced to new version
+        '''
+        version = self.getDomainDataVersion()
+        with _databaseLock:
+            profile = _domainProfiles.get(domain)
+        if profile is not None and profile.version == version:
+            return profile
+        
+        elements = {name : (info['by'], info['value']) for name, info in self.getElements(domain).items()}
+        candidates = {name : [locator] + self.getElementCandidates(domain).get(name, []) for name, locator in elements.items()}
+        profile = DomainProfile(domain, version, self.getPageAddress(domain), elements, candidates, self.getTimeouts(domain),
+                                self.getBlockedUrls(domain), self.getFolders(domain))
+        with _databaseLock:
+            _domainProfiles[domain] = profile
+        return profile
+    
+    def getDomainDataVersion(self):
+        with self._lock, self.db:
+            return self._config.getSyncedVersion(self.db)
+        
+    def getAdClassifier(self, domain, userName):
+        '''
+        Returns cached classifier of rules of `domain` and `userName`, it is compiled again only after any rule changed
+        '''
+        version = self.getAdRulesVersion()
+        with _databaseLock:
+            classifier = _adClassifiers.get((domain, userName))
+        if classifier is not None and classifier.version == version:
+            return classifier
+        
+        classifier = AdClassifier(version, self.getAdRules(domain, userName))
+        with _databaseLock:
+            _adClassifiers[(domain, userName)] = classifier
+        return classifier
+        
+    def getAdRulesVersion(self):
+        with self._lock, self.db:
+            version = self.db.execute("SELECT value FROM meta WHERE key = 'adRulesVersion';").fetchone()
+        return str(version[0]) if version is not None else '0'
+    
+    def getAdRules(self, domain, userName):
+        '''
+        Returns (field, kind, pattern) of rules of `domain` (for all its users) and of `userName`
+        '''
+        with self._lock, self.db:
+            query = self.db.execute("SELECT field, kind, pattern FROM adRules WHERE domain = ? AND userName IN ('', ?) ORDER BY rowid",
+                                    [domain, userName]).fetchall()
+        return query
+    
+    def addAdRule(self, domain, field, kind, pattern, userName = None):
+        '''
+        Adds rule for all users of `domain` (`userName` is None) or for single user of `domain`.
+        Raises `ValueError` or `re.error` for invalid rule
+        '''
+        if field not in AdClassifier.fields:
+            raise ValueError(f'Unknown ad rule field: {field}')
+        AdClassifier.getExpression(kind, pattern)
+        with self._lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO adRules(domain, userName, field, kind, pattern) VALUES(?,?,?,?,?);',
+                            [domain, userName or '', field, kind, pattern])
                         
     def getPageAddress(self, domain):
-        with self.db:
-            query = self.db.execute('SELECT pageAddress FROM domainAddress WHERE domain == ?', [domain])
-        return query.fetchall()[0][0]
+        with self._lock, self.db:
+            query = self.db.execute('SELECT pageAddress FROM domainAddress WHERE domain == ?', [domain]).fetchall()
+        return query[0][0]
     
     def getElements(self, domain):
-        with self.db:
-            query = self.db.execute('SELECT elementName, by, value FROM domainElements WHERE domain = ?', [domain])
-        return {item[0] : {'by' : item[1], 'value': item[2]} for item in query.fetchall()}
+        with self._lock, self.db:
+            query = self.db.execute('SELECT elementName, by, value FROM domainElements WHERE domain = ?', [domain]).fetchall()
+        return {item[0] : {'by' : item[1], 'value': item[2]} for item in query}
+    
+    def getElementCandidates(self, domain):
+        '''
+        Returns {element name : [(by, value), ...]} of fallback locators ordered by rank
+        '''
+        with self._lock, self.db:
+            query = self.db.execute('SELECT elementName, by, value FROM domainElementCandidates WHERE domain = ? ORDER BY rank', [domain]).fetchall()
+        candidates = {}
+        for name, by, value in query:
+            candidates.setdefault(name, []).append((by, value))
+        return candidates
+    
+    def getSelectorStats(self, userName, domain):
+        '''
+        Returns {(element name, by, value) : [hits, misses, seconds]} of lookups of account
+        '''
+        with self._lock, self.db:
+            query = self.db.execute('SELECT elementName, by, value, hits, misses, seconds FROM selectorStats WHERE userName = ? AND domain = ?',
+                                    [userName, domain]).fetchall()
+        return {(name, by, value) : [hits, misses, seconds] for name, by, value, hits, misses, seconds in query}
+    
+    def addSelectorStats(self, userName, domain, stats):
+        '''
+        Adds `stats` (the same form as returned by `getSelectorStats`) to stats of account
+        '''
+        for (name, by, value), (hits, misses, seconds) in stats.items():
+            self._putLog('''INSERT INTO selectorStats VALUES(?,?,?,?,?,?,?,?) ON CONFLICT (userName, domain, elementName, by, value) DO UPDATE
+                            SET hits = hits + excluded.hits, misses = misses + excluded.misses, seconds = seconds + excluded.seconds;''',
+                         (userName, domain, name, by, value, hits, misses, seconds))
+    
+    def getBlockedUrls(self, domain):
+        with self._lock, self.db:
+            query = self.db.execute('SELECT pattern FROM domainBlockedUrls WHERE domain = ?', [domain]).fetchall()
+        return [item[0] for item in query]
+    
+    def getFolders(self, domain):
+        with self._lock, self.db:
+            query = self.db.execute('SELECT tabName FROM domainFolders WHERE domain = ? ORDER BY position', [domain]).fetchall()
+        return [item[0] for item in query]
+    
+    def getImapInfo(self, domain):
+        with self._lock, self.db:
+            server = self.db.execute('SELECT host, port, loginSuffix FROM domainImap WHERE domain = ?', [domain]).fetchone()
+            folders = self.db.execute('SELECT folder FROM domainImapFolders WHERE domain = ?', [domain]).fetchall()
+        return {'host' : server[0], 'port' : server[1], 'loginSuffix' : server[2], 'folders' : [folder[0] for folder in folders]}
+    
+    def getTimeouts(self, domain):
+        with self._lock, self.db:
+            query = self.db.execute('SELECT timeoutName, seconds FROM domainTimeouts WHERE domain = ?', [domain]).fetchall()
+        return dict(query)
 
 
 class NoSuccessInNTrials(Exception):
     '''
     Cast in `Common._errorHandler` when no success in `nTrials`.
     Catch in derived class to go to sleep for `sleepTime`
-    '''
\ No newline at end of file
+    '''
+    
+    
+class DomainUnavailable(NoSuccessInNTrials):
+    '''
+    Cast in `Common._errorHandler` instead of trying, when circuit breaker of the domain is open.
+    Caught wherever `NoSuccessInNTrials` is
+    '''
@@ -0,0 +1,189 @@
+import datetime
+import multiprocessing
+import signal
+import time
+
+try:
+    import psutil
+except ImportError:
+    # without psutil workers are only restarted after crash, memory is not checked
+    psutil = None
+
+
+
+def runWorker(account, spawnTime):
+    '''
+    Target of worker process: stores time it took process to start (`workerStart` timing) and runs account.
+    SIGTERM makes worker exit gracefully (see `stopWorker`)
+    '''
+    signal.signal(signal.SIGTERM, stopWorker)
+    account.openDatabase().writeTiming(account.userLogin, account.domain, 'workerStart', 1, time.time() - spawnTime, 'ok')
+    account.run()
+
+
+def stopWorker(signalNumber, frame):
+    '''
+    SIGTERM handler of worker: exits like `sys.exit()` does, so finalizers quit its drivers and flush logs it put
+    to the queue shared with other workers, instead of leaving it in the middle of a write.
+    Main process of scheduler and supervisor uses it as well, so its `finally` blocks and finalizers run on normal stop
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_IGN) # finalizers are not interrupted by the next one
+    raise SystemExit()
+
+
+class WorkerState:
+    '''
+    Process of one account and its restart history
+    '''
+    def __init__(self, account):
+        self.account = account
+        self.process = None
+        self.state = 'waiting' # 'running', 'waiting' (for restart) or 'stopped'
+        self.restarts = 0
+        self.crashes = 0 # in a row, reset when process runs longer than `stableTime` of supervisor
+        self.startTime = None
+        self.nextStart = time.time()
+        self.lastExitCode = None
+        self.rssMb = 0
+
+
+class ProcessSupervisor:
+    '''
+    Runs every account in its own process and keeps it running.\n
+    Every `checkInterval` seconds checks whether worker processes are alive and how much memory they use
+    together with their children (driver service and browser processes).
+    Worker that exited (accounts run forever, so any exit is a crash) is started again after backoff
+    doubled with every crash in a row (from `minBackoff` up to `maxBackoff` seconds).
+    Worker using more than `maxRssMb` is recycled: it is stopped (see `_terminate`) and started again at once.\n
+    Status of all workers is saved to `workerStatus` table after every check (see `adsOnMail.py status`),
+    old logs are compacted by `logCompactor` (if given) when it is due.\n
+    Processes are made by `context` (`multiprocessing` context or module)
+    '''
+    def __init__(self, accounts, database, maxRssMb = 1500, checkInterval = 10, minBackoff = 5, maxBackoff = 15*60, stableTime = 10*60,
+                 context = multiprocessing, logCompactor = None):
+        self.workers = [WorkerState(account) for account in accounts]
+        self.context = context
+        self.database = database
+        self.logCompactor = logCompactor
+        self.maxRssMb = maxRssMb
+        self.checkInterval = checkInterval
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.stableTime = stableTime
+
+    def run(self):
+        try:
+            while True:
+                self.check()
+                time.sleep(self.checkInterval)
+        finally:
+            self.shutdown()
+
+    def check(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.state == 'running' and not worker.process.is_alive():
+                self._onExit(worker, now)
+            elif worker.state == 'running':
+                worker.rssMb = self._getRssMb(worker.process)
+                if self.maxRssMb is not None and worker.rssMb > self.maxRssMb:
+                    self._terminate(worker.process)
+                    worker.state = 'waiting'
+                    worker.nextStart = now
+                    worker.lastExitCode = worker.process.exitcode
+            if worker.state == 'waiting' and worker.nextStart <= now:
+                self._start(worker, now)
+        self.database.saveWorkerStatus(self.getStatus())
+        if self.logCompactor is not None and self.logCompactor.isDue():
+            self.logCompactor.compact()
+
+    def getStatus(self):
+        '''
+        Returns dict per worker with its user name, domain, pid, state, number of restarts, memory [MB],
+        exit code of the last process and time of the next start (only when waiting)
+        '''
+        return [{'userName' : worker.account.userLogin,
+                 'domain' : worker.account.domain,
+                 'pid' : worker.process.pid if worker.process is not None else None,
+                 'state' : worker.state,
+                 'restarts' : worker.restarts,
+                 'rssMb' : round(worker.rssMb),
+                 'lastExitCode' : worker.lastExitCode,
+                 'nextStart' : (datetime.datetime.fromtimestamp(worker.nextStart).isoformat(timespec = 'seconds')
+                                if worker.state == 'waiting' else None)}
+                for worker in self.workers]
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                self._terminate(worker.process)
+            worker.state = 'stopped'
+        self.database.saveWorkerStatus(self.getStatus())
+
+    def _start(self, worker, now):
+        if worker.process is not None:
+            worker.restarts += 1
+        worker.process = self.context.Process(target = runWorker, args = (worker.account, time.time()))
+        worker.process.start()
+        # account is copied to process by `start`, so only the first process of it stores `firstCycle` timing
+        worker.account.startupTime = None
+        worker.state = 'running'
+        worker.startTime = now
+        worker.rssMb = 0
+
+    def _onExit(self, worker, now):
+        worker.lastExitCode = worker.process.exitcode
+        worker.rssMb = 0
+        if now - worker.startTime > self.stableTime:
+            worker.crashes = 0
+        worker.crashes += 1
+        worker.state = 'waiting'
+        worker.nextStart = now + min(self.minBackoff * 2**(worker.crashes - 1), self.maxBackoff)
+
+    def _getRssMb(self, process):
+        '''
+        Returns memory used by worker process and all processes it started
+        '''
+        if psutil is None:
+            return 0
+        rss = 0
+        for child in self._getProcessTree(process):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss / 2**20
+
+    def _getProcessTree(self, process):
+        try:
+            parent = psutil.Process(process.pid)
+            return [parent] + parent.children(recursive = True)
+        except psutil.Error:
+            return []
+
+    def _terminate(self, process, timeout = 10, stopTimeout = 30):
+        '''
+        Stops worker and its children, which would be left running if worker exited without quitting its drivers.\n
+        Worker is asked to stop first (SIGTERM, handled by `stopWorker`) and given `stopTimeout` seconds to quit drivers
+        and flush logs. Only then it is killed, as killing it while it writes to the log queue would corrupt the queue.
+        On Windows `terminate` can not be handled, so worker is killed at once
+        '''
+        children = self._getProcessTree(process)[1:] if psutil is not None else []
+        process.terminate()
+        process.join(stopTimeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        children = [child for child in children if child.is_running()]
+        for child in children:
+            try:
+                child.terminate()
+            except psutil.Error:
+                pass
+        if children:
+            _, alive = psutil.wait_procs(children, timeout = timeout)
+            for child in alive:
+                try:
+                    child.kill()
+                except psutil.Error:
+                    pass
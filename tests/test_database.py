@@ -0,0 +1,249 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from setups import Database, DatabaseSetup, LogWriter, _getConnection
+
+
+
+def makeBundledDatabase(directory):
+    '''
+    Builds database shipped with program (`initDatabase.py`) in `directory`, returns its path
+    '''
+    subprocess.run([sys.executable, os.path.join(ROOT, 'initDatabase.py')], cwd = directory, check = True)
+    return os.path.join(directory, 'database.sqlite')
+
+
+class LocalDatabaseSetup(DatabaseSetup):
+    '''
+    Syncs database in user data directory at `uddPath` with bundled database at `fromPath`
+    '''
+    def __init__(self, fromPath, uddPath):
+        DatabaseSetup.__init__(self, 'database.sqlite')
+        self._fromPath = fromPath
+        self._uddPath = uddPath
+
+    def _runningAsExe(self):
+        return False
+
+    def _getDatabasePathFromSourceCodeLoaction(self):
+        return self._fromPath
+
+    def _getDatabasePathFromUserDataDir(self):
+        return self._uddPath
+
+
+def openDatabase(path, ownConnection = False):
+    '''
+    Returns `Database` using file at `path`, without looking for it in user data directory.
+    With `ownConnection` it does not share connection of this process, as `Database` of other host would not
+    '''
+    database = Database.__new__(Database)
+    database.name = os.path.basename(path)
+    database.logQueue = None
+    database._config = None
+    database.fullPath = path
+    if ownConnection:
+        database.db, database._lock = sqlite3.connect(path, timeout = 30, check_same_thread = False), threading.RLock()
+    else:
+        database.db, database._lock = _getConnection(path)
+    return database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fromPath = makeBundledDatabase(self.directory)
+        self.uddPath = os.path.join(self.directory, 'udd.sqlite')
+        shutil.copyfile(self.fromPath, self.uddPath)
+        self.setup = LocalDatabaseSetup(self.fromPath, self.uddPath)
+        self.setup.update()
+        self.database = openDatabase(self.uddPath)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def changeBundle(self, *statements):
+        bundle = sqlite3.connect(self.fromPath)
+        with bundle:
+            for statement in statements:
+                bundle.execute(statement)
+        bundle.close()
+
+
+class AdRulesSyncTest(DatabaseTestCase):
+    def testUserDomainRuleSurvivesNewBundle(self):
+        self.database.addAdRule('wp', 'subject', 'substring', 'PROMO')
+        self.changeBundle("INSERT INTO adRules VALUES ('wp', '', 'sender', 'prefix', 'Shop', 1);")
+        self.setup.update()
+        self.assertEqual(sorted(self.database.getAdRules('wp', 'user')),
+                         [('sender', 'prefix', 'Shop'), ('sender', 'suffix', '/WP'), ('subject', 'substring', 'PROMO')])
+
+    def testRuleDroppedFromBundleIsDeleted(self):
+        self.database.addAdRule('wp', 'subject', 'substring', 'PROMO')
+        self.changeBundle("DELETE FROM adRules WHERE domain = 'wp';")
+        self.setup.update()
+        self.assertEqual(self.database.getAdRules('wp', 'user'), [('subject', 'substring', 'PROMO')])
+
+    def testRulesOfDatabaseWithoutBundledColumnAreKept(self):
+        self.database.db.execute('ALTER TABLE adRules DROP COLUMN bundled;')
+        self.database.db.execute("DELETE FROM meta WHERE key = 'domainDataVersion';")
+        self.database.db.execute("INSERT INTO adRules VALUES ('wp', '', 'subject', 'substring', 'PROMO');")
+        self.database.db.commit()
+        self.setup.update()
+        self.changeBundle("DELETE FROM adRules WHERE domain = 'wp';")
+        self.setup.update()
+        self.assertEqual(self.database.getAdRules('wp', 'user'), [('subject', 'substring', 'PROMO')])
+
+
+class LeasesTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        for index in range(6):
+            self.database.newUser(f'user{index}', 'password', 'wp', 600)
+        self.hosts = {host : openDatabase(self.uddPath, ownConnection = True) for host in ['a', 'b', 'c']}
+
+    def tearDown(self):
+        for database in self.hosts.values():
+            database.db.close()
+        DatabaseTestCase.tearDown(self)
+
+    def getLeaseOwners(self):
+        with self.database._lock, self.database.db:
+            return dict(((userName, domain), host) for userName, domain, host
+                        in self.database.db.execute('SELECT userName, domain, host FROM leases WHERE expires >= ?;', [self.now()]))
+
+    def now(self):
+        return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec = 'seconds')
+
+    def testSharesAreEvenUpToCapacity(self):
+        self.assertEqual(Database.getLeaseShares(6, {'a' : 10, 'b' : 10, 'c' : 10}), {'a' : 2, 'b' : 2, 'c' : 2})
+        self.assertEqual(Database.getLeaseShares(7, {'a' : 10, 'b' : 10}), {'a' : 4, 'b' : 3})
+        self.assertEqual(Database.getLeaseShares(10, {'a' : 1, 'b' : 10, 'c' : 3}), {'a' : 1, 'c' : 3, 'b' : 6})
+        self.assertEqual(Database.getLeaseShares(10, {'a' : 2, 'b' : 3}), {'a' : 2, 'b' : 3})
+        self.assertEqual(Database.getLeaseShares(0, {'a' : 2}), {'a' : 0})
+
+    def testHostsSharingDatabaseNeverOwnSameAccount(self):
+        owned = {host : database.claimLeases(host, 10, 120) for host, database in self.hosts.items()}
+        self.assertEqual(len(owned['a']), 6) # alone when it claimed
+        self.assertEqual(owned['b'] | owned['c'], set())
+        for _ in range(2):
+            owned = {host : database.claimLeases(host, 10, 120) for host, database in self.hosts.items()}
+            self.assertFalse(owned['a'] & owned['b'] or owned['a'] & owned['c'] or owned['b'] & owned['c'])
+
+    def testExtraLeasesExpireInsteadOfBeingDeleted(self):
+        a, b = self.hosts['a'], self.hosts['b']
+        a.claimLeases('a', 10, 120)
+        b.claimLeases('b', 10, 120)
+        ownedByA = a.claimLeases('a', 10, 120)
+        self.assertEqual(len(ownedByA), 3)
+        # the rest is still leased to `a` till it expires, `b` can not take it meanwhile
+        self.assertEqual(list(self.getLeaseOwners().values()).count('a'), 6)
+        self.assertEqual(b.claimLeases('b', 10, 120), set())
+        with a._lock, a.db:
+            a.db.execute("UPDATE leases SET expires = '2000-01-01T00:00:00+00:00' WHERE host = 'a' AND userName > 'user2';")
+        ownedByB = b.claimLeases('b', 10, 120)
+        self.assertEqual(len(ownedByB), 3)
+        self.assertFalse(ownedByA & ownedByB)
+
+    def testRunningAccountsKeepTheirLeases(self):
+        a, b = self.hosts['a'], self.hosts['b']
+        a.claimLeases('a', 10, 120)
+        b.claimLeases('b', 10, 120)
+        running = {('user4', 'wp'), ('user5', 'wp')}
+        ownedByA = a.claimLeases('a', 10, 120, running)
+        self.assertTrue(running <= ownedByA)
+        self.assertEqual(len(ownedByA), 3)
+        with a._lock, a.db:
+            a.db.execute("UPDATE leases SET expires = '2000-01-01T00:00:00+00:00' WHERE host = 'a';")
+        # expired lease of running account is renewed, as long as no other host took it
+        self.assertTrue(running <= a.claimLeases('a', 10, 120, running))
+        self.assertFalse(running & b.claimLeases('b', 10, 120))
+
+
+class DatabaseSetupTest(DatabaseTestCase):
+    def getElements(self, domain):
+        with self.database._lock, self.database.db:
+            return self.database.db.execute('SELECT elementName, by, value FROM domainElements WHERE domain = ? ORDER BY elementName;',
+                                            [domain]).fetchall()
+
+    def testDomainDataIsSyncedOnlyWhenBundleChanges(self):
+        bundled = self.getElements('wp')
+        with self.database._lock, self.database.db:
+            self.database.db.execute("DELETE FROM domainElements WHERE domain = 'wp' AND elementName = 'message';")
+        self.setup.update()
+        self.assertEqual(len(self.getElements('wp')), len(bundled) - 1) # same version, nothing synced
+        self.changeBundle("UPDATE domainElements SET value = 'stream-item' WHERE domain = 'wp' AND elementName = 'message';")
+        self.setup.update()
+        self.assertIn(('message', 'class name', 'stream-item'), self.getElements('wp'))
+        self.assertEqual(len(self.getElements('wp')), len(bundled))
+
+    def testMissingTablesAndColumnsAreAdded(self):
+        with self.database._lock, self.database.db:
+            self.database.db.execute('DROP TABLE leases;')
+            self.database.db.execute('ALTER TABLE users DROP COLUMN maxTimeInterval;')
+            self.database.db.execute("INSERT INTO users(userName, password, domain, timeInterval) VALUES('user', 'password', 'wp', 600);")
+        self.changeBundle("INSERT INTO domainAddress(domain, pageAddress) VALUES('test', 'https://example.com');")
+        self.setup.update()
+        with self.database._lock, self.database.db:
+            self.assertEqual(self.database.db.execute('SELECT count(*) FROM leases;').fetchone(), (0,))
+            self.assertEqual(self.database.db.execute('SELECT userName, maxTimeInterval FROM users;').fetchall(), [('user', None)])
+
+
+class LogsTest(DatabaseTestCase):
+    def insertLog(self, userName, error, deleted, date):
+        with self.database._lock, self.database.db:
+            self.database.db.execute("INSERT INTO logs(userName, loop_id, error, info, deleted, date, domain) VALUES(?, 0, ?, 'Done', ?, ?, 'wp');",
+                                     [userName, error, deleted, date])
+
+    def query(self, statement, parameters = ()):
+        with self.database._lock, self.database.db:
+            return self.database.db.execute(statement, parameters).fetchall()
+
+    def testOldLogsAreMigratedAndRolledUp(self):
+        with self.database._lock, self.database.db:
+            self.database.db.execute('DROP TRIGGER logRollupsHour;')
+            self.database.db.execute('DROP TRIGGER logRollupsDay;')
+            self.database.db.execute('DROP TABLE logRollups;')
+            self.database.db.execute("DELETE FROM meta WHERE key = 'domainDataVersion';")
+            self.database.db.execute("INSERT INTO users(userName, password, domain, timeInterval) VALUES('user', 'password', 'wp', 600);")
+            self.database.db.executemany("INSERT INTO logs(userName, loop_id, error, info, deleted, date) VALUES('user', 0, ?, 'Done', ?, ?);",
+                                         [(0, 3, '03/15/2024, 10:20:30'), (1, None, '03/15/2024, 10:40:00'), (0, 2, '03/16/2024, 08:00:00')])
+        self.setup.update()
+        self.assertEqual(self.query('SELECT domain, date FROM logs ORDER BY date;'),
+                         [('wp', '2024-03-15T10:20:30'), ('wp', '2024-03-15T10:40:00'), ('wp', '2024-03-16T08:00:00')])
+        self.assertEqual(self.query("SELECT period, start, loops, errors, deleted FROM logRollups ORDER BY period, start;"),
+                         [('day', '2024-03-15', 2, 1, 3), ('day', '2024-03-16', 1, 0, 2),
+                          ('hour', '2024-03-15T10:00:00', 2, 1, 3), ('hour', '2024-03-16T08:00:00', 1, 0, 2)])
+        self.insertLog('user', 0, 1, '2024-03-16T08:30:00') # trigger created by update keeps rollups current
+        self.assertEqual(self.database.getUserStats(), {('wp', 'user') : (4, 1, 6)})
+
+    def testCompactionKeepsDailyRollups(self):
+        oldDate = (datetime.datetime.now() - datetime.timedelta(days = 40)).replace(hour = 12).isoformat(timespec = 'seconds')
+        newDate = datetime.datetime.now().isoformat(timespec = 'seconds')
+        self.insertLog('user', 0, 5, oldDate)
+        self.insertLog('user', 0, 1, newDate)
+        writer = LogWriter(self.uddPath, maxDelay = 0.01)
+        writer.start()
+        self.database.logQueue = writer.queue
+        self.database.writeTiming('user', 'wp', 'login', 1, 2.5, 'ok')
+        self.database.compactLogs(30)
+        writer.close()
+        self.assertEqual(self.query('SELECT date FROM logs;'), [(newDate,)])
+        self.assertEqual(self.query("SELECT start FROM logRollups WHERE period = 'hour';"), [(newDate[:13] + ':00:00',)])
+        self.assertEqual(self.query("SELECT start FROM logRollups WHERE period = 'day' ORDER BY start;"), [(oldDate[:10],), (newDate[:10],)])
+        self.assertEqual(self.database.getUserStats(), {('wp', 'user') : (2, 0, 6)})
+        self.assertEqual(self.database.getTimings()[0], {('wp', 'login') : [2.5]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from selenium.common.exceptions import WebDriverException
+
+from domains import Common
+from setups import NoSuccessInNTrials, DomainUnavailable, getCircuitBreaker
+
+
+
+class StandInDatabase:
+    def __init__(self):
+        self.logs = []
+
+    def writeLog(self, userName, loopIndex, nDeleted, errorInfo, domain):
+        self.logs.append(errorInfo)
+
+    def writeTiming(self, *args):
+        pass
+
+
+class OutageAccount(Common):
+    '''
+    Account of domain which serves pages during outage, so only logging in fails
+    '''
+    def __init__(self, domain, failing = True):
+        Common.__init__(self, 'user', 'password', 60, domain)
+        self.failing = failing
+
+    def setup(self):
+        self.database = StandInDatabase()
+
+    def closeDriver(self):
+        pass
+
+    @Common._errorHandler
+    def acceptCookies(self, nTries = 1, **kwargs):
+        pass # optional, succeeds also when there is no banner
+
+    @Common._errorHandler
+    def login(self, nTries = 1, **kwargs):
+        if self.failing:
+            raise WebDriverException('maintenance page')
+
+    def logIn(self):
+        self.acceptCookies()
+        self.login()
+        return False
+
+    def processTabs(self):
+        pass
+
+    def saveSession(self):
+        pass
+
+
+class CircuitBreakerCycleTest(unittest.TestCase):
+    def testCyclesFailingAfterSuccessfulStepsOpenBreaker(self):
+        account = OutageAccount('outage')
+        for _ in range(getCircuitBreaker('outage', account.engine).failureThreshold):
+            with self.assertRaises(NoSuccessInNTrials):
+                account.runCycle()
+        with self.assertRaises(DomainUnavailable):
+            account.runCycle()
+        self.assertTrue(account.database.logs[-1].startswith('outage unavailable, cycle skipped'))
+
+    def testCompletedCycleResetsFailures(self):
+        account = OutageAccount('flaky')
+        breaker = getCircuitBreaker('flaky', account.engine)
+        for failing in [True, True, False, True, True]:
+            account.failing = failing
+            try:
+                account.runCycle()
+            except NoSuccessInNTrials:
+                pass
+        self.assertTrue(breaker.allowRequest())
+        self.assertEqual(breaker.nFailures, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import re
+import socketserver
+import sys
+import threading
+import time
+import imaplib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imapEngine import ImapEngine
+from setups import AdClassifier
+
+
+
+class StandInImapHandler(socketserver.StreamRequestHandler):
+    '''
+    Answers the few commands `ImapEngine` sends, the way IMAP server would. Messages of the only folder are
+    in `server.messages` {uid : [sender, subject, deleted]}. FETCH sends UID before header for odd UIDs and after it
+    for even ones, IDLE sends continuation and EXISTS in single write when `server.newMessageOnIdle` is set
+    '''
+    def handle(self):
+        self.send(b'* OK IMAP4rev1 stand-in ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, *arguments = line.rstrip(b'\r\n').split(b' ', 2)
+            self.server.commands.append(line.rstrip(b'\r\n').split(b' ', 1)[1]) # without tag
+            handler = getattr(self, 'do' + command.decode().upper(), None)
+            if handler is None:
+                self.send(tag + b' BAD unknown command')
+            elif handler(tag, arguments[0] if arguments else b'') is False:
+                return
+
+    def send(self, *lines):
+        self.wfile.write(b''.join(line + b'\r\n' for line in lines))
+
+    def doCAPABILITY(self, tag, arguments):
+        self.send(b'* CAPABILITY IMAP4rev1 IDLE UIDPLUS', tag + b' OK CAPABILITY completed')
+
+    def doLOGIN(self, tag, arguments):
+        self.send(tag + b' OK LOGIN completed')
+
+    def doNOOP(self, tag, arguments):
+        self.send(tag + b' OK NOOP completed')
+
+    def doLOGOUT(self, tag, arguments):
+        self.send(b'* BYE', tag + b' OK LOGOUT completed')
+        return False
+
+    def doSELECT(self, tag, arguments):
+        uidNext = max(self.server.messages, default = 0) + 1
+        self.send(b'* %d EXISTS' % len(self.server.messages), b'* OK [UIDVALIDITY 7] UIDs valid',
+                  b'* OK [UIDNEXT %d] Predicted next UID' % uidNext, tag + b' OK [READ-WRITE] SELECT completed')
+
+    def doUID(self, tag, arguments):
+        command, arguments = arguments.split(b' ', 1)
+        getattr(self, 'doUid' + command.decode().upper())(tag, arguments)
+
+    def doUidSEARCH(self, tag, arguments):
+        terms = [(key.decode(), text.decode().lower()) for key, text in re.findall(rb'(FROM|SUBJECT) "([^"]*)"', arguments)]
+        uids = [uid for uid, (sender, subject, deleted) in sorted(self.server.messages.items())
+                if not deleted and any(text in (sender if key == 'FROM' else subject).lower() for key, text in terms)]
+        self.send(b'* SEARCH ' + b' '.join(b'%d' % uid for uid in uids), tag + b' OK SEARCH completed')
+
+    def doUidFETCH(self, tag, arguments):
+        uids = [int(uid) for uid in arguments.split(b' ', 1)[0].split(b',')]
+        sequence = sorted(self.server.messages)
+        for uid in uids:
+            sender, subject, _ = self.server.messages[uid]
+            header = f'From: {sender}\r\nSubject: {subject}\r\n\r\n'.encode()
+            number = sequence.index(uid) + 1
+            if uid%2:
+                self.send(b'* %d FETCH (UID %d BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}' % (number, uid, len(header)) + b'\r\n' + header + b')')
+            else:
+                self.send(b'* %d FETCH (BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}' % (number, len(header)) + b'\r\n' + header + b' UID %d)' % uid)
+        self.send(tag + b' OK FETCH completed')
+
+    def doUidSTORE(self, tag, arguments):
+        for uid in arguments.split(b' ', 1)[0].split(b','):
+            self.server.messages[int(uid)][2] = True
+        self.send(tag + b' OK STORE completed')
+
+    def doUidEXPUNGE(self, tag, arguments):
+        uids = {int(uid) for uid in arguments.split(b',')}
+        for number, uid in reversed(list(enumerate(sorted(self.server.messages), 1))):
+            if uid in uids and self.server.messages[uid][2]:
+                del self.server.messages[uid]
+                self.send(b'* %d EXPUNGE' % number)
+        self.send(tag + b' OK EXPUNGE completed')
+
+    def doIDLE(self, tag, arguments):
+        if self.server.newMessageOnIdle:
+            self.server.messages[max(self.server.messages) + 1] = ['friend@example.com', 'Hello', False]
+            self.send(b'+ idling', b'* %d EXISTS' % len(self.server.messages))
+        else:
+            self.send(b'+ idling')
+        if self.rfile.readline().strip().upper() == b'DONE':
+            self.send(tag + b' OK IDLE terminated')
+
+
+class StandInImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, newMessageOnIdle = False):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StandInImapHandler)
+        self.messages = messages
+        self.newMessageOnIdle = newMessageOnIdle
+        self.commands = []
+
+
+class StandInDatabase:
+    def writeTiming(self, *args):
+        pass
+
+    def writeLog(self, *args):
+        pass
+
+
+class ImapEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInImapServer({1 : ['Shop <promo@shop.example>', 'Big sale', False],
+                                         2 : ['Friend <friend@example.com>', 'Lunch?', False],
+                                         3 : ['News <news@example.com>', 'Last sale of the year', False],
+                                         4 : ['Bank <bank@example.com>', 'Statement', False]})
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.engine = ImapEngine('user', 'password', 60, 'stand-in')
+        self.engine.database = StandInDatabase()
+        self.engine.adClassifier = AdClassifier(1, [('subject', 'substring', 'sale'), ('sender', 'suffix', 'promo@shop.example>')])
+        self.engine.tabNames = ['INBOX']
+        self.engine.incremental = False
+        self.engine.defaultTimeIntervalBetweenTrials = 0
+        self.engine.connection = imaplib.IMAP4(*self.server.server_address)
+        self.engine.connection.login('user', 'password')
+
+    def tearDown(self):
+        self.engine.connection.logout()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testAdsAreSearchedFetchedAndDeleted(self):
+        self.engine.processTabs()
+        self.assertEqual(sorted(self.server.messages), [2, 4])
+        self.assertEqual(self.engine.nSelectedMessages, 2)
+        self.assertIn(b'UID SEARCH OR SUBJECT "sale" FROM "promo@shop.example>"', self.server.commands)
+        self.assertIn(b'UID EXPUNGE 1,3', self.server.commands)
+
+    def testUidIsReadBeforeAndAfterHeader(self):
+        self.engine.switchTab('INBOX')
+        self.engine.adClassifier = AdClassifier(1, [('sender', 'substring', 'example')])
+        messages = self.engine.getMessages()
+        self.assertEqual(sorted(uid for uid, _, _ in messages), [b'1', b'2', b'3', b'4'])
+        self.assertIn((b'4', 'Bank', 'Statement'), messages)
+
+    def testIdleWakesUpOnExistsSentWithContinuation(self):
+        self.server.newMessageOnIdle = True
+        self.engine.switchTab('INBOX')
+        startTime = time.monotonic()
+        self.assertTrue(self.engine._idle(5))
+        self.assertLess(time.monotonic() - startTime, 2)
+        self.assertEqual(self.engine.connection.noop()[0], 'OK') # connection is in sync after DONE
+
+    def testIdleTimesOutWithoutNewMessage(self):
+        self.engine.switchTab('INBOX')
+        self.assertFalse(self.engine._idle(0.5))
+        self.assertEqual(self.engine.connection.noop()[0], 'OK')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import setups
+from setups import AdClassifier, CircuitBreaker, DriverPool, LogWriter
+
+
+
+class AdClassifierTest(unittest.TestCase):
+    def testEveryKindMatchesItsField(self):
+        classifier = AdClassifier(1, [('sender', 'suffix', '/WP'), ('sender', 'prefix', 'Shop'),
+                                      ('subject', 'substring', 'sale'), ('subject', 'regex', r'\d+% off')])
+        self.assertEqual(classifier.getMatchingRule('News/WP'), 0)
+        self.assertEqual(classifier.getMatchingRule('Shop24'), 1)
+        self.assertEqual(classifier.getMatchingRule('Friend', 'Big sale'), 2)
+        self.assertEqual(classifier.getMatchingRule('Friend', '20% off'), 3)
+        self.assertIsNone(classifier.getMatchingRule('/WP friend', 'Shop'))
+        self.assertEqual(classifier.classify([('a/WP', ''), ('Friend', 'Lunch?')]), [True, False])
+
+    def testRulesAreEscaped(self):
+        classifier = AdClassifier(1, [('sender', 'suffix', 'a.b (ads)')])
+        self.assertTrue(classifier.isAd('x a.b (ads)'))
+        self.assertFalse(classifier.isAd('x axb (ads)'))
+
+    def testGroupReferencesAreRejected(self):
+        for pattern in [r'(a)\1', r'(?P<n>Promo)', r'(?P=n)', r'x\\\1', r'(a)?(?(1)b|c)']:
+            with self.assertRaises(ValueError, msg = pattern):
+                AdClassifier.getExpression('regex', pattern)
+        for pattern in [r'a\\1', r'(?:Promo|Sale)', r'(Promo|Sale) \d+']:
+            AdClassifier.getExpression('regex', pattern)
+
+    def testInvalidRuleDoesNotStopOthers(self):
+        classifier = AdClassifier(1, [('subject', 'regex', '(unclosed'), ('subject', 'regex', r'(a)\1'),
+                                      ('subject', 'unknown', 'x'), ('subject', 'substring', 'Deal')])
+        self.assertEqual(classifier.getMatchingRule('x', 'Deal'), 3)
+        self.assertIsNone(classifier.getMatchingRule('x', 'aa'))
+
+    def testSearchTermsOnlyWithoutRegexRules(self):
+        self.assertEqual(AdClassifier(1, [('sender', 'suffix', '/WP')]).getSearchTerms(), [('sender', '/WP')])
+        self.assertIsNone(AdClassifier(1, [('subject', 'regex', 'a+')]).getSearchTerms())
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', 'browser', failureThreshold = 3, openTime = 60, maxOpenTime = 100)
+
+    def testOpensAfterFailuresInRow(self):
+        for _ in range(2):
+            self.breaker.recordFailure()
+        self.breaker.recordSuccess()
+        for _ in range(2):
+            self.breaker.recordFailure()
+        self.assertTrue(self.breaker.allowRequest())
+        self.breaker.recordFailure()
+        self.assertFalse(self.breaker.allowRequest())
+        self.assertGreater(self.breaker.getRetryTime(), 50)
+
+    def testProbeClosesOrReopensForLonger(self):
+        for _ in range(3):
+            self.breaker.recordFailure()
+        self.breaker.openUntil = 0 # probe is due
+        self.assertTrue(self.breaker.allowRequest())
+        self.breaker.recordFailure()
+        self.assertFalse(self.breaker.allowRequest())
+        self.assertGreater(self.breaker.getRetryTime(), 100 - 1) # twice as long, up to `maxOpenTime`
+        self.breaker.openUntil = 0
+        self.assertTrue(self.breaker.allowRequest())
+        self.breaker.recordSuccess()
+        self.assertTrue(self.breaker.allowRequest())
+        self.assertEqual(self.breaker.getRetryTime(), 0)
+
+    def testOnlyProbeThreadIsLetThrough(self):
+        for _ in range(3):
+            self.breaker.recordFailure()
+        self.breaker.openUntil = 0
+        self.assertTrue(self.breaker.allowRequest())
+        otherThreadAllowed = []
+        thread = threading.Thread(target = lambda: otherThreadAllowed.append(self.breaker.allowRequest()))
+        thread.start()
+        thread.join()
+        self.assertEqual(otherThreadAllowed, [False])
+        self.breaker.releaseProbe()
+        self.assertTrue(self.breaker.allowRequest()) # probe of the next cycle
+
+
+class FlakyLogWriter(LogWriter):
+    '''
+    Log writer which finds database busy on the first `nBusyFlushes` writes
+    '''
+    def __init__(self, databasePath, nBusyFlushes, **kwargs):
+        LogWriter.__init__(self, databasePath, **kwargs)
+        self.nBusyFlushes = nBusyFlushes
+        self.nFlushes = 0
+
+    def _flush(self, db, batch):
+        self.nFlushes += 1
+        if self.nFlushes <= self.nBusyFlushes:
+            return batch
+        return LogWriter._flush(self, db, batch)
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databasePath = os.path.join(self.directory, 'logs.sqlite')
+        with sqlite3.connect(self.databasePath) as db:
+            db.execute('CREATE TABLE logs (message text);')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def getMessages(self):
+        db = sqlite3.connect(self.databasePath)
+        messages = [message for message, in db.execute('SELECT message FROM logs;')]
+        db.close()
+        return messages
+
+    def testBusyBatchIsWrittenLater(self):
+        writer = FlakyLogWriter(self.databasePath, 2, maxBatchSize = 1, maxDelay = 0.05)
+        writer.start()
+        writer.put('INSERT INTO logs VALUES (?);', ['first'])
+        writer.put('INSERT INTO logs VALUES (?);', ['second'])
+        writer.close()
+        self.assertEqual(self.getMessages(), ['first', 'second'])
+        self.assertGreater(writer.nFlushes, 2)
+
+    def testCloseGivesUpWhenDatabaseStaysBusy(self):
+        writer = FlakyLogWriter(self.databasePath, 100, maxBatchSize = 10, maxDelay = 0.01, closeTrials = 3)
+        writer.start()
+        writer.put('INSERT INTO logs VALUES (?);', ['lost'])
+        writer.close()
+        self.assertEqual(self.getMessages(), [])
+        self.assertEqual(writer.nFlushes, 3)
+
+    def testInvalidRecordIsDroppedAlone(self):
+        writer = LogWriter(self.databasePath, maxDelay = 0.01)
+        writer.start()
+        writer.put('INSERT INTO logs VALUES (?);', ['kept'])
+        writer.put('INSERT INTO logs VALUES (?);', ['too', 'many'])
+        writer.close()
+        self.assertEqual(self.getMessages(), ['kept'])
+
+    def testSwitchingToWalIsRetriedWhileDatabaseIsLocked(self):
+        connect = sqlite3.connect
+        nLocked = [2]
+        def lockedConnect(*args, **kwargs):
+            db = connect(*args, **kwargs)
+            if nLocked[0]:
+                nLocked[0] -= 1
+                db = mock.Mock(wraps = db)
+                db.execute.side_effect = sqlite3.OperationalError('database is locked')
+            return db
+        writer = LogWriter(self.databasePath, maxDelay = 0.01)
+        with mock.patch.object(setups.sqlite3, 'connect', lockedConnect):
+            writer.start()
+            writer.put('INSERT INTO logs VALUES (?);', ['written'])
+            writer.close()
+        self.assertEqual(nLocked, [0])
+        self.assertEqual(self.getMessages(), ['written'])
+
+
+class StandInDriver:
+    def __init__(self):
+        self.nQuits = 0
+
+    def quit(self):
+        self.nQuits += 1
+
+
+class StandInDriverPool(DriverPool):
+    '''
+    Driver pool of stand-in drivers, which are always healthy and reset without browser
+    '''
+    def __init__(self, size):
+        DriverPool.__init__(self, size)
+        self._config = mock.Mock(getDriver = StandInDriver)
+
+    def _isHealthy(self, driver):
+        return True
+
+    def _reset(self, driver):
+        return True
+
+    def getRssMb(self, driver):
+        return 0
+
+
+class DriverPoolTest(unittest.TestCase):
+    def testShutdownQuitsBorrowedDrivers(self):
+        pool = StandInDriverPool(size = 2)
+        borrowed, idle = pool.borrow(), pool.borrow()
+        pool.giveBack(idle)
+        pool.shutdown()
+        self.assertEqual((borrowed.nQuits, idle.nQuits), (1, 1))
+        pool.giveBack(borrowed) # given back after shutdown, e.g. by thread still running
+        self.assertEqual(pool._nDrivers, 0)
+        with self.assertRaises(RuntimeError):
+            pool.borrow()
+
+    def testDriverIsReusedUntilMaxUses(self):
+        pool = StandInDriverPool(size = 1)
+        pool.maxUses = 2
+        driver = pool.borrow()
+        pool.giveBack(driver)
+        self.assertIs(pool.borrow(), driver)
+        pool.giveBack(driver)
+        self.assertEqual(driver.nQuits, 1)
+        self.assertIsNot(pool.borrow(), driver)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file